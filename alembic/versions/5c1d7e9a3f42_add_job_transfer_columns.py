@@ -0,0 +1,37 @@
+"""add job transfer columns and status index
+
+Revision ID: 5c1d7e9a3f42
+Revises:
+Create Date: 2026-10-18 09:12:40.318522
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c1d7e9a3f42'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # init_db() runs create_all on startup, so a fresh database may already have these
+    inspector = sa.inspect(op.get_bind())
+    columns = {column['name'] for column in inspector.get_columns('job')}
+    indexes = {index['name'] for index in inspector.get_indexes('job')}
+    if 'codec' not in columns:
+        op.add_column('job', sa.Column('codec', sa.String(length=32), nullable=True))
+    if 'checksum' not in columns:
+        op.add_column('job', sa.Column('checksum', sa.String(length=80), nullable=True))
+    if 'ix_job_status' not in indexes:
+        op.create_index('ix_job_status', 'job', ['status'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_job_status', table_name='job')
+    op.drop_column('job', 'checksum')
+    op.drop_column('job', 'codec')
@@ -0,0 +1,33 @@
+"""add paused and cancelled job statuses
+
+Revision ID: 9e4b2a6d8c17
+Revises: 5c1d7e9a3f42
+Create Date: 2026-10-18 09:31:05.742096
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9e4b2a6d8c17'
+down_revision: Union[str, None] = '5c1d7e9a3f42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Only Postgres has a native enum type; SQLAlchemy stores the member names
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    # ALTER TYPE ... ADD VALUE cannot be used inside the migration's transaction
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TYPE jobstatus ADD VALUE IF NOT EXISTS 'PAUSED'")
+        op.execute("ALTER TYPE jobstatus ADD VALUE IF NOT EXISTS 'CANCELLED'")
+
+
+def downgrade() -> None:
+    # Postgres cannot drop values from an enum type; the extra values are left in place
+    pass
@@ -1,3 +1,4 @@
+import os
 from datetime import datetime, timedelta, timezone
 from sqlalchemy.orm import Session
 from app.db_setup import get_db
@@ -15,6 +16,10 @@ SECRET_KEY = "09d25e094faa6ca2556c81816644vdf31vdfdf7099f6f0f4caa6hkjsdfd8d3e7"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 30  # 30 days
 
+# Comma-separated emails of the users allowed to change settings shared by every
+# user's jobs, such as bandwidth budgets. Nobody when unset.
+ADMIN_EMAILS = {email.strip().lower() for email in os.getenv('ADMIN_EMAILS', '').split(',') if email.strip()}
+
 router = APIRouter()
 
 
@@ -97,6 +102,12 @@ def get_current_user(
     return user
 
 
+def get_admin_user(current_user: User = Depends(get_current_user)):
+    if current_user.email.lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
+
+
 
 # async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
 #     credentials_exception = HTTPException(
@@ -15,7 +15,9 @@ celery_app = Celery(
 # Add this to explicitly include task modules
 celery_app.autodiscover_tasks([
     'app.utils.windows_transfer',
-    'app.utils.linux_paramiko_transfer'
+    'app.utils.linux_paramiko_transfer',
+    'app.utils.sync_transfer',
+    'app.utils.fan_out_transfer'
 ])
 
 # Configure Celery
@@ -26,6 +28,10 @@ celery_app.conf.update(
     timezone='UTC',
     enable_utc=True,
     broker_connection_retry_on_startup=True,
+    # Late-acked transfers run for hours; keep Redis from redelivering them mid-run.
+    # A transfer still running after this is redelivered anyway; the second delivery
+    # finds the task's lease (app.utils.job_slots.task_lease) taken and is dropped.
+    broker_transport_options={'visibility_timeout': 43200},
     
     # Add ML worker configuration
     task_routes={
@@ -34,7 +40,12 @@ celery_app.conf.update(
     },
     # task_time_limit=14400,  # 4 hours max
     # task_soft_time_limit=14100,  # Soft limit 15 mins before hard limit
-    worker_prefetch_multiplier=1,  # Process one task at a time
+    # One message per pool thread; run_celery.sh sizes the thread pool to
+    # TRANSFER_JOBS_PER_PROCESS and app.utils.job_slots keeps per-host limits
+    worker_prefetch_multiplier=1,
+    # task-started/succeeded/failed events for the API's job monitor, next to the
+    # task-progress and task-job-status events the transfers send themselves
+    worker_send_task_events=True,
     # worker_max_memory_per_child=4000000,  # Restart worker after using 4GB RAM
        # Add beat schedule
     # beat_schedule={
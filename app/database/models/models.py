@@ -1,5 +1,5 @@
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import Integer, String, Text, Boolean, ForeignKey, DateTime, func, Enum as SQLAlchemyEnum
+from sqlalchemy import Integer, BigInteger, String, Text, Boolean, ForeignKey, DateTime, UniqueConstraint, func, Enum as SQLAlchemyEnum
 from datetime import datetime
 from app.database.models.base_model import Base
 from enum import Enum
@@ -9,6 +9,8 @@ class JobStatus(str, Enum):
     IN_PROGRESS = "in_progress"
     COMPLETED = "completed"
     FAILED = "failed"
+    PAUSED = "paused"
+    CANCELLED = "cancelled"
 
 class User(Base):
     __tablename__ = "user"
@@ -46,11 +48,59 @@ class Job(Base):
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id"), nullable=False)
     source_storage: Mapped[str] = mapped_column(String(255), nullable=False)
     dest_storage: Mapped[str] = mapped_column(String(255), nullable=False)
-    status: Mapped[JobStatus] = mapped_column(SQLAlchemyEnum(JobStatus), default=JobStatus.PENDING, nullable=False)
+    # Indexed: the job monitor's reconciliation looks up every unfinished job by status
+    status: Mapped[JobStatus] = mapped_column(SQLAlchemyEnum(JobStatus), default=JobStatus.PENDING, nullable=False, index=True)
     description: Mapped[str] = mapped_column(Text, nullable=True)
     errors: Mapped[str] = mapped_column(Text, nullable=True)
     task_id: Mapped[str] = mapped_column(String(255), nullable=True)
+    # Compression used for the tar stream/archive, e.g. "zstd:3" (the pick of "auto")
+    codec: Mapped[str] = mapped_column(String(32), nullable=True)
+    # Verified digest of what landed on the destination ("sha256:..." over the copied
+    # files/ranges, or "manifest-sha256:..." after a per-file manifest check)
+    checksum: Mapped[str] = mapped_column(String(80), nullable=True)
 
 
     # Relationship
     user = relationship("User", back_populates="jobs")
+    checkpoints = relationship("TransferCheckpoint", back_populates="job", cascade="all, delete-orphan")
+    shards = relationship("TransferShard", back_populates="job", cascade="all, delete-orphan",
+                          order_by="TransferShard.shard_index")
+
+
+class TransferCheckpoint(Base):
+    """Last byte offset confirmed on the destination for one file (or one byte range of it)"""
+    __tablename__ = "transfer_checkpoint"
+    __table_args__ = (UniqueConstraint("job_id", "dest_path", "range_start"),)
+
+    job_id: Mapped[int] = mapped_column(ForeignKey("job.id"), nullable=False, index=True)
+    source_path: Mapped[str] = mapped_column(String(1024), nullable=False)
+    dest_path: Mapped[str] = mapped_column(String(1024), nullable=False)
+    file_size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    range_start: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    range_end: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    offset: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    # sha256 chained over every confirmed segment, and sha256 of the bytes just before offset
+    digest: Mapped[str] = mapped_column(String(64), nullable=False)
+    tail_digest: Mapped[str] = mapped_column(String(64), nullable=False)
+
+    # Relationship
+    job = relationship("Job", back_populates="checkpoints")
+
+
+class TransferShard(Base):
+    """One unit of a sharded transfer plan: a tar batch of small files, or a single large file"""
+    __tablename__ = "transfer_shard"
+    __table_args__ = (UniqueConstraint("job_id", "shard_index"),)
+
+    job_id: Mapped[int] = mapped_column(ForeignKey("job.id"), nullable=False, index=True)
+    shard_index: Mapped[int] = mapped_column(Integer, nullable=False)
+    # "tar" or "file"
+    kind: Mapped[str] = mapped_column(String(8), nullable=False)
+    file_count: Mapped[int] = mapped_column(Integer, nullable=False)
+    total_bytes: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    # JSON list of paths relative to the source root
+    paths: Mapped[str] = mapped_column(Text, nullable=False)
+    completed: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+
+    # Relationship
+    job = relationship("Job", back_populates="shards")
@@ -40,4 +40,36 @@ class JobRead(JobBase):
 class TransferRequest(BaseModel):
     source_storage: str
     dest_storage: str
+    # How the tree is sent:
+    #   archive: stages a tar archive on both hosts
+    #   stream:  pipes tar through the worker
+    #   direct:  has the source pipe tar to the destination itself
+    #   files:   copies file by file over pooled SFTP sessions
+    #   sync:    sends only what differs from the destination
+    #   sharded: sends small files in balanced tar batches and large files on their
+    #            own, several at a time
+    mode: str = "archive"
+    # sync only: compare same-size files by sha256 when their mtimes differ, and
+    # delete destination files that are gone from the source
+    checksum: bool = False
+    prune: bool = False
+    # archive/stream only: none, gzip, pigz, zstd, lz4, or auto to pick one by sampling
+    # the source; codec_level overrides the codec's default level
+    codec: str = "gzip"
+    codec_level: Optional[int] = None
+    # After the transfer, compare every file of the two trees by sha256 (any mode but sync)
+    verify_manifest: bool = False
+    # sharded only: split the shards over several Celery subtasks so idle workers help
+    fan_out: bool = False
+    # Weight of the job when it shares a bandwidth budget with others (2.0 gets twice
+    # the bandwidth of a default job)
+    priority: float = Field(default=1.0, gt=0)
+
+
+class BandwidthBudget(BaseModel):
+    # Both hosts for a host pair budget, neither for the global one
+    source_host: Optional[str] = None
+    dest_host: Optional[str] = None
+    # 0 removes the limit
+    bytes_per_second: int = Field(ge=0)
 
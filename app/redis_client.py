@@ -0,0 +1,14 @@
+import os
+import redis
+
+redis_backend_url = os.getenv('REDIS_BACKEND_URL')
+
+_client = None
+
+
+def get_redis():
+    """Shared Redis client for state the API and the workers coordinate through"""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(redis_backend_url)
+    return _client
@@ -1,19 +1,26 @@
 from fastapi import APIRouter, HTTPException, Depends
-from app.database.schemas.schemas import TransferRequest
+from app.database.schemas.schemas import TransferRequest, BandwidthBudget
 # from app.tasks.transfer import transfer
-from app.database.models.models import Job, User
+from app.database.models.models import Job, User, JobStatus
 import subprocess
 from pathlib import Path
 import time
 import re
 from app.logging.logger import logger
 import platform
+import asyncio
 from app.utils.windows_transfer import windows_tar_transfer
 from app.utils.linux_paramiko_transfer import linux_paramiko_transfer
 from app.db_setup import get_db
 from sqlalchemy.orm import Session
 from app.celery_app import celery_app
-from app.auth import get_current_user
+from app.auth import get_current_user, get_admin_user
+from app.utils.compression import validate_codec
+from app.utils.bandwidth import set_budget, get_budgets, pair_name, GLOBAL_BUDGET
+from app.utils.shard_transfer import load_plan
+from app.utils.manifest_cache import cache_stats
+from app.utils.job_control import request_stop, resume_job, cancel_paused
+from app.websocket.connection_manager import manager
 router = APIRouter()
 
 
@@ -31,6 +38,8 @@ SERVER_CONFIGS = {
 
 IDENTITY_FILE = Path(__file__).parent.parent / 'identityFile' / 'id_rsa'
 
+TRANSFER_MODES = ["archive", "stream", "direct", "files", "sync", "sharded"]
+
 
 @router.get("")
 async def get_jobs(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
@@ -45,6 +54,13 @@ async def transfer_repository(request: TransferRequest, db: Session = Depends(ge
         raise HTTPException(status_code=400, detail="Source storage is required")
     if request.dest_storage == "":
         raise HTTPException(status_code=400, detail="Destination storage is required")
+    if request.mode not in TRANSFER_MODES:
+        raise HTTPException(status_code=400, detail=f"Transfer mode must be one of {TRANSFER_MODES}")
+    if request.fan_out and request.mode != "sharded":
+        raise HTTPException(status_code=400, detail="fan_out is only supported in sharded mode")
+    codec_error = validate_codec(request.codec, request.codec_level)
+    if codec_error:
+        raise HTTPException(status_code=400, detail=codec_error)
     
     # TODO: add the job to the database
     job = Job(
@@ -62,14 +78,33 @@ async def transfer_repository(request: TransferRequest, db: Session = Depends(ge
         "source_storage": request.source_storage,
         "dest_storage": request.dest_storage,
         "status": "pending",
-        "user_id": current_user.id
+        "user_id": current_user.id,
+        "mode": request.mode,
+        "checksum": request.checksum,
+        "prune": request.prune,
+        "codec": request.codec,
+        "codec_level": request.codec_level,
+        "verify_manifest": request.verify_manifest,
+        "priority": request.priority
     }
 
     try:
         print("platform",platform.system())
         # Check operating system and use appropriate transfer method
         task = None
-        if platform.system() == 'Windows':
+        if request.fan_out:
+            logger.debug("Attempting to queue fan-out transfer task")
+            task = celery_app.send_task(
+                'transfer.fan_out',
+                args=[transfer_data, SERVER_CONFIGS, str(IDENTITY_FILE)]
+            )
+        elif request.mode == "sync":
+            logger.debug("Attempting to queue sync task")
+            task = celery_app.send_task(
+                'transfer.sync',
+                args=[transfer_data, SERVER_CONFIGS, str(IDENTITY_FILE)]
+            )
+        elif platform.system() == 'Windows':
             print("windows")
             logger.debug("Attempting to queue Windows transfer task")
             task = celery_app.send_task(
@@ -101,6 +136,121 @@ async def transfer_repository(request: TransferRequest, db: Session = Depends(ge
 
 
 
+@router.get("/bandwidth")
+async def get_bandwidth_budgets(current_user: User = Depends(get_current_user)):
+    """Current bandwidth budgets in bytes/s, by host pair ('source->dest') and 'global'"""
+    return get_budgets()
+
+
+@router.put("/bandwidth")
+async def set_bandwidth_budget(budget: BandwidthBudget, current_user: User = Depends(get_admin_user)):
+    """Change a bandwidth budget (admins only: budgets apply to every user's jobs); running jobs pick it up within a few megabytes"""
+    if bool(budget.source_host) != bool(budget.dest_host):
+        raise HTTPException(status_code=400, detail="Give both hosts for a host pair budget, or neither for the global one")
+    name = pair_name(budget.source_host, budget.dest_host) if budget.source_host else GLOBAL_BUDGET
+    try:
+        set_budget(name, budget.bytes_per_second)
+    except Exception as e:
+        logger.error(f"Failed to set bandwidth budget: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to set bandwidth budget: {str(e)}")
+    return get_budgets()
+
+
+@router.get("/manifest-cache")
+async def get_manifest_cache_stats(current_user: User = Depends(get_current_user)):
+    """Hits, misses, stale entries and stores of the source manifest cache, across all workers"""
+    try:
+        return cache_stats()
+    except Exception as e:
+        logger.error(f"Failed to read manifest cache stats: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to read manifest cache stats: {str(e)}")
+
+
+@router.get("/websockets")
+async def get_websocket_stats(current_user: User = Depends(get_current_user)):
+    """Queue depth, dropped frames and send lag of your websockets on the API process that answers"""
+    return manager.stats(current_user.id)
+
+
+@router.get("/{job_id}/plan")
+async def get_job_plan(job_id: int, paths: bool = False, db: Session = Depends(get_db),
+                       current_user: User = Depends(get_current_user)):
+    """The shard plan of a sharded job; file lists only with ?paths=true, they can be long"""
+    job = db.query(Job).filter(Job.id == job_id, Job.user_id == current_user.id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    plan = load_plan(job_id, with_paths=paths)
+    return {
+        "job_id": job_id,
+        "shards": plan,
+        "completed": sum(1 for shard in plan if shard['completed']),
+        "total_bytes": sum(shard['total_bytes'] for shard in plan)
+    }
+
+
+def get_user_job(db, job_id, user):
+    job = db.query(Job).filter(Job.id == job_id, Job.user_id == user.id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+def stop_job(db, job_id, user, action):
+    """Flag a queued or running job; its task stops at the next chunk and sets the job's status itself"""
+    job = get_user_job(db, job_id, user)
+    if job.status not in (JobStatus.PENDING, JobStatus.IN_PROGRESS):
+        raise HTTPException(status_code=409, detail=f"Job is {job.status.value}; only pending or running jobs can be stopped")
+    try:
+        request_stop(job_id, action)
+    except Exception as e:
+        logger.error(f"Failed to {action} job {job_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to {action} job: {str(e)}")
+    logger.info(f"Requested {action} of job {job_id}")
+    return {"job_id": job_id, "action": action, "status": job.status}
+
+
+@router.post("/{job_id}/pause")
+async def pause_job(job_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    """Stop a job, keeping what it has transferred so far; POST /{job_id}/resume carries on"""
+    return stop_job(db, job_id, current_user, 'pause')
+
+
+@router.post("/{job_id}/cancel")
+async def cancel_job(job_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    """Stop a job for good: its remote tar processes are killed and partial archives removed"""
+    job = get_user_job(db, job_id, current_user)
+    if job.status == JobStatus.PAUSED:
+        # No task left to flag; clean up what the paused run left behind right here
+        try:
+            await asyncio.to_thread(cancel_paused, job_id)
+        except Exception as e:
+            logger.error(f"Failed to cancel paused job {job_id}: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Failed to cancel job: {str(e)}")
+        return {"job_id": job_id, "action": "cancel", "status": JobStatus.CANCELLED}
+    return stop_job(db, job_id, current_user, 'cancel')
+
+
+@router.post("/{job_id}/resume")
+async def resume_paused_job(job_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    """Queue a paused job again; it picks up from what the paused run left behind"""
+    job = get_user_job(db, job_id, current_user)
+    if job.status != JobStatus.PAUSED:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status.value}; only paused jobs can be resumed")
+    try:
+        task = resume_job(job_id, celery_app.send_task)
+    except Exception as e:
+        logger.error(f"Failed to resume job {job_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to resume job: {str(e)}")
+    if task is None:
+        raise HTTPException(status_code=409, detail="Nothing to resume the job from; it may have expired")
+    logger.info(f"Job {job_id} resumed as task {task.id}")
+    job.status = JobStatus.PENDING
+    job.task_id = str(task)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
 @router.post("/test")
 async def test_transfer_direct(request: TransferRequest, current_user: User = Depends(get_current_user)):
     """Test endpoint that performs transfer directly without Celery"""
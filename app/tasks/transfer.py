@@ -7,7 +7,7 @@ import json
 import re
 import time
 from app.logging.logger import logger
-from app.websocket.connection_manager import manager
+from app.websocket.event_bus import publish_to_user
 from asgiref.sync import async_to_sync
 
 # Define server configurations
@@ -168,7 +168,7 @@ async def send_progress_update(
     estimated_time: int = None,
     error: str = None
 ):
-    """Send detailed progress update through WebSocket."""
+    """Send detailed progress update through WebSocket, via the API processes' event subscription."""
     message = {
         "type": "transfer_progress",
         "progress": progress,
@@ -178,4 +178,4 @@ async def send_progress_update(
         "estimated_time_remaining": estimated_time,
         "error": error
     }
-    await manager.broadcast_to_user(user_id, message)
\ No newline at end of file
+    publish_to_user(user_id, message)
\ No newline at end of file
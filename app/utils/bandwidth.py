@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+from app.logging.logger import logger
+from app.redis_client import get_redis
+
+# Bytes a job takes from its bucket per Redis round trip. The copy loops count every
+# chunk locally and only go to Redis when this allowance is used up.
+BANDWIDTH_QUANTUM = int(os.getenv('BANDWIDTH_QUANTUM', 4 * 1024 * 1024))
+# Seconds of budget a job may save up while it is not sending
+BANDWIDTH_BURST_SECONDS = float(os.getenv('BANDWIDTH_BURST_SECONDS', 1))
+# A job that has not drawn from a bucket for this long no longer counts toward the shares
+BANDWIDTH_STALE_SECONDS = int(os.getenv('BANDWIDTH_STALE_SECONDS', 30))
+
+GLOBAL_BUDGET = 'global'
+BUDGET_KEY = 'bandwidth:budget:{}'      # bytes/s; missing or 0 means unlimited
+WEIGHTS_KEY = 'bandwidth:weights:{}'    # job id -> priority weight of the active jobs
+SEEN_KEY = 'bandwidth:seen:{}'          # job id -> last time the job drew from the bucket
+BUCKET_KEY = 'bandwidth:bucket:{}'      # the job's own bucket: tokens, updated
+
+# Every job has its own bucket, filled at its weighted share of each budget it falls
+# under (the host pair's and the global one), whichever is smaller. The shares of the
+# active jobs add up to the budget, so together they never exceed it. Tokens may go
+# negative: the caller then sleeps for the returned number of seconds, which keeps
+# chunk sizes and the quantum from mattering.
+TAKE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local job, weight, wanted = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local stale, burst = tonumber(ARGV[4]), tonumber(ARGV[5])
+
+local rate = nil
+for i = 0, 1 do
+    local budget_key, weights_key, seen_key = KEYS[i * 3 + 1], KEYS[i * 3 + 2], KEYS[i * 3 + 3]
+    redis.call('HSET', weights_key, job, weight)
+    redis.call('ZADD', seen_key, now, job)
+    for _, gone in ipairs(redis.call('ZRANGEBYSCORE', seen_key, '-inf', now - stale)) do
+        redis.call('HDEL', weights_key, gone)
+        redis.call('ZREM', seen_key, gone)
+    end
+    redis.call('EXPIRE', weights_key, stale * 2)
+    redis.call('EXPIRE', seen_key, stale * 2)
+
+    local budget = tonumber(redis.call('GET', budget_key) or '0')
+    if budget and budget > 0 then
+        local total = 0
+        for _, w in ipairs(redis.call('HVALS', weights_key)) do
+            total = total + tonumber(w)
+        end
+        local share = budget * weight / total
+        if rate == nil or share < rate then
+            rate = share
+        end
+    end
+end
+
+local bucket = KEYS[7]
+if rate == nil then
+    redis.call('DEL', bucket)
+    return '0'
+end
+local tokens = tonumber(redis.call('HGET', bucket, 'tokens') or tostring(rate * burst))
+local updated = tonumber(redis.call('HGET', bucket, 'updated') or tostring(now))
+tokens = math.min(rate * burst, tokens + (now - updated) * rate) - wanted
+redis.call('HSET', bucket, 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', bucket, stale * 2)
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+
+def pair_name(source_host, dest_host):
+    return f"{source_host}->{dest_host}"
+
+
+def set_budget(name, bytes_per_second):
+    """Set the budget of a host pair (see pair_name) or GLOBAL_BUDGET; 0 removes the limit"""
+    if bytes_per_second:
+        get_redis().set(BUDGET_KEY.format(name), int(bytes_per_second))
+    else:
+        get_redis().delete(BUDGET_KEY.format(name))
+    logger.info(f"Bandwidth budget for {name} set to {bytes_per_second or 'unlimited'} bytes/s")
+
+
+def get_budgets():
+    """{name: bytes/s} for every budget currently set"""
+    redis = get_redis()
+    prefix = BUDGET_KEY.format('')
+    keys = list(redis.scan_iter(match=f"{prefix}*"))
+    values = redis.mget(keys) if keys else []
+    return {key.decode()[len(prefix):]: int(value) for key, value in zip(keys, values) if value}
+
+
+class BandwidthLimiter:
+    """
+    Throttles one job to its share of the global and host-pair bandwidth budgets.
+
+    The budgets live in Redis, so they hold across every worker, and operators can
+    change them at any time; the next quantum a job takes uses the new value. The
+    bandwidth of a budget is split between its active jobs in proportion to their
+    priority weights. Call `consume(n)` for every n bytes moved (from any thread).
+    If Redis is unreachable the job carries on unthrottled.
+    """
+
+    def __init__(self, job_id, pair, weight=1.0, quantum=BANDWIDTH_QUANTUM):
+        self.job_id = str(job_id)
+        self.pair = pair
+        self.weight = weight
+        self.quantum = quantum
+        self.throttled_seconds = 0.0
+        self._allowance = 0
+        self._disabled = False
+        self._lock = threading.Lock()
+        self._keys = [
+            BUDGET_KEY.format(pair), WEIGHTS_KEY.format(pair), SEEN_KEY.format(pair),
+            BUDGET_KEY.format(GLOBAL_BUDGET), WEIGHTS_KEY.format(GLOBAL_BUDGET), SEEN_KEY.format(GLOBAL_BUDGET),
+            BUCKET_KEY.format(self.job_id)
+        ]
+        self._take = None
+
+    def consume(self, nbytes):
+        # The lock is held while sleeping on purpose: the limit is per job, so every
+        # copy thread of the job waits for the same tokens
+        with self._lock:
+            self._allowance -= nbytes
+            while self._allowance < 0 and not self._disabled:
+                wait = self._take_quantum()
+                self._allowance += self.quantum
+                if wait > 0:
+                    self.throttled_seconds += wait
+                    time.sleep(wait)
+
+    def wrap(self, callback=None):
+        """An on_chunk callback that throttles and then calls `callback(n)`"""
+        def on_chunk(nbytes):
+            self.consume(nbytes)
+            if callback:
+                callback(nbytes)
+        return on_chunk
+
+    def _take_quantum(self):
+        try:
+            if self._take is None:
+                self._take = get_redis().register_script(TAKE_SCRIPT)
+            wait = self._take(keys=self._keys, args=[
+                self.job_id, self.weight, self.quantum, BANDWIDTH_STALE_SECONDS, BANDWIDTH_BURST_SECONDS
+            ])
+            return float(wait)
+        except Exception as e:
+            logger.error(f"Bandwidth limiter unavailable, continuing unthrottled: {str(e)}")
+            self._disabled = True
+            return 0.0
+
+
+def job_limiter(transfer_data):
+    """The BandwidthLimiter for a job, from the pair and priority recorded in transfer_data"""
+    # Direct test transfers have no job; they share one bucket per user
+    return BandwidthLimiter(
+        transfer_data.get('job_id') or f"user-{transfer_data.get('user_id')}",
+        transfer_data.get('bandwidth_pair', GLOBAL_BUDGET),
+        float(transfer_data.get('priority') or 1.0)
+    )
@@ -0,0 +1,193 @@
+import hashlib
+import os
+from collections import deque
+from sqlalchemy.orm import Session
+from app.db_setup import engine
+from app.database.models.models import TransferCheckpoint
+from app.logging.logger import logger
+
+# Confirm and persist the destination offset every this many bytes
+CHECKPOINT_INTERVAL_BYTES = int(os.getenv('CHECKPOINT_INTERVAL_BYTES', 256 * 1024 * 1024))
+# Bytes just before the offset that are read back from the destination on resume
+TAIL_WINDOW = 1024 * 1024
+
+EMPTY_DIGEST = hashlib.sha256().hexdigest()
+
+
+def load_checkpoints(job_id):
+    """Return {(dest_path, range_start): checkpoint dict} for every checkpoint of the job"""
+    with Session(engine) as db:
+        rows = db.query(TransferCheckpoint).filter(TransferCheckpoint.job_id == job_id).all()
+        return {
+            (row.dest_path, row.range_start): {
+                'source_path': row.source_path,
+                'file_size': row.file_size,
+                'range_end': row.range_end,
+                'offset': row.offset,
+                'digest': row.digest,
+                'tail_digest': row.tail_digest
+            }
+            for row in rows
+        }
+
+
+def clear_checkpoints(job_id):
+    with Session(engine) as db:
+        db.query(TransferCheckpoint).filter(TransferCheckpoint.job_id == job_id).delete()
+        db.commit()
+
+
+def save_checkpoint(job_id, source_path, dest_path, file_size, range_start, range_end, offset, digest, tail_digest):
+    with Session(engine) as db:
+        checkpoint = db.query(TransferCheckpoint).filter(
+            TransferCheckpoint.job_id == job_id,
+            TransferCheckpoint.dest_path == dest_path,
+            TransferCheckpoint.range_start == range_start
+        ).first()
+        if not checkpoint:
+            checkpoint = TransferCheckpoint(
+                job_id=job_id,
+                source_path=source_path,
+                dest_path=dest_path,
+                range_start=range_start
+            )
+            db.add(checkpoint)
+        checkpoint.file_size = file_size
+        checkpoint.range_end = range_end
+        checkpoint.offset = offset
+        checkpoint.digest = digest
+        checkpoint.tail_digest = tail_digest
+        db.commit()
+
+
+def verify_tail(dest_sftp, dest_path, range_start, offset, tail_digest):
+    """
+    Check that the bytes just before `offset` on the destination are the ones we
+    confirmed. Returns those bytes if they are, None otherwise.
+    """
+    window_start = max(range_start, offset - TAIL_WINDOW)
+    try:
+        with dest_sftp.file(dest_path, 'rb') as dfh:
+            dfh.seek(window_start)
+            tail = dfh.read(offset - window_start)
+    except IOError as e:
+        logger.info(f"Cannot read back {dest_path} for resume: {str(e)}")
+        return None
+    return tail if hashlib.sha256(tail).hexdigest() == tail_digest else None
+
+
+class Checkpointer:
+    """
+    Writes every chunk the copy engine copies for one file or byte range. Every
+    CHECKPOINT_INTERVAL_BYTES it makes sure the destination has acknowledged the data
+    and records the offset together with a rolling hash of everything confirmed so far.
+    A resumed range passes the destination bytes just before its offset as `tail`, so
+    the tail hash of its next checkpoint covers the full window again.
+    """
+
+    def __init__(self, job_id, source_path, dest_path, file_size, range_start, range_end,
+                 offset=None, digest=EMPTY_DIGEST, tail=b'', interval_bytes=CHECKPOINT_INTERVAL_BYTES):
+        self.job_id = job_id
+        self.source_path = source_path
+        self.dest_path = dest_path
+        self.file_size = file_size
+        self.range_start = range_start
+        self.range_end = range_end
+        self.position = range_start if offset is None else offset
+        self.digest = digest
+        self.interval_bytes = interval_bytes
+
+        self._start = (self.position, digest, tail)
+        self._confirmed = self.position
+        self._segment = hashlib.sha256()
+        self._tail = deque([tail]) if tail else deque()
+        self._tail_bytes = len(tail)
+
+    def write(self, dfh, data):
+        """Write a chunk to dfh, confirming and checkpointing whenever the interval is up"""
+        due = self.position + len(data) - self._confirmed >= self.interval_bytes
+        if due:
+            # A non-pipelined write waits for the server's ack of every write queued
+            # before it, and raises if any of them failed
+            dfh.set_pipelined(False)
+        dfh.write(data)
+        if due:
+            dfh.flush()
+            dfh.set_pipelined(True)
+
+        self._segment.update(data)
+        self._tail.append(bytes(data))
+        self._tail_bytes += len(data)
+        # Keep just enough recent chunks to cover TAIL_WINDOW
+        while self._tail_bytes - len(self._tail[0]) >= TAIL_WINDOW:
+            self._tail_bytes -= len(self._tail.popleft())
+        self.position += len(data)
+        if due:
+            self.save()
+
+    def save(self):
+        """Persist the current position; only call once everything written is acknowledged"""
+        if self.position == self._confirmed:
+            return
+        self.digest = hashlib.sha256(bytes.fromhex(self.digest) + self._segment.digest()).hexdigest()
+        tail = b''.join(self._tail)[-TAIL_WINDOW:]
+        tail = tail[-(self.position - self.range_start):]
+        save_checkpoint(
+            self.job_id, self.source_path, self.dest_path, self.file_size,
+            self.range_start, self.range_end, self.position, self.digest,
+            hashlib.sha256(tail).hexdigest()
+        )
+        self._confirmed = self.position
+        self._segment = hashlib.sha256()
+
+    def restart(self):
+        """
+        Rewind to where this checkpointer started, to copy its range once more. The
+        rewind is recorded right away, so a pause during the second copy cannot
+        resume past data that failed verification.
+        """
+        self.position, self.digest, tail = self._start
+        self._segment = hashlib.sha256()
+        self._tail = deque([tail]) if tail else deque()
+        self._tail_bytes = len(tail)
+        save_checkpoint(
+            self.job_id, self.source_path, self.dest_path, self.file_size,
+            self.range_start, self.range_end, self.position, self.digest,
+            hashlib.sha256(tail).hexdigest()
+        )
+        self._confirmed = self.position
+
+
+def resume_items(job_id, dest_sftp, items):
+    """
+    Turn copy-pool work items into items that pick up where a previous attempt stopped.
+
+    Returns (items, checkpointers, bytes_already_done). Every returned item gets a
+    Checkpointer keyed by (dest_path, offset) as run_copy_pool expects. Items whose
+    checkpoint matches and whose destination tail still verifies start at the
+    checkpointed offset, written in place; the rest start from scratch.
+    """
+    checkpoints = load_checkpoints(job_id)
+    resumed_items = []
+    checkpointers = {}
+    bytes_done = 0
+    for source_path, dest_path, file_size, offset, length in items:
+        range_end = file_size if length is None else offset + length
+        checkpoint = checkpoints.get((dest_path, offset))
+        tail = None
+        if checkpoint and checkpoint['file_size'] == file_size and checkpoint['range_end'] == range_end:
+            tail = verify_tail(dest_sftp, dest_path, offset, checkpoint['offset'], checkpoint['tail_digest'])
+        if tail is not None:
+            start = checkpoint['offset']
+            logger.info(f"Resuming {dest_path} range {offset} at offset {start}")
+            bytes_done += start - offset
+            checkpointer = Checkpointer(job_id, source_path, dest_path, file_size, offset, range_end,
+                                        offset=start, digest=checkpoint['digest'], tail=tail)
+            # Written in place from the checkpoint on, so it must be a ranged copy
+            resumed_items.append((source_path, dest_path, file_size, start, range_end - start))
+            checkpointers[(dest_path, start)] = checkpointer
+        else:
+            checkpointer = Checkpointer(job_id, source_path, dest_path, file_size, offset, range_end)
+            resumed_items.append((source_path, dest_path, file_size, offset, length))
+            checkpointers[(dest_path, offset)] = checkpointer
+    return resumed_items, checkpointers, bytes_done
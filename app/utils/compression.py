@@ -0,0 +1,155 @@
+import os
+from app.logging.logger import logger
+from app.utils.update_job_status import update_job_codec, get_job_codec
+
+# Compression programs tar can pipe through. `program` is run by tar (-I) on both
+# hosts, with -d appended when extracting.
+CODECS = {
+    'none': {'extension': '.tar', 'program': None, 'default_level': None, 'max_level': None},
+    'gzip': {'extension': '.tar.gz', 'program': 'gzip', 'default_level': 6, 'max_level': 9},
+    'pigz': {'extension': '.tar.gz', 'program': 'pigz', 'default_level': 6, 'max_level': 9},
+    'zstd': {'extension': '.tar.zst', 'program': 'zstd -T0', 'default_level': 3, 'max_level': 19},
+    'lz4': {'extension': '.tar.lz4', 'program': 'lz4', 'default_level': 1, 'max_level': 12}
+}
+CODEC_CHOICES = list(CODECS) + ['auto']
+
+# What `auto` tries, in order of preference when two come out equal
+AUTO_CANDIDATES = [('none', None), ('lz4', 1), ('zstd', 1), ('zstd', 3), ('pigz', 6), ('gzip', 6)]
+# A later candidate must beat the best so far by this fraction to be chosen, so that
+# incompressible data is not run through a compressor for a rounding-error gain
+AUTO_MIN_GAIN = 0.05
+# Bytes of the source tree `auto` compresses with every candidate
+CODEC_SAMPLE_BYTES = int(os.getenv('CODEC_SAMPLE_BYTES', 32 * 1024 * 1024))
+# Expected throughput of the source -> destination path in bytes/s (default 1 Gbit/s)
+LINK_BANDWIDTH = int(os.getenv('LINK_BANDWIDTH', 125 * 1000 * 1000))
+
+
+def compressor_command(codec, level=None):
+    """Command line of the compressor for codec at level, e.g. 'zstd -T0 -3'"""
+    spec = CODECS[codec]
+    if spec['program'] is None:
+        return None
+    if level is None:
+        level = spec['default_level']
+    return f"{spec['program']} -{level}"
+
+
+def tar_flags(codec, level=None):
+    """tar options selecting the codec, for both -c and -x"""
+    command = compressor_command(codec, level)
+    return f"-I '{command}'" if command else ""
+
+
+def archive_extension(codec):
+    return CODECS[codec]['extension']
+
+
+def codec_label(codec, level=None):
+    """How a codec choice is stored on the Job, e.g. 'zstd:3'"""
+    if CODECS[codec]['program'] is None:
+        return codec
+    return f"{codec}:{CODECS[codec]['default_level'] if level is None else level}"
+
+
+def parse_codec_label(label):
+    codec, _, level = label.partition(':')
+    return codec, int(level) if level else None
+
+
+def validate_codec(codec, level=None):
+    """Return an error message for an unusable codec/level combination, None if fine"""
+    if codec not in CODEC_CHOICES:
+        return f"Codec must be one of {CODEC_CHOICES}"
+    if level is None:
+        return None
+    if codec == 'auto' or CODECS[codec]['max_level'] is None:
+        return f"Codec {codec} does not take a level"
+    if not 1 <= level <= CODECS[codec]['max_level']:
+        return f"Level for {codec} must be between 1 and {CODECS[codec]['max_level']}"
+    return None
+
+
+def available_codecs(ssh):
+    """Names of the codecs whose programs are installed on the remote host"""
+    programs = ' '.join(sorted({spec['program'].split()[0] for spec in CODECS.values() if spec['program']}))
+    stdin, stdout, stderr = ssh.exec_command(f"for p in {programs}; do command -v $p >/dev/null && echo $p; done")
+    installed = set(stdout.read().decode().split())
+    return {name for name, spec in CODECS.items() if spec['program'] is None or spec['program'].split()[0] in installed}
+
+
+def sample_codecs(ssh, source, candidates, sample_bytes=CODEC_SAMPLE_BYTES):
+    """
+    Compress the first sample_bytes of the source tree (as tar would produce it) with
+    every candidate, on the source host. Returns (sample_size, {candidate: (compressed
+    bytes, seconds)}).
+    """
+    compressors = [(candidate, compressor_command(*candidate)) for candidate in candidates
+                   if CODECS[candidate[0]]['program']]
+    script = [
+        'sample=$(mktemp)',
+        f"tar -cf - -C '{source}' . 2>/dev/null | head -c {sample_bytes} > \"$sample\"",
+        'wc -c < "$sample"'
+    ]
+    for _, command in compressors:
+        script.append(f's=$(date +%s%N); n=$({command} -c < "$sample" | wc -c); '
+                      f'e=$(date +%s%N); echo "$n $((e - s))"')
+    script.append('rm -f "$sample"')
+    stdin, stdout, stderr = ssh.exec_command(' ; '.join(script))
+    lines = stdout.read().decode().split('\n')
+
+    sample_size = int(lines[0])
+    results = {}
+    for (candidate, _), line in zip(compressors, lines[1:]):
+        compressed, nanoseconds = line.split()
+        results[candidate] = (int(compressed), int(nanoseconds) / 1e9)
+    return sample_size, results
+
+
+def pick_codec(sample_size, results, link_bandwidth=LINK_BANDWIDTH):
+    """
+    Pick the candidate with the best end-to-end rate in source bytes per second.
+
+    Compression and the transfer run as a pipeline, so a codec moves data at the
+    slower of its compression speed and the link speed scaled by its ratio.
+    """
+    best, best_rate = ('none', None), float(link_bandwidth)
+    for candidate, (compressed, seconds) in results.items():
+        compress_rate = sample_size / seconds if seconds > 0 else float('inf')
+        link_rate = link_bandwidth * sample_size / max(compressed, 1)
+        rate = min(compress_rate, link_rate)
+        logger.info(f"Codec {codec_label(*candidate)}: ratio {sample_size / max(compressed, 1):.2f}, "
+                    f"{compress_rate / 1e6:.1f} MB/s compressing, {rate / 1e6:.1f} MB/s end to end")
+        if rate > best_rate * (1 + AUTO_MIN_GAIN):
+            best, best_rate = candidate, rate
+    return best
+
+
+def resolve_codec(transfer_data, source_ssh, dest_ssh):
+    """
+    Return the (codec, level) to use for this job and record it on the Job.
+
+    `auto` samples the source to choose among the codecs installed on both hosts.
+    A retried job keeps the codec its first attempt chose, so an archive left behind
+    by that attempt can still be resumed.
+    """
+    codec = transfer_data.get('codec') or 'gzip'
+    level = transfer_data.get('codec_level')
+    if codec != 'auto':
+        update_job_codec(transfer_data['job_id'], codec_label(codec, level))
+        return codec, level
+
+    previous = get_job_codec(transfer_data['job_id'])
+    if previous:
+        logger.info(f"Reusing codec {previous} chosen by an earlier attempt")
+        return parse_codec_label(previous)
+
+    installed = available_codecs(source_ssh) & available_codecs(dest_ssh)
+    candidates = [candidate for candidate in AUTO_CANDIDATES if candidate[0] in installed]
+    sample_size, results = sample_codecs(source_ssh, transfer_data['source_storage'], candidates)
+    if sample_size == 0:
+        codec, level = 'none', None
+    else:
+        codec, level = pick_codec(sample_size, results)
+    logger.info(f"Auto-selected codec {codec_label(codec, level)} from a {sample_size} byte sample")
+    update_job_codec(transfer_data['job_id'], codec_label(codec, level))
+    return codec, level
@@ -0,0 +1,322 @@
+import hashlib
+import queue
+import threading
+import time
+import paramiko
+from app.logging.logger import logger
+from app.utils.job_control import TransferStopped
+
+# Adjustable chunk sizes for reading/writing. The tuner climbs this ladder.
+CHUNK_SIZE = {
+    'small': 32768,
+    'medium': 65536,
+    'large': 131072,
+    'xlarge': 262144
+}
+CHUNK_LADDER = sorted(CHUNK_SIZE.values())
+
+# How many chunk buffers each engine cycles between its reader and its writer
+COPY_QUEUE_DEPTH = 32
+
+# paramiko hands back reads of up to one SFTP request as the received bytes object;
+# larger reads are assembled by repeated bytes concatenation, so read this much at a time
+SFTP_BLOCK_SIZE = paramiko.SFTPFile.MAX_REQUEST_SIZE
+
+# Upper bound on outstanding read requests paramiko's prefetch keeps in flight
+PREFETCH_MAX_REQUESTS = 64
+
+# Bytes measured per tuning step, and how much slower a step must be to count as worse
+TUNE_WINDOW_BYTES = 8 * 1024 * 1024
+TUNE_TOLERANCE = 0.05
+
+_EOF = object()
+
+
+class ChunkSizeTuner:
+    """Hill-climbs the chunk size along CHUNK_LADDER using the throughput of each window"""
+
+    def __init__(self, sizes=CHUNK_LADDER, window_bytes=TUNE_WINDOW_BYTES):
+        self.sizes = sizes
+        self.window_bytes = window_bytes
+        self.index = 0
+        self.direction = 1
+        self._last_rate = None
+        self._window_start = time.monotonic()
+        self._window_done = 0
+
+    @property
+    def chunk_size(self):
+        return self.sizes[self.index]
+
+    def record(self, nbytes):
+        self._window_done += nbytes
+        if self._window_done < self.window_bytes:
+            return
+
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        rate = self._window_done / elapsed if elapsed > 0 else float('inf')
+        # The last step made things worse: turn around
+        if self._last_rate is not None and rate < self._last_rate * (1 - TUNE_TOLERANCE):
+            self.direction = -self.direction
+        self._last_rate = rate
+
+        next_index = self.index + self.direction
+        if 0 <= next_index < len(self.sizes):
+            self.index = next_index
+        else:
+            self.direction = -self.direction
+        self._window_start = now
+        self._window_done = 0
+
+
+def read_into(sfh, view):
+    """
+    Fill the memoryview `view` from sfh in SFTP_BLOCK_SIZE reads; returns the bytes read.
+    Each block is copied once, into the buffer, and never concatenated.
+    """
+    filled = 0
+    size = len(view)
+    while filled < size:
+        block = sfh.read(min(SFTP_BLOCK_SIZE, size - filled))
+        if not block:
+            break
+        view[filled:filled + len(block)] = block
+        filled += len(block)
+    return filled
+
+
+class CopyEngine:
+    """
+    Copies one remote file to another between two SFTP sessions.
+
+    Reads are prefetched and writes pipelined, so neither side waits a round trip per
+    chunk. A reader thread fills chunk buffers that the writer (the calling thread)
+    drains, which overlaps the two network legs. The buffers are a fixed ring
+    allocated once per engine: slots go round from a free queue to the reader, to the
+    writer and back, so no chunk is ever allocated. The chunk size is tuned from the
+    measured throughput and the tuning carries over between files copied by the same
+    engine.
+    """
+
+    def __init__(self, on_chunk=None, queue_depth=COPY_QUEUE_DEPTH):
+        self.on_chunk = on_chunk
+        self.queue_depth = queue_depth
+        self.tuner = ChunkSizeTuner()
+        self._buffers = None
+        self._small_buffer = None
+        self._lengths = [0] * queue_depth
+
+    @property
+    def buffers(self):
+        # Allocated on first use, at the largest chunk size the tuner can pick
+        if self._buffers is None:
+            self._buffers = [memoryview(bytearray(self.tuner.sizes[-1])) for _ in range(self.queue_depth)]
+        return self._buffers
+
+    def copy(self, source_sftp, dest_sftp, source_path, dest_path, file_size=None, offset=0, length=None,
+             checkpointer=None, digests=None):
+        """
+        Copy source_path to dest_path and return the number of bytes copied.
+
+        With `length` set only the byte range [offset, offset + length) is copied, and it
+        is written at the same offset of an existing destination file (see
+        range_transfer.preallocate), so several ranges can be copied at once.
+        With a `checkpointer` (see checkpoint.Checkpointer) every chunk is written through it.
+        With a `digests` dict, the data is hashed as it is written and
+        digests[(dest_path, offset)] is set to (bytes copied, sha256, ranged).
+        Chunks are passed to the checkpointer and on_chunk as memoryviews of reused
+        buffers; anything kept past the call has to be copied.
+        """
+        if file_size is None:
+            file_size = source_sftp.stat(source_path).st_size
+        ranged = length is not None
+        # Not worth a reader thread for something that fits in one chunk
+        if not ranged and file_size <= self.tuner.chunk_size:
+            return self._copy_small(source_sftp, dest_sftp, source_path, dest_path, digests)
+
+        buffers = self.buffers
+        free = queue.SimpleQueue()
+        filled = queue.SimpleQueue()
+        for slot in range(self.queue_depth):
+            free.put(slot)
+        stop = threading.Event()
+        reader = threading.Thread(
+            target=self._read,
+            args=(source_sftp, source_path, file_size, offset, length, free, filled, stop),
+            name=f"sftp-reader:{source_path}@{offset}",
+            daemon=True
+        )
+        reader.start()
+
+        bytes_copied = 0
+        digest = hashlib.sha256() if digests is not None else None
+        try:
+            with dest_sftp.file(dest_path, 'r+b' if ranged else 'wb') as dfh:
+                if offset:
+                    dfh.seek(offset)
+                dfh.set_pipelined(True)
+                while True:
+                    slot = filled.get()
+                    if slot is _EOF:
+                        break
+                    if isinstance(slot, Exception):
+                        raise slot
+                    size = self._lengths[slot]
+                    data = buffers[slot][:size]
+                    # paramiko has serialised the data into its packet by the time write returns
+                    if checkpointer:
+                        checkpointer.write(dfh, data)
+                    else:
+                        dfh.write(data)
+                    if digest:
+                        digest.update(data)
+                    free.put(slot)
+                    bytes_copied += size
+                    self.tuner.record(size)
+                    if self.on_chunk:
+                        self.on_chunk(size)
+        except TransferStopped:
+            # The file closed cleanly on the way out, so a paused job resumes from right here
+            if checkpointer:
+                checkpointer.save()
+            raise
+        finally:
+            stop.set()
+            reader.join()
+
+        # The file closed cleanly, so everything written has been acknowledged
+        if checkpointer:
+            checkpointer.save()
+
+        if ranged and bytes_copied != length:
+            raise Exception(f"Short copy of {source_path}@{offset}: {bytes_copied} of {length} bytes")
+        if digest:
+            digests[(dest_path, offset)] = (bytes_copied, digest.hexdigest(), ranged)
+        logger.info(f"Copied {source_path} -> {dest_path} @{offset}: {bytes_copied} bytes "
+                    f"(chunk size {self.tuner.chunk_size})")
+        return bytes_copied
+
+    def _copy_small(self, source_sftp, dest_sftp, source_path, dest_path, digests=None):
+        # One buffer, read and written in turn; loops in case the file grew since it was listed
+        if self._small_buffer is None:
+            self._small_buffer = memoryview(bytearray(self.tuner.sizes[-1]))
+        view = self._small_buffer
+        bytes_copied = 0
+        digest = hashlib.sha256() if digests is not None else None
+        with source_sftp.file(source_path, 'rb') as sfh, dest_sftp.file(dest_path, 'wb') as dfh:
+            while True:
+                size = read_into(sfh, view)
+                if not size:
+                    break
+                dfh.write(view[:size])
+                if digest:
+                    digest.update(view[:size])
+                bytes_copied += size
+        if digest:
+            digests[(dest_path, 0)] = (bytes_copied, digest.hexdigest(), False)
+        if self.on_chunk and bytes_copied:
+            self.on_chunk(bytes_copied)
+        return bytes_copied
+
+    def _read(self, source_sftp, source_path, file_size, offset, length, free, filled, stop):
+        try:
+            with source_sftp.file(source_path, 'rb') as sfh:
+                if offset:
+                    sfh.seek(offset)
+                # prefetch() queues reads from the current position up to the given end.
+                # Whole files are read to EOF; ranges stop exactly at their end.
+                end = file_size if length is None else offset + length
+                sfh.prefetch(end, max_concurrent_requests=PREFETCH_MAX_REQUESTS)
+                buffers = self.buffers
+                remaining = length
+                while not stop.is_set():
+                    size = self.tuner.chunk_size if remaining is None else min(self.tuner.chunk_size, remaining)
+                    if size == 0:
+                        break
+                    slot = self._take(free, stop)
+                    if slot is None:
+                        return
+                    size = read_into(sfh, buffers[slot][:size])
+                    if not size:
+                        break
+                    if remaining is not None:
+                        remaining -= size
+                    self._lengths[slot] = size
+                    filled.put(slot)
+        except Exception as e:
+            logger.error(f"Error reading {source_path}: {str(e)}")
+            filled.put(e)
+            return
+        filled.put(_EOF)
+
+    @staticmethod
+    def _take(free, stop):
+        # Bounded wait so a failed writer never leaves the reader blocked forever
+        while not stop.is_set():
+            try:
+                return free.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return None
+
+
+def open_sftp_pool(ssh, size):
+    """Open `size` SFTP sessions multiplexed over the client's existing transport"""
+    transport = ssh.get_transport()
+    return [paramiko.SFTPClient.from_transport(transport) for _ in range(size)]
+
+
+def run_copy_pool(source_ssh, dest_ssh, items, pool_size, on_chunk=None, checkpointers=None, digests=None):
+    """
+    Copy `items` concurrently over `pool_size` SFTP sessions on each host.
+
+    Each item is (source_path, dest_path, file_size, offset, length); length is None
+    for a whole file. Items are handed out largest first so the big ones start early
+    and the small ones fill in the gaps at the end. `on_chunk(n)` is called from the
+    worker threads and must be thread-safe. `checkpointers` optionally maps
+    (dest_path, offset) to the Checkpointer for that item, and `digests` collects the
+    inline sha256 of every item (see CopyEngine.copy).
+    """
+    work = queue.Queue()
+    for item in sorted(items, key=lambda i: i[4] if i[4] is not None else i[2], reverse=True):
+        work.put(item)
+
+    pool_size = max(1, min(pool_size, len(items)))
+    source_pool = open_sftp_pool(source_ssh, pool_size)
+    dest_pool = open_sftp_pool(dest_ssh, pool_size)
+
+    errors = []
+    failed = threading.Event()
+
+    def worker(source_sftp, dest_sftp):
+        copier = CopyEngine(on_chunk=on_chunk)
+        while not failed.is_set():
+            try:
+                source_path, dest_path, file_size, offset, length = work.get_nowait()
+            except queue.Empty:
+                return
+            checkpointer = checkpointers.get((dest_path, offset)) if checkpointers else None
+            try:
+                copier.copy(source_sftp, dest_sftp, source_path, dest_path, file_size, offset, length,
+                            checkpointer, digests)
+            except Exception as e:
+                logger.error(f"Error transferring {source_path}: {str(e)}")
+                errors.append(e)
+                failed.set()
+
+    threads = [
+        threading.Thread(target=worker, args=(source_pool[i], dest_pool[i]), name=f"sftp-worker-{i}")
+        for i in range(pool_size)
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for sftp in source_pool + dest_pool:
+            sftp.close()
+
+    if errors:
+        raise errors[0]
@@ -0,0 +1,251 @@
+import heapq
+import os
+from fastapi import HTTPException
+from celery import shared_task, chord
+from celery.exceptions import Ignore
+from app.database.models.models import JobStatus
+from app.logging.logger import logger
+from app.redis_client import get_redis
+from app.utils.update_job_status import update_job_status
+from app.utils.progress_reporter import ProgressReporter
+from app.utils.multi_file_transfer import verify_tree_copy
+from app.utils.compression import resolve_codec
+from app.utils.shard_transfer import get_or_plan, load_plan, send_shards
+from app.utils.ssh_pool import connect_servers, release_servers
+from app.utils.bandwidth import pair_name
+from app.utils.job_slots import job_slots, limit_concurrency, task_lease
+from app.utils.manifest_cache import invalidate_manifests
+from app.utils.linux_paramiko_transfer import TRANSFER_MAX_RETRIES, TRANSFER_RETRY_DELAY
+from app.utils.job_control import TransferStopped, StopCheck, clean_up_stopped, record_stopped
+from app.utils.job_events import send_job_event, PROGRESS_EVENT
+
+# Most subtasks one job is split into; the shards are spread over them by size
+FAN_OUT_SUBTASKS = int(os.getenv('FAN_OUT_SUBTASKS', 8))
+
+# Per-job hash where the subtasks leave their progress: total, and per subtask
+# "<n>:bytes" and "<n>:rate"
+PROGRESS_KEY = 'job_progress:{}'
+PROGRESS_TTL = 86400
+
+
+def split_shards(shards, count):
+    """Spread shards over at most `count` batches of about equal bytes; returns lists of shard indices"""
+    count = max(1, min(count, len(shards)))
+    batches = [[] for _ in range(count)]
+    lightest = [(0, i) for i in range(count)]
+    for shard in sorted(shards, key=lambda shard: shard['total_bytes'], reverse=True):
+        load, i = heapq.heappop(lightest)
+        batches[i].append(shard['shard_index'])
+        heapq.heappush(lightest, (load + shard['total_bytes'], i))
+    return [batch for batch in batches if batch]
+
+
+class SubtaskProgress(ProgressReporter):
+    """
+    ProgressReporter for one subtask of a fanned-out job.
+
+    Every publish stores the subtask's bytes and rate in the job's progress hash and
+    puts the sum over all subtasks on the parent task, which is the task id the job
+    record points at. Progress stays visible where it always was, as one percentage
+    and one rate for the whole job.
+    """
+
+    def __init__(self, task, transfer_data, total_bytes, subtask_index):
+        super().__init__(task, transfer_data, total_bytes)
+        self.parent_task_id = transfer_data['parent_task_id']
+        self.subtask_index = subtask_index
+        self.key = PROGRESS_KEY.format(self.job_id)
+
+    def _send(self):
+        try:
+            redis = get_redis()
+            redis.hset(self.key, mapping={
+                f"{self.subtask_index}:bytes": self.bytes_done,
+                f"{self.subtask_index}:rate": int(self.rate)
+            })
+            fields = {key.decode(): int(value) for key, value in redis.hgetall(self.key).items()}
+        except Exception as e:
+            logger.error(f"Could not aggregate progress of job {self.job_id}: {str(e)}")
+            return
+        current = sum(value for key, value in fields.items() if key.endswith(':bytes'))
+        rate = sum(value for key, value in fields.items() if key.endswith(':rate'))
+        total = fields.get('total', 0)
+        meta = {
+            'job_id': self.job_id,
+            'task_id': self.parent_task_id,
+            'user_id': self.user_id,
+            'current': current,
+            'total': total,
+            'status': JobStatus.IN_PROGRESS,
+            'percent': min(int(current / total * 100), 100) if total else 0,
+            'rate': rate,
+            'eta': int(max(total - current, 0) / rate) if rate > 0 else None
+        }
+        self.task.update_state(task_id=self.parent_task_id, state=JobStatus.IN_PROGRESS, meta=meta)
+        send_job_event(PROGRESS_EVENT, uuid=self.parent_task_id, **meta)
+
+
+# Plans the job, then hands the shards to a chord of transfer.shard_batch subtasks that
+# any worker can pick up; transfer.fan_out_finalize marks the job when they are all done.
+@shared_task(name="transfer.fan_out", bind=True, acks_late=True, reject_on_worker_lost=True,
+             max_retries=TRANSFER_MAX_RETRIES)
+@limit_concurrency
+def fan_out_transfer(self, transfer_data, server_configs, identity_file):
+    """Sharded transfer spread over several workers: one subtask per batch of shards"""
+    try:
+        # Paused or cancelled while still queued
+        StopCheck(transfer_data['job_id'])()
+        update_job_status(transfer_data['job_id'], JobStatus.IN_PROGRESS)
+        logger.info(f"Planning fan-out transfer with data: {transfer_data}")
+
+        if not transfer_data.get('source_storage'):
+            raise HTTPException(status_code=400, detail="Source storage is required")
+        if not transfer_data.get('dest_storage'):
+            raise HTTPException(status_code=400, detail="Destination storage is required")
+
+        source_ssh, dest_ssh = connect_servers(server_configs, identity_file)
+        try:
+            plan = get_or_plan(transfer_data['job_id'], source_ssh, transfer_data['source_storage'])
+            # Settle the codec once, so every subtask uses the same one
+            resolve_codec(transfer_data, source_ssh, dest_ssh)
+        except Exception:
+            release_servers(source_ssh, dest_ssh, discard=True)
+            raise
+        release_servers(source_ssh, dest_ssh)
+
+        pending = [shard for shard in plan if not shard['completed']]
+        batches = split_shards(pending, FAN_OUT_SUBTASKS)
+        total_bytes = sum(shard['total_bytes'] for shard in pending)
+
+        subtask_data = dict(transfer_data, parent_task_id=self.request.id)
+        redis = get_redis()
+        redis.delete(PROGRESS_KEY.format(transfer_data['job_id']))
+        redis.hset(PROGRESS_KEY.format(transfer_data['job_id']), 'total', total_bytes)
+        redis.expire(PROGRESS_KEY.format(transfer_data['job_id']), PROGRESS_TTL)
+
+        header = [
+            shard_batch_transfer.s(subtask_data, server_configs, identity_file, index, batch)
+            for index, batch in enumerate(batches)
+        ]
+        chord(header)(fan_out_finalize.s(subtask_data, server_configs, identity_file))
+        logger.info(f"Fanned out {len(pending)} shards ({total_bytes} bytes) over {len(batches)} subtasks")
+
+        return {
+            "status": "fanned_out",
+            "message": f"Transfer split into {len(batches)} subtasks",
+            "source": transfer_data['source_storage'],
+            "destination": transfer_data['dest_storage'],
+            "subtasks": len(batches),
+            "shards": len(pending)
+        }
+
+    except TransferStopped as stop:
+        return record_stopped(self, stop, self.name, [transfer_data, server_configs, identity_file])
+    except HTTPException:
+        update_job_status(transfer_data['job_id'], JobStatus.FAILED)
+        raise
+    except Exception as e:
+        logger.error(f"Fan-out planning failed with error: {e}")
+        if self.request.retries < self.max_retries:
+            logger.info(f"Retrying fan-out in {TRANSFER_RETRY_DELAY}s (attempt {self.request.retries + 1})")
+            update_job_status(transfer_data['job_id'], JobStatus.PENDING)
+            raise self.retry(exc=e, countdown=TRANSFER_RETRY_DELAY)
+        update_job_status(transfer_data['job_id'], JobStatus.FAILED)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@shared_task(name="transfer.shard_batch", bind=True, acks_late=True, reject_on_worker_lost=True,
+             max_retries=TRANSFER_MAX_RETRIES)
+def shard_batch_transfer(self, transfer_data, server_configs, identity_file, subtask_index, shard_indices):
+    """
+    Send one batch of a fanned-out job's shards. Retries resume from the shards
+    already marked completed. Once out of retries it reports the failure as its
+    result instead of raising, so the finalizer still runs and can fail the job.
+    A pause or cancel is reported the same way, without retrying.
+    """
+    try:
+        StopCheck(transfer_data['job_id'])()
+        with task_lease(self.request.id), \
+                job_slots.slot([server_configs['pisms']['host'], server_configs['pimaster']['host']]):
+            return _send_batch(self, transfer_data, server_configs, identity_file, subtask_index, shard_indices)
+    except Ignore:
+        # A redelivery of a batch that is still running elsewhere
+        raise
+    except TransferStopped as stop:
+        logger.info(f"Subtask {subtask_index} of job {transfer_data['job_id']} stopped: {stop.action}")
+        return {"subtask": subtask_index, "status": "stopped", "action": stop.action}
+    except Exception as e:
+        logger.error(f"Subtask {subtask_index} of job {transfer_data['job_id']} failed with error: {e}")
+        if self.request.retries < self.max_retries:
+            logger.info(f"Retrying subtask in {TRANSFER_RETRY_DELAY}s (attempt {self.request.retries + 1})")
+            raise self.retry(exc=e, countdown=TRANSFER_RETRY_DELAY)
+        return {"subtask": subtask_index, "status": "failed", "error": str(e)}
+
+
+def _send_batch(task, transfer_data, server_configs, identity_file, subtask_index, shard_indices):
+    transfer_data['bandwidth_pair'] = pair_name(server_configs['pisms']['host'], server_configs['pimaster']['host'])
+    wanted = set(shard_indices)
+    shards = [shard for shard in load_plan(transfer_data['job_id']) if shard['shard_index'] in wanted]
+    pending = [shard for shard in shards if not shard['completed']]
+
+    # Count what an earlier attempt of this subtask already sent, so job progress
+    # does not go backwards on a retry
+    progress = SubtaskProgress(task, transfer_data, sum(shard['total_bytes'] for shard in shards), subtask_index)
+    progress.add(sum(shard['total_bytes'] for shard in shards if shard['completed']))
+
+    source_ssh, dest_ssh = connect_servers(server_configs, identity_file)
+    try:
+        send_shards(transfer_data, source_ssh, dest_ssh, pending, progress)
+    except Exception as e:
+        if isinstance(e, TransferStopped):
+            clean_up_stopped(e, source_ssh, dest_ssh, transfer_data)
+        invalidate_manifests(dest_ssh, transfer_data['dest_storage'])
+        release_servers(source_ssh, dest_ssh, discard=True)
+        raise
+    invalidate_manifests(dest_ssh, transfer_data['dest_storage'])
+    release_servers(source_ssh, dest_ssh)
+    progress.flush()
+    logger.info(f"Subtask {subtask_index} sent {len(pending)} shards")
+    return {"subtask": subtask_index, "status": "completed", "shards": len(pending)}
+
+
+@shared_task(name="transfer.fan_out_finalize", bind=True)
+def fan_out_finalize(self, results, transfer_data, server_configs, identity_file):
+    """Chord callback: mark the job COMPLETED, FAILED, PAUSED or CANCELLED from the subtask results"""
+    job_id = transfer_data['job_id']
+    stopped = [result['action'] for result in results if result.get('status') == 'stopped']
+    if stopped:
+        # A resumed job is fanned out again over the shards still outstanding
+        stop = TransferStopped(job_id, 'cancel' if 'cancel' in stopped else 'pause')
+        job_data = {key: value for key, value in transfer_data.items() if key != 'parent_task_id'}
+        self.update_state(task_id=transfer_data['parent_task_id'], state=stop.status,
+                          meta={'job_id': job_id, 'status': stop.status})
+        return record_stopped(self, stop, 'transfer.fan_out', [job_data, server_configs, identity_file])
+    failed = [result for result in results if result.get('status') != 'completed']
+    outstanding = [shard for shard in load_plan(job_id, with_paths=False) if not shard['completed']]
+    try:
+        if failed or outstanding:
+            errors = '; '.join(f"subtask {result['subtask']}: {result.get('error')}" for result in failed)
+            raise Exception(f"{len(outstanding)} shards not transferred. {errors}")
+
+        if transfer_data.get('verify_manifest'):
+            source_ssh, dest_ssh = connect_servers(server_configs, identity_file)
+            try:
+                verify_tree_copy(source_ssh, dest_ssh, transfer_data['source_storage'],
+                                 transfer_data['dest_storage'], job_id)
+            except Exception:
+                release_servers(source_ssh, dest_ssh, discard=True)
+                raise
+            release_servers(source_ssh, dest_ssh)
+    except Exception as e:
+        logger.error(f"Fan-out transfer of job {job_id} failed: {e}")
+        update_job_status(job_id, JobStatus.FAILED)
+        self.update_state(task_id=transfer_data['parent_task_id'], state=JobStatus.FAILED,
+                          meta={'job_id': job_id, 'status': JobStatus.FAILED, 'error': str(e)})
+        raise
+
+    update_job_status(job_id, JobStatus.COMPLETED)
+    self.update_state(task_id=transfer_data['parent_task_id'], state=JobStatus.COMPLETED,
+                      meta={'job_id': job_id, 'status': JobStatus.COMPLETED, 'percent': 100})
+    logger.info(f"Fan-out transfer of job {job_id} completed with {len(results)} subtasks")
+    return {"status": "completed", "job_id": job_id, "subtasks": len(results)}
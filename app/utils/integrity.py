@@ -0,0 +1,199 @@
+import hashlib
+import os
+import queue
+import threading
+from app.logging.logger import logger
+from app.utils.copy_engine import run_copy_pool
+
+# Checksum commands run at once on a host when verifying
+VERIFY_STREAMS = int(os.getenv('VERIFY_STREAMS', 4))
+# Paths hashed per sha256sum exec; small enough that the output of one batch always
+# fits in the channel window
+HASH_BATCH = 1000
+
+SHA256SUM_ESCAPES = {'n': '\n', 'r': '\r', '\\': '\\'}
+
+
+def parse_sha256sum_line(line):
+    """Split a sha256sum output line into (path, digest), undoing its escaping of odd names"""
+    escaped = line.startswith('\\')
+    if escaped:
+        line = line[1:]
+    digest, path = line.split('  ', 1)
+    if escaped:
+        chars = []
+        i = 0
+        while i < len(path):
+            if path[i] == '\\' and i + 1 < len(path):
+                chars.append(SHA256SUM_ESCAPES.get(path[i + 1], path[i + 1]))
+                i += 2
+            else:
+                chars.append(path[i])
+                i += 1
+        path = ''.join(chars)
+    return path, digest
+
+
+def run_parallel(func, work, streams):
+    """Call func(item) for every item over `streams` threads; return the results in any order"""
+    todo = queue.Queue()
+    for item in work:
+        todo.put(item)
+    results = []
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                item = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results.append(func(item))
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker, name=f"verify-{i}") for i in range(max(1, min(streams, len(work))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def _hash_batch(ssh, root, paths):
+    channel = ssh.get_transport().open_session()
+    try:
+        channel.exec_command(f"cd '{root}' && xargs -0 sha256sum --")
+        channel.sendall(memoryview('\0'.join(paths).encode()))
+        channel.shutdown_write()
+        output = channel.makefile('rb').read().decode()
+        channel.recv_exit_status()
+    finally:
+        channel.close()
+    return dict(parse_sha256sum_line(line) for line in output.split('\n') if line)
+
+
+def remote_hashes(ssh, root, paths, streams=VERIFY_STREAMS):
+    """Return {path: sha256} for `paths` (relative to root, or absolute), hashed on the remote host"""
+    batches = [paths[start:start + HASH_BATCH] for start in range(0, len(paths), HASH_BATCH)]
+    hashes = {}
+    for batch_hashes in run_parallel(lambda batch: _hash_batch(ssh, root, batch), batches, streams):
+        hashes.update(batch_hashes)
+    return hashes
+
+
+def remote_range_hash(ssh, path, offset, length):
+    """sha256 of bytes [offset, offset + length) of a remote file (tail -c seeks, it does not read up to offset)"""
+    stdin, stdout, stderr = ssh.exec_command(f"tail -c +{offset + 1} '{path}' | head -c {length} | sha256sum")
+    output = stdout.read().decode()
+    return output.split()[0] if output else None
+
+
+def verify_copies(dest_ssh, digests, streams=VERIFY_STREAMS):
+    """
+    Hash every copied file and byte range again on the destination and return the
+    (dest_path, offset) keys whose hash differs from the one taken while copying.
+    Whole files are hashed in batches and ranges one exec each, `streams` at a time.
+    """
+    whole = [dest_path for (dest_path, offset), (_, _, ranged) in digests.items() if not ranged]
+    ranges = [(dest_path, offset, length) for (dest_path, offset), (length, _, ranged) in digests.items() if ranged]
+
+    remote = {(path, 0): digest for path, digest in remote_hashes(dest_ssh, '.', whole, streams).items()}
+    for key, digest in run_parallel(lambda r: ((r[0], r[1]), remote_range_hash(dest_ssh, *r)), ranges, streams):
+        remote[key] = digest
+    return [key for key, (_, digest, _) in digests.items() if remote.get(key) != digest]
+
+
+def combined_digest(digests):
+    """One sha256 over the per-item digests, as stored on the Job"""
+    combined = hashlib.sha256()
+    for (dest_path, offset), (length, digest, _) in sorted(digests.items()):
+        combined.update(f"{dest_path}\t{offset}\t{length}\t{digest}\n".encode())
+    return f"sha256:{combined.hexdigest()}"
+
+
+def verified_copy_pool(source_ssh, dest_ssh, items, pool_size, on_chunk=None, checkpointers=None):
+    """
+    run_copy_pool, hashing everything inline, then check every item on the destination.
+
+    Items whose destination hash does not match are copied once more on their own,
+    through the same on_chunk and rewound checkpointers; if they still do not match
+    the copy fails. Returns the digests (see CopyEngine.copy) of everything copied.
+    """
+    digests = {}
+    run_copy_pool(source_ssh, dest_ssh, items, pool_size, on_chunk, checkpointers, digests)
+    mismatched = set(verify_copies(dest_ssh, digests))
+    if mismatched:
+        logger.error(f"Checksum mismatch on {len(mismatched)} of {len(digests)} copied items; copying them again")
+        retry_items = [item for item in items if (item[1], item[3]) in mismatched]
+        if checkpointers:
+            for source_path, dest_path, file_size, offset, length in retry_items:
+                checkpointer = checkpointers.get((dest_path, offset))
+                if checkpointer:
+                    checkpointer.restart()
+        retry_digests = {}
+        run_copy_pool(source_ssh, dest_ssh, retry_items, pool_size, on_chunk, checkpointers, retry_digests)
+        still_mismatched = verify_copies(dest_ssh, retry_digests)
+        if still_mismatched:
+            names = ', '.join(f"{path}@{offset}" for path, offset in still_mismatched[:10])
+            logger.error(f"Checksum still mismatched after copying again: {names}")
+            raise Exception(f"Checksum mismatch on {len(still_mismatched)} items: {names}")
+        digests.update(retry_digests)
+    logger.info(f"Verified {len(digests)} copied items on the destination")
+    return digests
+
+
+def _start_tree_hashes(ssh, root, streams):
+    # Hash with several sha256sum processes; line-buffered output keeps their lines
+    # whole, and the final sort puts them back in path order for the merge
+    command = (f"cd '{root}' && find . -type f -print0 | xargs -0 -r -n {HASH_BATCH} -P {streams} "
+               f"stdbuf -oL sha256sum -- | LC_ALL=C sort -k 2")
+    logger.info(f"Hashing tree with command: {command}")
+    channel = ssh.get_transport().open_session()
+    channel.exec_command(command)
+    return channel
+
+
+def _iter_tree_hashes(channel):
+    try:
+        for line in channel.makefile('rb'):
+            line = line.decode().rstrip('\n')
+            if line:
+                # Keep the escaped form: both sides escape alike and sort on it
+                escaped = line.startswith('\\')
+                digest, path = (line[1:] if escaped else line).split('  ', 1)
+                yield path, digest, escaped
+    finally:
+        channel.close()
+
+
+def verify_tree(source_ssh, dest_ssh, source_root, dest_root, streams=VERIFY_STREAMS):
+    """
+    Compare the sha256 of every file under source_root with its copy under dest_root.
+
+    Both hosts hash their tree at the same time and the sorted outputs are merged as
+    they stream in. Returns (manifest digest, [relative paths that differ or are
+    missing on the destination]); extra destination files are ignored.
+    """
+    source_channel = _start_tree_hashes(source_ssh, source_root, streams)
+    dest_channel = _start_tree_hashes(dest_ssh, dest_root, streams)
+    source_lines = _iter_tree_hashes(source_channel)
+    dest_lines = _iter_tree_hashes(dest_channel)
+
+    manifest = hashlib.sha256()
+    differing = []
+    dest = next(dest_lines, None)
+    for path, digest, escaped in source_lines:
+        manifest.update(f"{digest}  {path}\n".encode())
+        while dest is not None and dest[0] < path:
+            dest = next(dest_lines, None)
+        if dest is None or dest[0] != path or dest[1] != digest:
+            real_path = parse_sha256sum_line(f"\\{digest}  {path}")[0] if escaped else path
+            differing.append(real_path[2:] if real_path.startswith('./') else real_path)
+    # Drain so the destination command can finish
+    for _ in dest_lines:
+        pass
+    return f"manifest-sha256:{manifest.hexdigest()}", differing
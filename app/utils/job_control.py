@@ -0,0 +1,194 @@
+import json
+import os
+import time
+from app.database.models.models import JobStatus
+from app.logging.logger import logger
+from app.redis_client import get_redis
+from app.utils.checkpoint import clear_checkpoints
+from app.utils.ssh_pool import connect_servers, release_servers
+from app.utils.update_job_status import update_job_status
+
+CONTROL_KEY = 'job_control:{}'      # job id -> 'pause' or 'cancel'
+RESUME_KEY = 'job_resume:{}'        # job id -> JSON task name and args of a paused job
+CONTROL_TTL = 7 * 86400
+CONTROL_ACTIONS = ('pause', 'cancel')
+
+# Most seconds between two reads of a job's control flag by its copy loop
+CONTROL_CHECK_INTERVAL = float(os.getenv('CONTROL_CHECK_INTERVAL', 0.5))
+# How often a remote command that reports no progress is polled for a stop
+CONTROL_POLL_SECONDS = 0.2
+
+
+class TransferStopped(Exception):
+    """Raised inside a transfer once its job has been paused or cancelled"""
+
+    def __init__(self, job_id, action):
+        super().__init__(f"Job {job_id} {'paused' if action == 'pause' else 'cancelled'}")
+        self.job_id = job_id
+        self.action = action
+
+    @property
+    def status(self):
+        return JobStatus.PAUSED if self.action == 'pause' else JobStatus.CANCELLED
+
+
+def request_stop(job_id, action):
+    """Ask the running (or queued) transfer of a job to pause or cancel"""
+    get_redis().set(CONTROL_KEY.format(job_id), action, ex=CONTROL_TTL)
+
+
+def clear_stop(job_id):
+    get_redis().delete(CONTROL_KEY.format(job_id))
+
+
+def stop_requested(job_id):
+    """'pause', 'cancel' or None. None as well when Redis is unreachable, so jobs carry on."""
+    try:
+        action = get_redis().get(CONTROL_KEY.format(job_id))
+    except Exception as e:
+        logger.error(f"Could not read control flag of job {job_id}: {str(e)}")
+        return None
+    return action.decode() if action else None
+
+
+class StopCheck:
+    """
+    Callable that raises TransferStopped when the job has been paused or cancelled.
+    Cheap enough to call for every chunk: Redis is read at most every `interval` seconds.
+    """
+
+    def __init__(self, job_id, interval=CONTROL_CHECK_INTERVAL):
+        self.job_id = job_id
+        self.interval = interval
+        self._next_read = 0.0
+
+    def __call__(self):
+        now = time.monotonic()
+        if now < self._next_read:
+            return
+        self._next_read = now + self.interval
+        action = stop_requested(self.job_id)
+        if action in CONTROL_ACTIONS:
+            raise TransferStopped(self.job_id, action)
+
+
+def tracked(command, job_id):
+    """
+    Tag a remote command with its job, so kill_remote can find it. The trailing exit
+    keeps the shell from exec'ing the last command, so the tagged shell stays the
+    parent of everything the command starts.
+    """
+    return f": transfer-job-{job_id}; {command}; exit $?"
+
+
+def kill_remote(ssh, job_id):
+    """Kill every tracked command of the job on this host, and what they started"""
+    # [t] keeps pgrep from matching this very command line
+    kill_command = (f"for pid in $(pgrep -f '[t]ransfer-job-{job_id};'); do "
+                    f"pkill -TERM -P $pid; kill -TERM $pid; done 2>/dev/null; true")
+    try:
+        stdin, stdout, stderr = ssh.exec_command(kill_command)
+        stdout.channel.recv_exit_status()
+    except Exception as e:
+        logger.error(f"Could not stop remote commands of job {job_id}: {str(e)}")
+
+
+def remove_partial_archives(source_ssh, dest_ssh, transfer_data):
+    """Delete the archives archive mode noted in transfer_data['archives'] on either host"""
+    archives = transfer_data.get('archives')
+    if not archives:
+        return
+    for ssh, path in ((source_ssh, archives['source']), (dest_ssh, archives['dest'])):
+        rm_command = f"rm -f '{path}'"
+        logger.info(f"Removing partial archive: {rm_command}")
+        try:
+            stdin, stdout, stderr = ssh.exec_command(rm_command)
+            stdout.channel.recv_exit_status()
+        except Exception as e:
+            logger.error(f"Could not remove partial archive of job {transfer_data['job_id']}: {str(e)}")
+
+
+def clean_up_stopped(stop, source_ssh, dest_ssh, transfer_data):
+    """
+    Kill what the job still runs on both hosts. A cancelled job also loses its
+    archives and checkpoints; a paused one keeps them to resume from.
+    """
+    kill_remote(source_ssh, stop.job_id)
+    kill_remote(dest_ssh, stop.job_id)
+    if stop.action == 'cancel':
+        remove_partial_archives(source_ssh, dest_ssh, transfer_data)
+        clear_checkpoints(stop.job_id)
+
+
+def record_stopped(task, stop, task_name, args):
+    """
+    Set the job's status after a stop. A paused job keeps the task name and args
+    that resume_job sends again; the control flag is cleared either way.
+    """
+    if stop.action == 'pause':
+        get_redis().set(RESUME_KEY.format(stop.job_id), json.dumps({'task': task_name, 'args': args}),
+                        ex=CONTROL_TTL)
+    clear_stop(stop.job_id)
+    update_job_status(stop.job_id, stop.status)
+    logger.info(f"Job {stop.job_id} {stop.status.value}")
+    return {"status": stop.status.value, "job_id": stop.job_id}
+
+
+def resume_job(job_id, send_task):
+    """Queue a paused job again with the task and args it stopped with; returns the new task"""
+    resume = get_redis().get(RESUME_KEY.format(job_id))
+    if not resume:
+        return None
+    resume = json.loads(resume)
+    clear_stop(job_id)
+    task = send_task(resume['task'], args=resume['args'])
+    get_redis().delete(RESUME_KEY.format(job_id))
+    return task
+
+
+def cancel_paused(job_id):
+    """
+    Cancel a paused job. Its task has already exited, so the cleanup a cancel gets
+    from its task happens here: archives the paused run left on either host, its
+    checkpoints and what resume_job would have sent again all go.
+    """
+    resume = get_redis().get(RESUME_KEY.format(job_id))
+    if resume:
+        transfer_data, server_configs, identity_file = json.loads(resume)['args'][:3]
+        source_ssh, dest_ssh = connect_servers(server_configs, identity_file)
+        try:
+            clean_up_stopped(TransferStopped(job_id, 'cancel'), source_ssh, dest_ssh, transfer_data)
+        finally:
+            release_servers(source_ssh, dest_ssh)
+    clear_checkpoints(job_id)
+    get_redis().delete(RESUME_KEY.format(job_id))
+    clear_stop(job_id)
+    update_job_status(job_id, JobStatus.CANCELLED)
+    logger.info(f"Paused job {job_id} cancelled")
+
+
+def wait_remote(ssh, command, check_stop):
+    """
+    Run a remote command that reports no progress (tar -c -f, tar -x -f) until it
+    exits, calling `check_stop()` in between, so a stop does not wait for it.
+    Returns (exit status, stdout, stderr).
+    """
+    channel = ssh.get_transport().open_session()
+    stdout, stderr = [], []
+    try:
+        channel.exec_command(command)
+        while not channel.exit_status_ready():
+            check_stop()
+            # Keep both streams drained so a chatty command cannot stall on a full window
+            while channel.recv_ready():
+                stdout.append(channel.recv(65536))
+            while channel.recv_stderr_ready():
+                stderr.append(channel.recv_stderr(65536))
+            time.sleep(CONTROL_POLL_SECONDS)
+        status = channel.recv_exit_status()
+        # Whatever is still in flight, up to EOF
+        stdout.extend(iter(lambda: channel.recv(65536), b''))
+        stderr.extend(iter(lambda: channel.recv_stderr(65536), b''))
+    finally:
+        channel.close()
+    return status, b''.join(stdout).decode(errors='replace'), b''.join(stderr).decode(errors='replace')
@@ -0,0 +1,54 @@
+import os
+import threading
+from celery import current_task
+from app.celery_app import celery_app
+from app.logging.logger import logger
+
+# Custom Celery events the transfer tasks send next to the built-in task-* ones.
+# The API's job monitor (app.utils.job_monitor) consumes them all from the broker.
+PROGRESS_EVENT = 'task-progress'        # ProgressReporter meta: job_id, current, total, percent, rate, eta
+JOB_STATUS_EVENT = 'task-job-status'    # job_id, user_id, status: every change of a job's status
+
+
+# One event dispatcher per thread: default_dispatcher() would open a channel and
+# producer for every progress publish and status change
+_local = threading.local()
+
+
+def _dispatcher():
+    """This thread's dispatcher, created on first use (and again after a fork)"""
+    dispatcher = getattr(_local, 'dispatcher', None)
+    if dispatcher is None or dispatcher.pid != os.getpid():
+        dispatcher = celery_app.events.Dispatcher(celery_app.connection_for_write(), buffer_while_offline=False)
+        _local.dispatcher = dispatcher
+    return dispatcher
+
+
+def _discard_dispatcher():
+    """Drop this thread's dispatcher after a failed send, so the next one reconnects"""
+    dispatcher = getattr(_local, 'dispatcher', None)
+    _local.dispatcher = None
+    if dispatcher is None:
+        return
+    try:
+        dispatcher.close()
+        dispatcher.connection.close()
+    except Exception:
+        pass
+
+
+def send_job_event(event_type, **fields):
+    """Send a Celery event from worker code; never fails the transfer sending it"""
+    if 'uuid' not in fields:
+        # Lets the monitor map the task's own task-* events to the job
+        request = getattr(current_task, 'request', None)
+        fields['uuid'] = getattr(request, 'id', None)
+    # A stale connection fails the first send; retry once on a fresh one
+    for attempt in range(2):
+        try:
+            _dispatcher().send(event_type, **fields)
+            return
+        except Exception as e:
+            _discard_dispatcher()
+            if attempt:
+                logger.error(f"Could not send {event_type} event: {str(e)}")
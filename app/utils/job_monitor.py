@@ -1,76 +1,287 @@
-from celery.result import AsyncResult
-from app.websocket.connection_manager import manager
+import asyncio
+import os
+import threading
+import time
+from sqlalchemy import case, literal, update
+from app.celery_app import celery_app
+from app.redis_client import get_redis
+from app.websocket.connection_manager import manager, WS_MAX_SUBSCRIPTIONS
 from app.database.models.models import Job, JobStatus
 from app.db_setup import Session, engine
-import asyncio
 from app.logging.logger import logger
+from app.utils.job_events import PROGRESS_EVENT, JOB_STATUS_EVENT
+
+# Seconds between reconciliation passes against the database, which catch whatever
+# the event stream missed (monitor restarts, a worker killed before reporting)
+JOB_RECONCILE_SECONDS = float(os.getenv('JOB_RECONCILE_SECONDS', 30))
+# Longest wait before the event receiver reconnects to the broker
+JOB_EVENTS_RECONNECT_MAX_SECONDS = 30
+# Result-backend keys per MGET; a reconciliation sends all of them in one pipeline
+RESULT_MGET_CHUNK = 1000
+
+# Statuses after which the job's task no longer reports anything
+FINISHED_STATUSES = (JobStatus.COMPLETED, JobStatus.FAILED, JobStatus.CANCELLED, JobStatus.PAUSED)
+ACTIVE_STATUSES = (JobStatus.PENDING, JobStatus.IN_PROGRESS)
+# How far along each status is; reconciliation only ever moves a job forward, so a
+# result-backend entry lagging behind what the worker wrote never undoes it
+STATUS_RANK = {JobStatus.PENDING: 0, JobStatus.IN_PROGRESS: 1} | {status: 2 for status in FINISHED_STATUSES}
+# Celery's own task states and the job status each one implies
+TASK_STATE_STATUSES = {
+    'STARTED': JobStatus.IN_PROGRESS,
+    'RETRY': JobStatus.PENDING,
+    'FAILURE': JobStatus.FAILED,
+    'REVOKED': JobStatus.CANCELLED
+}
+# Progress fields a task-progress event carries into the job's state
+PROGRESS_FIELDS = ('current', 'total', 'percent', 'rate', 'eta')
+# Built-in task events that end or restart a run; the job's status is checked after them
+LIFECYCLE_EVENTS = ('task-succeeded', 'task-failed', 'task-revoked', 'task-retried')
+
 
 class JobMonitor:
-    def __init__(self):
-        self._current_job = None
-        self._is_running = False
-
-    async def start_monitoring(self):
-        """Single monitoring loop that tracks the current active job"""
-        self._is_running = True
-        
-        while self._is_running:
+    """
+    One per API process. Consumes the Celery events of every transfer task from the
+    broker (task-started, task-progress, task-job-status, task-succeeded, task-failed,
+    ...), keeps the state of every running job in memory and pushes a job_updates
+    frame to the job owner's sockets whenever that state really changes. Nothing is
+    polled per job or per watcher; the database is only read when a task ends without
+    having reported its job's status, and by the periodic reconciliation.
+    """
+
+    def __init__(self, connection_manager):
+        self.manager = connection_manager
+        self.jobs = {}   # job id -> state last pushed: job_id, user_id, task_id, status, progress fields
+        self.tasks = {}  # task id -> job id
+        self._loop = None
+        self._receiver = None
+        self._thread = None
+        self._reconcile_task = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._consume, name="job-events", daemon=True)
+        self._thread.start()
+        self._reconcile_task = asyncio.create_task(self._reconcile_periodically(), name="job-reconcile")
+
+    async def stop(self):
+        self._stopping.set()
+        if self._receiver:
+            self._receiver.should_stop = True
+        if self._reconcile_task:
+            self._reconcile_task.cancel()
+        if self._thread:
+            await asyncio.to_thread(self._thread.join)
+
+    def _consume(self):
+        """Receiver thread: hand every event over to the event loop"""
+        handlers = {'*': lambda event: self._loop.call_soon_threadsafe(self.on_event, event)}
+        delay = 1
+        while not self._stopping.is_set():
+            try:
+                with celery_app.connection() as connection:
+                    self._receiver = celery_app.events.Receiver(connection, handlers=handlers)
+                    logger.info("Consuming Celery task events")
+                    delay = 1
+                    self._receiver.capture(limit=None, timeout=None, wakeup=False)
+            except Exception as e:
+                logger.error(f"Celery event stream lost, retrying in {delay}s: {str(e)}")
+                self._stopping.wait(delay)
+                delay = min(delay * 2, JOB_EVENTS_RECONNECT_MAX_SECONDS)
+
+    def on_event(self, event):
+        """Fold one event into the job states; runs on the event loop"""
+        event_type = event.get('type')
+        task_id = event.get('uuid')
+        if event_type == PROGRESS_EVENT:
+            if task_id:
+                self.tasks[task_id] = event['job_id']
+            self.apply(event['job_id'], event.get('user_id'), task_id,
+                       {field: event.get(field) for field in PROGRESS_FIELDS} | {'status': JobStatus.IN_PROGRESS})
+        elif event_type == JOB_STATUS_EVENT:
+            if task_id:
+                self.tasks[task_id] = event['job_id']
+            self.apply(event['job_id'], event.get('user_id'), task_id, {'status': JobStatus(event['status'])})
+        elif event_type == 'task-started' and task_id in self.tasks:
+            self.apply(self.tasks[task_id], None, task_id, {'status': JobStatus.IN_PROGRESS})
+        elif event_type in LIFECYCLE_EVENTS and task_id:
+            # The task normally reported its job's final status itself; check it did
+            asyncio.create_task(self.refresh_task(task_id))
+
+    def apply(self, job_id, user_id, task_id, changes):
+        """Merge changes into a job's state and push the state if anything differs"""
+        current = self.jobs.get(job_id, {'job_id': job_id})
+        state = dict(current)
+        state.update(changes)
+        if user_id is not None:
+            state['user_id'] = user_id
+        if task_id:
+            state['task_id'] = task_id
+        if state == current or state.get('user_id') is None:
+            return
+        if state['status'] in FINISHED_STATUSES:
+            self.forget(job_id)
+        else:
+            self.jobs[job_id] = state
+        self.manager.publish_job_update(state)
+
+    def forget(self, job_id):
+        self.jobs.pop(job_id, None)
+        for task_id in [task_id for task_id, job in self.tasks.items() if job == job_id]:
+            del self.tasks[task_id]
+
+    async def subscribe(self, connection, job_ids):
+        """Subscribe a socket to the given jobs of its user; answers with the ids taken and refused"""
+        job_ids = [job_id for job_id in job_ids if isinstance(job_id, int)]
+        room = max(WS_MAX_SUBSCRIPTIONS - len(connection.jobs or []), 0)
+        try:
+            rows = await asyncio.to_thread(self._load_user_jobs, connection.user_id, job_ids[:room])
+        except Exception as e:
+            logger.error(f"Could not load jobs {job_ids} to subscribe to: {str(e)}")
+            rows = []
+        for job_id, user_id, task_id, status in rows:
+            # The state the monitor follows is newer than the database's
+            state = self.jobs.get(job_id) or {'job_id': job_id, 'user_id': user_id, 'task_id': task_id, 'status': status}
+            self.manager.subscribe(connection, job_id, state)
+        subscribed = [row[0] for row in rows]
+        connection.put({
+            "type": "subscribed",
+            "job_ids": subscribed,
+            "rejected": [job_id for job_id in job_ids if job_id not in subscribed]
+        })
+
+    def unsubscribe(self, connection, job_ids):
+        self.manager.unsubscribe(connection, job_ids)
+        connection.put({"type": "unsubscribed", "job_ids": job_ids})
+
+    @staticmethod
+    def _load_user_jobs(user_id, job_ids):
+        if not job_ids:
+            return []
+        with Session(engine) as db:
+            return db.query(Job.id, Job.user_id, Job.task_id, Job.status).filter(
+                Job.id.in_(job_ids), Job.user_id == user_id
+            ).all()
+
+    async def refresh_task(self, task_id):
+        try:
+            job = await asyncio.to_thread(self._load_task_job, task_id, self.tasks.get(task_id))
+        except Exception as e:
+            logger.error(f"Could not load the job of task {task_id}: {str(e)}")
+            return
+        if job:
+            self.apply(job['job_id'], job['user_id'], task_id, {'status': job['status']})
+
+    @staticmethod
+    def _load_task_job(task_id, job_id):
+        with Session(engine) as db:
+            query = db.query(Job.id, Job.user_id, Job.status)
+            row = query.filter(Job.id == job_id).first() if job_id else query.filter(Job.task_id == task_id).first()
+            return {'job_id': row[0], 'user_id': row[1], 'status': row[2]} if row else None
+
+    async def _reconcile_periodically(self):
+        while True:
+            await asyncio.sleep(JOB_RECONCILE_SECONDS)
             try:
-                with Session(engine) as db:
-                    # Get the currently processing job
-                    active_job = db.query(Job).filter(Job.status == JobStatus.IN_PROGRESS).first()
-                    
-                    if active_job and active_job.task_id:
-                        result = AsyncResult(active_job.task_id)
-                        status = result.status
-                        
-                        update = {
-                            "job_id": active_job.id,
-                            "status": status,
-                            "task_id": active_job.task_id,
-                        }
-                        
-                        # Add progress info if available
-                        if status == JobStatus.IN_PROGRESS and result.info:
-                            # result.info contains the meta data from self.update_state
-                            progress_info = result.info
-                            update.update({
-                                "current": progress_info.get('current', 0),
-                                "total": progress_info.get('total', 0),
-                                "percent": progress_info.get('percent', 0),
-                                "status": progress_info.get('status', JobStatus.IN_PROGRESS)
-                            })
-                            
-                        # Check if job is complete (SUCCESS or FAILURE)
-                        # elif status in ['SUCCESS', JobStatus.COMPLETED]:
-                        #     logger.info(f"Job {active_job.id} completed with status: {status}")
-                        #     # Send a job completion notification
-                        #     await manager.broadcast_to_user(
-                        #         active_job.user_id,
-                        #         {
-                        #             "type": "job_completion",
-                        #             "job_id": active_job.id,
-                        #             "status": JobStatus.COMPLETED
-                        #         }
-                        #     )
-                        
-                        # Broadcast to the job's owner
-                        await manager.broadcast_to_user(
-                            active_job.user_id,
-                            {
-                                "type": "job_updates",
-                                "updates": [update]
-                            }
-                        )
-                        
+                await self.reconcile()
             except Exception as e:
-                logger.error(f"Error in job monitor: {str(e)}")
-                
-            await asyncio.sleep(1)
-    
-    def stop_monitoring(self):
-        """Stop the monitoring loop"""
-        self._is_running = False
+                logger.error(f"Job reconciliation failed: {str(e)}")
+
+    async def reconcile(self):
+        """Bring the states in line with the database and the result backend: running jobs we missed, finished ones we did not hear about"""
+        started = time.monotonic()
+        # Running jobs we follow, plus watched jobs we have not seen finish
+        watched = [
+            job_id for job_id, stream in self.manager.job_streams.items()
+            if stream.state is None or stream.state['status'] not in FINISHED_STATUSES
+        ]
+        states = await asyncio.to_thread(reconcile_jobs, list(set(self.jobs) | set(watched)))
+        for state in states:
+            changes = {field: value for field, value in state.items() if field not in ('job_id', 'user_id', 'task_id')}
+            self.apply(state['job_id'], state['user_id'], state['task_id'], changes)
+        logger.debug(f"Reconciled {len(states)} jobs in {time.monotonic() - started:.3f}s")
+
+
+def job_status_from_task(meta):
+    """The job status a result-backend entry implies, or None if it does not tell"""
+    state = meta.get('status')
+    result = meta.get('result')
+    if state == 'SUCCESS':
+        # The task's return value carries the outcome (completed, paused, cancelled, fanned_out)
+        reported = result.get('status') if isinstance(result, dict) else JobStatus.COMPLETED
+    else:
+        # Celery's states, or the job status the task set with update_state
+        reported = TASK_STATE_STATUSES.get(state, state)
+    try:
+        return JobStatus(reported)
+    except ValueError:
+        return None
+
+
+def fetch_task_results(task_ids):
+    """Result-backend entries of the given tasks, fetched with one pipelined MGET"""
+    keys = [celery_app.backend.get_key_for_task(task_id) for task_id in task_ids]
+    if not keys:
+        return {}
+    pipe = get_redis().pipeline(transaction=False)
+    for start in range(0, len(keys), RESULT_MGET_CHUNK):
+        pipe.mget(keys[start:start + RESULT_MGET_CHUNK])
+    values = [value for chunk in pipe.execute() for value in chunk]
+
+    results = {}
+    for task_id, value in zip(task_ids, values):
+        if value is None:
+            continue  # not started yet, or expired
+        try:
+            results[task_id] = celery_app.backend.decode(value)
+        except Exception as e:
+            logger.error(f"Unreadable result of task {task_id}: {str(e)}")
+    return results
+
+
+def reconcile_jobs(known_ids):
+    """
+    One reconciliation pass, at the same cost however many jobs are running: one
+    indexed query for every unfinished job (and the ones in known_ids), one Redis
+    round trip for all their task results, and one UPDATE for every job whose task
+    got further than the database says, e.g. a worker killed before it wrote its
+    final status. Returns the resulting state of each job.
+    """
+    with Session(engine) as db:
+        active = Job.status.in_(ACTIVE_STATUSES)
+        condition = active | Job.id.in_(known_ids) if known_ids else active
+        rows = db.query(Job.id, Job.user_id, Job.task_id, Job.status).filter(condition).all()
+        results = fetch_task_results([row.task_id for row in rows if row.task_id])
+
+        states = []
+        fixes = {}  # job id -> status
+        for job_id, user_id, task_id, status in rows:
+            state = {'job_id': job_id, 'user_id': user_id, 'task_id': task_id, 'status': status}
+            meta = results.get(task_id)
+            if meta:
+                reported = job_status_from_task(meta)
+                if reported and STATUS_RANK[reported] > STATUS_RANK[status]:
+                    fixes[job_id] = state['status'] = reported
+                progress = meta.get('result')
+                if state['status'] == JobStatus.IN_PROGRESS and isinstance(progress, dict):
+                    state.update({field: progress[field] for field in PROGRESS_FIELDS if field in progress})
+            states.append(state)
+
+        if fixes:
+            # Skips any job a worker finished since the query
+            db.execute(
+                update(Job)
+                .where(Job.id.in_(list(fixes)), active)
+                .values(status=case(
+                    {job_id: literal(status, Job.status.type) for job_id, status in fixes.items()},
+                    value=Job.id
+                )),
+                execution_options={'synchronize_session': False}
+            )
+            db.commit()
+            logger.info(f"Reconciliation fixed the status of {len(fixes)} jobs: {sorted(fixes)}")
+    return states
 
 # Create a single instance
-job_monitor = JobMonitor()
\ No newline at end of file
+job_monitor = JobMonitor(manager)
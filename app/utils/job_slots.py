@@ -0,0 +1,161 @@
+import functools
+import os
+import threading
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from celery.exceptions import Ignore
+from app.logging.logger import logger
+from app.redis_client import get_redis
+
+# Transfers one worker process runs at once. run_celery.sh starts the thread pool with
+# the same number, so every slot has a thread to run in.
+TRANSFER_JOBS_PER_PROCESS = int(os.getenv('TRANSFER_JOBS_PER_PROCESS', 4))
+# Transfers one process runs at once that touch the same host, as source or destination
+TRANSFER_JOBS_PER_HOST = int(os.getenv('TRANSFER_JOBS_PER_HOST', 2))
+# Seconds a running task's lease outlives its last renewal; renewed every third of that
+TASK_LEASE_TTL = int(os.getenv('TASK_LEASE_TTL', 60))
+
+LEASE_KEY = 'task_lease:{}'     # task id -> token of the worker thread running it
+
+# Renew or drop a lease only while it is still ours
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class JobSlots:
+    """
+    Admission control for the transfers running concurrently in one worker process.
+
+    A job holds one process slot and one slot on each of its hosts for as long as it
+    runs. Jobs that would go over either limit wait in a queue, holding nothing.
+    Whenever a job finishes, the waiting jobs are started in arrival order, each one
+    that fits: a job waiting for a busy host does not keep a job bound for idle hosts
+    from starting, and the longest waiting job gets a freed host first.
+    """
+
+    def __init__(self, per_process=TRANSFER_JOBS_PER_PROCESS, per_host=TRANSFER_JOBS_PER_HOST):
+        self.per_process = per_process
+        self.per_host = per_host
+        self._jobs = 0        # jobs holding a process slot
+        self._running = {}    # host -> jobs holding a slot
+        self._waiting = deque()  # (hosts, admitted event), in arrival order
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, hosts):
+        hosts = sorted(set(hosts))
+        admitted = threading.Event()
+        with self._lock:
+            self._waiting.append((hosts, admitted))
+            self._admit()
+        admitted.wait()
+        logger.info(f"Transfer slot taken for {hosts}; running per host: {self.running()}")
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._jobs -= 1
+                for host in hosts:
+                    self._running[host] -= 1
+                self._admit()
+
+    def _admit(self):
+        """Start every waiting job that fits, oldest first; call with the lock held"""
+        for waiter in list(self._waiting):
+            if self._jobs >= self.per_process:
+                break
+            hosts, admitted = waiter
+            if all(self._running.get(host, 0) < self.per_host for host in hosts):
+                self._waiting.remove(waiter)
+                self._jobs += 1
+                for host in hosts:
+                    self._running[host] = self._running.get(host, 0) + 1
+                admitted.set()
+
+    def running(self):
+        with self._lock:
+            return {host: count for host, count in self._running.items() if count}
+
+
+# One set of slots per worker process
+job_slots = JobSlots()
+
+
+@contextmanager
+def task_lease(task_id):
+    """
+    Hold task_lease:{task_id} in Redis while a task message runs, renewed by a
+    heartbeat thread.
+
+    Transfers are late-acked, so Redis hands a message that is still running to
+    another worker once the broker's visibility_timeout is up. That second delivery
+    finds the lease taken and is dropped (Ignore: no result is stored, the message
+    is acked) instead of writing the same destination alongside the first. A worker
+    that dies stops renewing, so its lease is gone long before its message comes
+    back. Without Redis the task runs unguarded.
+    """
+    key = LEASE_KEY.format(task_id)
+    token = uuid.uuid4().hex
+    try:
+        redis = get_redis()
+        taken = redis.set(key, token, nx=True, ex=TASK_LEASE_TTL)
+    except Exception as e:
+        logger.error(f"Could not take the lease of task {task_id}: {str(e)}")
+        yield
+        return
+    if not taken:
+        logger.warning(f"Task {task_id} is already running on another worker; dropping this delivery")
+        raise Ignore()
+
+    stopped = threading.Event()
+    heartbeat = threading.Thread(target=_renew_lease, args=(key, token, stopped),
+                                 name=f"lease:{task_id}", daemon=True)
+    heartbeat.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        heartbeat.join()
+        try:
+            redis.register_script(RELEASE_SCRIPT)(keys=[key], args=[token])
+        except Exception as e:
+            # Expires on its own
+            logger.error(f"Could not release the lease of task {task_id}: {str(e)}")
+
+
+def _renew_lease(key, token, stopped):
+    renew = get_redis().register_script(RENEW_SCRIPT)
+    while not stopped.wait(TASK_LEASE_TTL / 3):
+        try:
+            if not renew(keys=[key], args=[token, TASK_LEASE_TTL]):
+                logger.error(f"Lease {key} was lost; a redelivery of this task may run alongside it")
+                return
+        except Exception as e:
+            logger.error(f"Could not renew lease {key}: {str(e)}")
+
+
+def limit_concurrency(task_func):
+    """
+    Run a transfer task body under its task lease, in a job slot for its source and
+    destination hosts.
+
+    Goes under @shared_task; the task keeps its (self, transfer_data, server_configs,
+    identity_file) signature, and the job stays pending while it waits for a slot.
+    """
+    @functools.wraps(task_func)
+    def wrapper(self, transfer_data, server_configs, identity_file):
+        hosts = [server_configs['pisms']['host'], server_configs['pimaster']['host']]
+        with task_lease(self.request.id), job_slots.slot(hosts):
+            return task_func(self, transfer_data, server_configs, identity_file)
+    return wrapper
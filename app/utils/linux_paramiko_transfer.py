@@ -1,27 +1,48 @@
-import asyncio
-import time
-import paramiko
+import shlex
 from pathlib import Path
 from fastapi import HTTPException
 from celery import shared_task
 from app.database.models.models import JobStatus
 from app.utils.update_job_status import update_job_status
 from app.logging.logger import logger
+from app.utils.multi_file_transfer import files_transfer, verify_tree_copy
+from app.utils.integrity import verified_copy_pool, combined_digest
+from app.utils.update_job_status import update_job_checksum
+from app.utils.progress_reporter import ProgressReporter
+from app.utils.range_transfer import RANGE_THRESHOLD, RANGE_STREAMS, copy_file_ranges, range_items, preallocate
+from app.utils.checkpoint import load_checkpoints, clear_checkpoints, resume_items
+from app.utils.stream_transfer import (
+    stream_tar_relay, TAR_CHECKPOINT_FLAGS, can_reach, remote_push, direct_ssh_command
+)
+from app.utils.compression import resolve_codec, tar_flags, archive_extension
+from app.utils.ssh_pool import connect_servers, release_servers, ssh_pool
+from app.utils.bandwidth import job_limiter, pair_name
+from app.utils.shard_transfer import sharded_transfer
+from app.utils.job_slots import limit_concurrency
+from app.utils.manifest_cache import cached_tree_size, invalidate_manifests
+from app.utils.job_control import (
+    TransferStopped, StopCheck, tracked, wait_remote, clean_up_stopped, record_stopped
+)
 
-# Adjustable chunk sizes for reading/writing
-CHUNK_SIZE = {
-    'small': 32768,
-    'medium': 65536,
-    'large': 131072
-}
+# Attempts after the first, and the pause between them
+TRANSFER_MAX_RETRIES = 3
+TRANSFER_RETRY_DELAY = 30
 
-@shared_task(name="transfer.linux_paramiko", bind=True)
+# acks_late + reject_on_worker_lost put the message back on the queue if the worker
+# dies mid-transfer; the next attempt resumes from the job's checkpoints.
+@shared_task(name="transfer.linux_paramiko", bind=True, acks_late=True, reject_on_worker_lost=True,
+             max_retries=TRANSFER_MAX_RETRIES)
+@limit_concurrency
 def linux_paramiko_transfer(self, transfer_data, server_configs, identity_file):
     """
     Linux-specific implementation using Paramiko (chunk-based transfer).
     This replaces the old subprocess/rsync approach.
+    Failed attempts are retried and resume from the last checkpointed offset.
+    A pause or cancel (see job_control) stops it between two chunks.
     """
     try:
+        # Paused or cancelled while still queued
+        StopCheck(transfer_data['job_id'])()
         update_job_status(transfer_data['job_id'], JobStatus.IN_PROGRESS)
         logger.info(f"Starting Linux transfer process (Paramiko) with data: {transfer_data}")
 
@@ -33,45 +54,96 @@ def linux_paramiko_transfer(self, transfer_data, server_configs, identity_file):
 
         source = transfer_data['source_storage']
         dest = transfer_data['dest_storage']
-        user_id = transfer_data['user_id']
-
-        # Prepare SSH clients
-        source_ssh = paramiko.SSHClient()
-        source_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        dest_ssh = paramiko.SSHClient()
-        dest_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        # Load private key
-        logger.info(f"Loading private key from: {identity_file}")
-        private_key = paramiko.RSAKey(filename=str(identity_file))
-
-        # Connect to source server (e.g. pisms)
-        source_server = server_configs['pisms']
-        logger.info(f"Connecting to source server: {source_server['host']}")
-        source_ssh.connect(
-            source_server['host'],
-            username=source_server['user'],
-            pkey=private_key
-        )
-        logger.info("Successfully connected to source server")
-
-        # Connect to destination server (e.g. pimaster)
-        dest_server = server_configs['pimaster']
-        logger.info(f"Connecting to destination server: {dest_server['host']}")
-        dest_ssh.connect(
-            dest_server['host'],
-            username=dest_server['user'],
-            pkey=private_key
+
+        # Bandwidth budgets are per source/destination host pair
+        transfer_data['bandwidth_pair'] = pair_name(server_configs['pisms']['host'], server_configs['pimaster']['host'])
+
+        # Pooled connections: a worker reuses them across jobs instead of reconnecting
+        source_ssh, dest_ssh = connect_servers(server_configs, identity_file)
+        try:
+            if transfer_data.get('mode') == 'stream':
+                stream_transfer(self, transfer_data, source_ssh, dest_ssh)
+            elif transfer_data.get('mode') == 'direct':
+                direct_transfer(self, transfer_data, source_ssh, dest_ssh, server_configs['pimaster'])
+            elif transfer_data.get('mode') == 'files':
+                files_transfer(self, transfer_data, source_ssh, dest_ssh)
+            elif transfer_data.get('mode') == 'sharded':
+                sharded_transfer(self, transfer_data, source_ssh, dest_ssh)
+            else:
+                archive_transfer(self, transfer_data, source_ssh, dest_ssh)
+        except Exception as e:
+            if isinstance(e, TransferStopped):
+                clean_up_stopped(e, source_ssh, dest_ssh, transfer_data)
+            invalidate_manifests(dest_ssh, dest)
+            # Don't hand a connection in an unknown state to the next job
+            release_servers(source_ssh, dest_ssh, discard=True)
+            raise
+        # Cached listings of the destination no longer match it
+        invalidate_manifests(dest_ssh, dest)
+        release_servers(source_ssh, dest_ssh)
+
+        # Update job status to COMPLETED
+        update_job_status(transfer_data['job_id'], JobStatus.COMPLETED)
+        logger.info("Linux transfer (Paramiko) completed successfully.")
+
+        return {
+            "status": "completed",
+            "message": "Linux transfer (Paramiko) successful",
+            "source": source,
+            "destination": dest,
+            "ssh_pool": ssh_pool.stats()
+        }
+
+    except TransferStopped as stop:
+        return record_stopped(self, stop, self.name, [transfer_data, server_configs, identity_file])
+    except HTTPException:
+        update_job_status(transfer_data['job_id'], JobStatus.FAILED)
+        raise
+    except Exception as e:
+        logger.error(f"Linux transfer (Paramiko) failed with error: {e}")
+        if self.request.retries < self.max_retries:
+            logger.info(f"Retrying transfer in {TRANSFER_RETRY_DELAY}s (attempt {self.request.retries + 1})")
+            update_job_status(transfer_data['job_id'], JobStatus.PENDING)
+            raise self.retry(exc=e, countdown=TRANSFER_RETRY_DELAY)
+        update_job_status(transfer_data['job_id'], JobStatus.FAILED)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def archive_transfer(task, transfer_data, source_ssh, dest_ssh):
+    """
+    Archive mode: tar the source into {source}.tar.<codec>, copy the archive over SFTP,
+    then extract it on the destination and remove both archives.
+    """
+    source = transfer_data['source_storage']
+    dest = transfer_data['dest_storage']
+    job_id = transfer_data['job_id']
+    codec, level = resolve_codec(transfer_data, source_ssh, dest_ssh)
+    source_archive = f"{source}{archive_extension(codec)}"
+    check_stop = StopCheck(job_id)
+    # Where a cancel finds the archives to remove
+    transfer_data['archives'] = {'source': source_archive, 'dest': f"{dest}/{Path(source_archive).name}"}
+
+    # A retried job picks up the archive its previous attempt left behind, as long as
+    # it is still the one the checkpoints were taken against
+    resumable = False
+    checkpoints = load_checkpoints(job_id)
+    if checkpoints:
+        stdin, stdout, stderr = source_ssh.exec_command(f"stat -c%s '{source_archive}'")
+        existing_size = stdout.read().decode().strip()
+        resumable = existing_size.isdigit() and all(
+            checkpoint['file_size'] == int(existing_size) for checkpoint in checkpoints.values()
         )
-        logger.info("Successfully connected to destination server")
+        if not resumable:
+            logger.info("Checkpoints do not match the source archive; starting over")
+            clear_checkpoints(job_id)
 
+    if resumable:
+        logger.info(f"Reusing archive from previous attempt: {source_archive}")
+    else:
         # Create tar archive on source
-        source_archive = f"{source}.tar.gz"
-        tar_command = f"tar -czf '{source_archive}' -C '{source}' ."
+        tar_command = f"tar -c {tar_flags(codec, level)} -f '{source_archive}' -C '{source}' ."
         logger.info(f"Creating tar archive on source with command: {tar_command}")
-        stdin, stdout, stderr = source_ssh.exec_command(tar_command)
-        tar_output = stdout.read().decode()
-        tar_error = stderr.read().decode()
+        tar_status, tar_output, tar_error = wait_remote(source_ssh, tracked(tar_command, job_id), check_stop)
         if tar_error:
             logger.error(f"Tar command error: {tar_error}")
             raise Exception(f"Failed to create tar archive: {tar_error}")
@@ -83,118 +155,159 @@ def linux_paramiko_transfer(self, transfer_data, server_configs, identity_file):
             logger.error(f"Tarball not found at {source_archive}")
             raise Exception(f"Tarball not found at {source_archive}")
 
-        # Determine size of the newly created tarball
-        size_command = f"stat -c%s '{source_archive}'"
-        logger.info(f"Getting archive size with command: {size_command}")
-        stdin, stdout, stderr = source_ssh.exec_command(size_command)
-        size_output = stdout.read().decode().strip()
-        size_error = stderr.read().decode()
-        if size_error:
-            logger.error(f"Error getting file size: {size_error}")
-            raise Exception(f"Failed to get archive size: {size_error}")
-        if not size_output:
-            logger.error("File size command returned empty output")
-            raise Exception("Failed to get archive size: empty output")
-
-        total_bytes = int(size_output)
-        logger.info(f"Archive file size: {total_bytes} bytes")
-
-        # Open SFTP connections
-        logger.info("Opening SFTP connections on both servers...")
-        source_sftp = source_ssh.open_sftp()
-        dest_sftp = dest_ssh.open_sftp()
-
-        # Transfer the tar file in chunks
-        bytes_transferred = 0
-        dest_archive = f"{dest}/{Path(source_archive).name}"
-        logger.info(f"Transferring tarball to destination: {dest_archive}")
-
-        # Verify destination path and create if it doesn't exist
-        mkdir_command = f"mkdir -p '{dest}'"
-        logger.info(f"Ensuring destination path exists with command: {mkdir_command}")
-        stdin, stdout, stderr = dest_ssh.exec_command(mkdir_command)
-        mkdir_error = stderr.read().decode()
-        if mkdir_error:
-            logger.error(f"Error creating destination directory: {mkdir_error}")
-            raise Exception(f"Failed to create destination directory: {mkdir_error}")
-
-        # Verify destination path
-        stdin, stdout, stderr = dest_ssh.exec_command(f"ls '{dest}'")
-        if stderr.read().decode():
-            logger.error(f"Destination path not found: {dest}")
-            # raise Exception(f"Destination path not found: {dest}")
-
-        logger.info(f"Transferring zip file to destination")
-        with source_sftp.file(source_archive, 'rb') as sfh:
-            with dest_sftp.file(dest_archive, 'wb') as dfh:
-                while True:
-                    data = sfh.read(CHUNK_SIZE['small'])
-                    if not data:
-                        break
-                    dfh.write(data)
-                    bytes_transferred += len(data)
-
-                    # Calculate progress
-                    progress = int((bytes_transferred / total_bytes) * 100)
-
-                    # Update Celery task state
-                    self.update_state(
-                        state=JobStatus.IN_PROGRESS,
-                        meta={
-                            'job_id': transfer_data['job_id'],
-                            'task_id': self.request.id,
-                            'user_id': user_id,
-                            'current': bytes_transferred,
-                            'total': total_bytes,
-                            'status': JobStatus.IN_PROGRESS,
-                            'percent': progress
-                        }
-                    )
-                    time.sleep(0.2)  # Throttle updates slightly
-
-        # Close SFTP after the transfer
-        source_sftp.close()
-        dest_sftp.close()
-        logger.info("Tarball transfer completed; SFTP connections closed")
-
-        # Untar on destination server
-        untar_command = f"tar -xzf '{dest_archive}' -C '{dest}'"
-        logger.info(f"Untarring archive on destination with command: {untar_command}")
-        stdin, stdout, stderr = dest_ssh.exec_command(untar_command)
-        untar_output = stdout.read().decode()
-        untar_error = stderr.read().decode()
-        if untar_error:
-            logger.error(f"Untar command error: {untar_error}")
-            raise Exception(f"Failed to untar file: {untar_error}")
-        logger.info(f"Untar command output: {untar_output}")
-
-        # Remove tarball on destination
-        rm_dest_cmd = f"rm '{dest_archive}'"
-        logger.info(f"Removing tarball on destination: {rm_dest_cmd}")
-        dest_ssh.exec_command(rm_dest_cmd)
-
-        # Remove tarball on source
-        rm_source_cmd = f"rm '{source_archive}'"
-        logger.info(f"Cleaning up tar file on source: {rm_source_cmd}")
-        source_ssh.exec_command(rm_source_cmd)
-
-        # Close SSH connections
-        source_ssh.close()
-        dest_ssh.close()
-        logger.info("All SSH connections closed.")
+    # Determine size of the newly created tarball
+    size_command = f"stat -c%s '{source_archive}'"
+    logger.info(f"Getting archive size with command: {size_command}")
+    stdin, stdout, stderr = source_ssh.exec_command(size_command)
+    size_output = stdout.read().decode().strip()
+    size_error = stderr.read().decode()
+    if size_error:
+        logger.error(f"Error getting file size: {size_error}")
+        raise Exception(f"Failed to get archive size: {size_error}")
+    if not size_output:
+        logger.error("File size command returned empty output")
+        raise Exception("Failed to get archive size: empty output")
 
-        # Update job status to COMPLETED
-        update_job_status(transfer_data['job_id'], JobStatus.COMPLETED)
-        logger.info("Linux transfer (Paramiko) completed successfully.")
+    total_bytes = int(size_output)
+    logger.info(f"Archive file size: {total_bytes} bytes")
 
-        return {
-            "status": "completed",
-            "message": "Linux transfer (Paramiko) successful",
-            "source": source,
-            "destination": dest
-        }
+    # Open SFTP connections
+    logger.info("Opening SFTP connections on both servers...")
+    source_sftp = source_ssh.open_sftp()
+    dest_sftp = dest_ssh.open_sftp()
 
-    except Exception as e:
-        logger.error(f"Linux transfer (Paramiko) failed with error: {e}")
-        update_job_status(transfer_data['job_id'], JobStatus.FAILED)
-        raise HTTPException(status_code=500, detail=str(e))
+    # Transfer the tar file in chunks
+    progress = ProgressReporter(task, transfer_data, total_bytes)
+    dest_archive = f"{dest}/{Path(source_archive).name}"
+    logger.info(f"Transferring tarball to destination: {dest_archive}")
+
+    # Verify destination path and create if it doesn't exist
+    mkdir_command = f"mkdir -p '{dest}'"
+    logger.info(f"Ensuring destination path exists with command: {mkdir_command}")
+    stdin, stdout, stderr = dest_ssh.exec_command(mkdir_command)
+    mkdir_error = stderr.read().decode()
+    if mkdir_error:
+        logger.error(f"Error creating destination directory: {mkdir_error}")
+        raise Exception(f"Failed to create destination directory: {mkdir_error}")
+
+    # Verify destination path
+    stdin, stdout, stderr = dest_ssh.exec_command(f"ls '{dest}'")
+    if stderr.read().decode():
+        logger.error(f"Destination path not found: {dest}")
+        # raise Exception(f"Destination path not found: {dest}")
+
+    # Work out what is left to copy; ranges confirmed by an earlier attempt are skipped
+    if total_bytes >= RANGE_THRESHOLD:
+        items = range_items(source_archive, dest_archive, total_bytes, RANGE_STREAMS)
+    else:
+        items = [(source_archive, dest_archive, total_bytes, 0, None)]
+    items, checkpointers, bytes_done = resume_items(job_id, dest_sftp, items)
+    progress.add(bytes_done)
+    on_chunk = job_limiter(transfer_data).wrap(progress.add)
+
+    logger.info(f"Transferring zip file to destination")
+    if total_bytes >= RANGE_THRESHOLD:
+        if not bytes_done:
+            preallocate(dest_sftp, dest_archive, total_bytes)
+        digests = copy_file_ranges(source_ssh, dest_ssh, source_archive, dest_archive, total_bytes,
+                                   on_chunk=on_chunk, items=items, checkpointers=checkpointers)
+    else:
+        digests = verified_copy_pool(source_ssh, dest_ssh, items, 1, on_chunk, checkpointers)
+    progress.flush()
+    update_job_checksum(job_id, combined_digest(digests))
+
+    # Close SFTP after the transfer
+    source_sftp.close()
+    dest_sftp.close()
+    logger.info("Tarball transfer completed; SFTP connections closed")
+
+    # Untar on destination server
+    untar_command = f"tar -x {tar_flags(codec, level)} -f '{dest_archive}' -C '{dest}'"
+    logger.info(f"Untarring archive on destination with command: {untar_command}")
+    untar_status, untar_output, untar_error = wait_remote(dest_ssh, tracked(untar_command, job_id), check_stop)
+    if untar_error:
+        logger.error(f"Untar command error: {untar_error}")
+        raise Exception(f"Failed to untar file: {untar_error}")
+    logger.info(f"Untar command output: {untar_output}")
+
+    # Nothing left to resume once the archive is extracted
+    clear_checkpoints(job_id)
+
+    if transfer_data.get('verify_manifest'):
+        verify_tree_copy(source_ssh, dest_ssh, source, dest, job_id)
+
+    # Remove tarball on destination
+    rm_dest_cmd = f"rm '{dest_archive}'"
+    logger.info(f"Removing tarball on destination: {rm_dest_cmd}")
+    dest_ssh.exec_command(rm_dest_cmd)
+
+    # Remove tarball on source
+    rm_source_cmd = f"rm '{source_archive}'"
+    logger.info(f"Cleaning up tar file on source: {rm_source_cmd}")
+    source_ssh.exec_command(rm_source_cmd)
+
+
+def stream_transfer(task, transfer_data, source_ssh, dest_ssh):
+    """
+    Stream mode: pipe `tar -c` on the source through the worker into `tar -x` on the
+    destination. Nothing is staged on disk, and packing, copying and unpacking overlap.
+    """
+    source = transfer_data['source_storage']
+    dest = transfer_data['dest_storage']
+    codec, level = resolve_codec(transfer_data, source_ssh, dest_ssh)
+
+    total_bytes = cached_tree_size(source_ssh, source)
+    logger.info(f"Source tree size: {total_bytes} bytes")
+
+    progress = ProgressReporter(task, transfer_data, total_bytes)
+
+    pack_command = f"tar -c {tar_flags(codec, level)} {TAR_CHECKPOINT_FLAGS} -f - -C '{source}' ."
+    unpack_command = f"mkdir -p '{dest}' && tar -x {tar_flags(codec, level)} -f - -C '{dest}'"
+    stream_tar_relay(source_ssh, dest_ssh, tracked(pack_command, transfer_data['job_id']),
+                     tracked(unpack_command, transfer_data['job_id']), progress.update,
+                     job_limiter(transfer_data).consume)
+    progress.update(total_bytes)
+    progress.flush()
+    logger.info("Tar stream transfer completed")
+
+    if transfer_data.get('verify_manifest'):
+        verify_tree_copy(source_ssh, dest_ssh, source, dest, transfer_data['job_id'])
+
+
+def direct_transfer(task, transfer_data, source_ssh, dest_ssh, dest_server):
+    """
+    Direct mode: the source pipes `tar -c` into its own ssh session to the destination,
+    so the data goes host to host and the worker only follows tar's progress.
+    Falls back to stream mode (relayed through the worker) when the source cannot
+    reach the destination. dest_server may set `direct_host` when the source knows
+    the destination under another address than the worker does.
+    The data never passes the worker, so bandwidth budgets do not apply to it.
+    """
+    source = transfer_data['source_storage']
+    dest = transfer_data['dest_storage']
+    dest_host = dest_server.get('direct_host', dest_server['host'])
+    dest_port = dest_server.get('port', 22)
+
+    if not can_reach(source_ssh, dest_server['user'], dest_host, dest_port):
+        logger.info("Direct transfer not possible; relaying the stream through the worker instead")
+        stream_transfer(task, transfer_data, source_ssh, dest_ssh)
+        return
+
+    codec, level = resolve_codec(transfer_data, source_ssh, dest_ssh)
+    total_bytes = cached_tree_size(source_ssh, source)
+    logger.info(f"Source tree size: {total_bytes} bytes")
+
+    progress = ProgressReporter(task, transfer_data, total_bytes)
+
+    pack_command = f"tar -c {tar_flags(codec, level)} {TAR_CHECKPOINT_FLAGS} -f - -C {shlex.quote(source)} ."
+    unpack_command = f"mkdir -p {shlex.quote(dest)} && tar -x {tar_flags(codec, level)} -f - -C {shlex.quote(dest)}"
+    # Quoted once more for the source's shell, so only the destination's shell interprets it
+    push_command = f"{pack_command} | {direct_ssh_command(dest_server['user'], dest_host, dest_port)} {shlex.quote(unpack_command)}"
+    # Killing the push also ends tar -x on the destination: its ssh session closes
+    remote_push(source_ssh, tracked(push_command, transfer_data['job_id']), progress.update)
+    progress.update(total_bytes)
+    progress.flush()
+    logger.info("Direct transfer completed")
+
+    if transfer_data.get('verify_manifest'):
+        verify_tree_copy(source_ssh, dest_ssh, source, dest, transfer_data['job_id'])
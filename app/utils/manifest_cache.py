@@ -0,0 +1,213 @@
+import os
+import posixpath
+import time
+import zlib
+from app.logging.logger import logger
+from app.redis_client import get_redis
+from app.utils.remote_walk import RemoteWalk
+from app.utils.stream_transfer import get_tree_size
+
+# Seconds a cached manifest may be used for; 0 turns the cache off. Directory mtimes
+# catch files being added, removed or renamed, but not a file rewritten in place, so
+# this also bounds how stale such a file can be.
+MANIFEST_CACHE_TTL = int(os.getenv('MANIFEST_CACHE_TTL', 600))
+# Trees with more files than this are walked every time instead of cached
+MANIFEST_CACHE_MAX_FILES = int(os.getenv('MANIFEST_CACHE_MAX_FILES', 2000000))
+# Compressed manifest bytes decompressed at a time
+MANIFEST_CACHE_CHUNK = 1024 * 1024
+
+MANIFEST_KEY = 'manifest:{}:{}'         # host, root -> hash: signature, file_count, total_bytes, entries
+STATS_KEY = 'manifest_cache:stats'      # hits, misses, stale, stores, skipped, errors
+
+
+def host_id(ssh):
+    """host:port of a connection, as used in the cache keys"""
+    pool_key = getattr(ssh, 'pool_key', None)
+    if pool_key:
+        return f"{pool_key[0]}:{pool_key[1]}"
+    host, port = ssh.get_transport().getpeername()[:2]
+    return f"{host}:{port}"
+
+
+def tree_signature(ssh, root):
+    """
+    sha256 over the mtime of every directory under root, None if root does not exist.
+
+    Adding, removing or renaming a file anywhere in the tree changes the mtime of its
+    directory. Only directories are visited, so this is far cheaper than a full walk.
+    """
+    stdin, stdout, stderr = ssh.exec_command(
+        f"[ -d '{root}' ] && find '{root}' -type d -printf '%T@ %p\\0' | LC_ALL=C sort -z | sha256sum"
+    )
+    output = stdout.read().decode().strip()
+    return output.split()[0] if output else None
+
+
+def _count(stat):
+    try:
+        get_redis().hincrby(STATS_KEY, stat, 1)
+    except Exception:
+        pass
+
+
+def cache_stats():
+    """Counters of the cache across all workers, with the hit rate"""
+    stats = {key.decode(): int(value) for key, value in get_redis().hgetall(STATS_KEY).items()}
+    lookups = stats.get('hits', 0) + stats.get('misses', 0) + stats.get('stale', 0)
+    stats['hit_rate'] = round(stats.get('hits', 0) / lookups, 3) if lookups else None
+    return stats
+
+
+class Manifest:
+    """
+    Every regular file under root as (rel_path, size, mtime), sorted by path, from
+    the cache when the tree has not changed and from one RemoteWalk otherwise.
+
+    Iterate once. `file_count` and `total_bytes` are known up front on a cache hit
+    and once iteration ends on a miss. A hit reads the metadata and the compressed
+    entries in one transaction, so entries that expire or are invalidated after the
+    lookup cannot leave it short. A complete walk is stored for the next caller,
+    under the signature taken before the walk, so a tree that changes meanwhile is
+    not served from the cache later.
+    """
+
+    def __init__(self, ssh, root, missing_ok=False):
+        self.ssh = ssh
+        self.root = root.rstrip('/') or '/'
+        self.missing_ok = missing_ok
+        self.key = MANIFEST_KEY.format(host_id(ssh), self.root)
+        self.cached = None
+        self.signature = None
+        self.file_count = None
+        self.total_bytes = None
+        if MANIFEST_CACHE_TTL > 0:
+            self._lookup()
+
+    def _lookup(self):
+        try:
+            self.signature = tree_signature(self.ssh, self.root)
+            pipeline = get_redis().pipeline(transaction=True)
+            pipeline.hmget(self.key, ['signature', 'file_count', 'total_bytes'])
+            pipeline.get(f"{self.key}:entries")
+            meta, entries = pipeline.execute()
+        except Exception as e:
+            logger.error(f"Manifest cache unavailable: {str(e)}")
+            _count('errors')
+            # Walk without storing the result
+            self.signature = None
+            return
+        if meta[0] is None or entries is None:
+            _count('misses')
+        elif self.signature is None or meta[0].decode() != self.signature:
+            logger.info(f"Cached manifest of {self.root} is out of date")
+            _count('stale')
+        else:
+            self.cached = entries
+            self.file_count, self.total_bytes = int(meta[1]), int(meta[2])
+            logger.info(f"Manifest of {self.root} served from cache ({self.file_count} files)")
+            _count('hits')
+
+    def __iter__(self):
+        if self.cached is not None:
+            return self._from_cache()
+        return self._walk()
+
+    def _from_cache(self):
+        decompressor = zlib.decompressobj()
+        buffer = b''
+        count = 0
+        for offset in range(0, len(self.cached), MANIFEST_CACHE_CHUNK):
+            chunk = self.cached[offset:offset + MANIFEST_CACHE_CHUNK]
+            records = (buffer + decompressor.decompress(chunk)).split(b'\0')
+            buffer = records.pop()
+            for record in records:
+                path, size, mtime = record.decode().rsplit('\t', 2)
+                count += 1
+                yield path, int(size), int(mtime)
+        self.cached = None
+        # Callers copy, and sync prunes, by this list; never let a short one pass
+        if count != self.file_count:
+            logger.error(f"Cached manifest of {self.root} has {count} files instead of {self.file_count}")
+            _count('errors')
+            raise Exception(f"Cached manifest of {self.root} is incomplete: {count} of {self.file_count} files")
+
+    def _walk(self):
+        walk = RemoteWalk(self.ssh, self.root, relative=True, mtimes=True, sort=True, missing_ok=self.missing_ok)
+        compressor = zlib.compressobj()
+        parts = []
+        storing = MANIFEST_CACHE_TTL > 0 and self.signature is not None
+        for path, size, mtime in walk:
+            if storing:
+                if walk.file_count > MANIFEST_CACHE_MAX_FILES:
+                    storing = False
+                    parts = []
+                    _count('skipped')
+                else:
+                    parts.append(compressor.compress(f"{path}\t{size}\t{mtime}\0".encode()))
+            yield path, size, mtime
+        self.file_count, self.total_bytes = walk.file_count, walk.total_bytes
+        if storing:
+            parts.append(compressor.flush())
+            self._store(b''.join(parts))
+
+    def _store(self, entries):
+        try:
+            redis = get_redis()
+            pipeline = redis.pipeline()
+            pipeline.set(f"{self.key}:entries", entries, ex=MANIFEST_CACHE_TTL)
+            pipeline.hset(self.key, mapping={
+                'signature': self.signature,
+                'file_count': self.file_count,
+                'total_bytes': self.total_bytes,
+                'stored_at': int(time.time())
+            })
+            pipeline.expire(self.key, MANIFEST_CACHE_TTL)
+            pipeline.execute()
+            logger.info(f"Cached manifest of {self.root}: {self.file_count} files, {len(entries)} bytes compressed")
+            _count('stores')
+        except Exception as e:
+            logger.error(f"Could not cache manifest of {self.root}: {str(e)}")
+            _count('errors')
+
+
+def manifest_files(ssh, root):
+    """Yield (absolute path, size) for every file under root, through the cache"""
+    for path, size, _ in Manifest(ssh, root):
+        yield posixpath.join(root, path), size
+
+
+def cached_tree_size(ssh, root):
+    """
+    Total bytes of the regular files under root from the cache. A miss walks the tree
+    and caches it for the transfers that follow; with the cache off this is du -sb.
+    """
+    if MANIFEST_CACHE_TTL <= 0:
+        return get_tree_size(ssh, root)
+    manifest = Manifest(ssh, root)
+    if manifest.total_bytes is None:
+        for _ in manifest:
+            pass
+    return manifest.total_bytes
+
+
+def invalidate_manifests(ssh, root):
+    """
+    Drop every cached manifest of `root`, its subtrees and the trees containing it on
+    this host. Called after writing into a tree: a file rewritten in place does not
+    change any directory mtime.
+    """
+    if MANIFEST_CACHE_TTL <= 0:
+        return
+    root = root.rstrip('/') or '/'
+    try:
+        prefix = MANIFEST_KEY.format(host_id(ssh), '')
+        redis = get_redis()
+        for key in redis.scan_iter(match=f"{prefix}*"):
+            cached_root = key.decode()[len(prefix):]
+            if cached_root.endswith(':entries'):
+                continue
+            if (cached_root == root or cached_root.startswith(f"{root}/")
+                    or root.startswith(f"{cached_root.rstrip('/')}/")):
+                redis.delete(key, f"{key.decode()}:entries")
+    except Exception as e:
+        logger.error(f"Could not invalidate cached manifests of {root}: {str(e)}")
@@ -0,0 +1,122 @@
+import os
+import posixpath
+from app.logging.logger import logger
+from app.utils.integrity import verified_copy_pool, verify_tree, combined_digest
+from app.utils.progress_reporter import ProgressReporter
+from app.utils.range_transfer import RANGE_THRESHOLD, range_items, preallocate
+from app.utils.update_job_status import update_job_checksum
+from app.utils.bandwidth import job_limiter
+from app.utils.manifest_cache import Manifest
+
+# Number of SFTP sessions opened per host. They all share the host's single SSH
+# transport, so keep this below the server's MaxSessions (OpenSSH default: 10).
+SFTP_POOL_SIZE = int(os.getenv('SFTP_POOL_SIZE', 8))
+
+
+def list_files(ssh, root):
+    """Return ([(path, size), ...], total bytes) for every regular file under root, from the manifest cache or one streamed walk"""
+    manifest = Manifest(ssh, root)
+    files = [(posixpath.join(root, path), size) for path, size, _ in manifest]
+    return files, manifest.total_bytes
+
+
+def make_dest_dirs(dest_ssh, dirs):
+    """Create every directory in `dirs` on the destination with a single exec round trip"""
+    if not dirs:
+        return
+    channel = dest_ssh.get_transport().open_session()
+    try:
+        # Paths go over stdin NUL-separated, so neither ARG_MAX nor quoting is a concern
+        channel.exec_command("xargs -0 mkdir -p")
+        channel.sendall(memoryview('\0'.join(sorted(dirs)).encode()))
+        channel.shutdown_write()
+        if channel.recv_exit_status() != 0:
+            mkdir_error = channel.makefile_stderr('rb').read().decode()
+            logger.error(f"Error creating destination directories: {mkdir_error}")
+            raise Exception(f"Failed to create destination directories: {mkdir_error}")
+    finally:
+        channel.close()
+    logger.info(f"Created {len(dirs)} destination directories")
+
+
+def transfer_files(source_ssh, dest_ssh, files, source_root, dest_root, pool_size=SFTP_POOL_SIZE, on_chunk=None):
+    """
+    Copy many files concurrently over a pool of SFTP sessions on each host.
+
+    `files` is a list of (source_path, size). Files of RANGE_THRESHOLD bytes or more
+    are split into byte ranges that share the same pool, so one huge file does not
+    leave the other sessions idle once the small files are done.
+    `on_chunk(n)` is called from the worker threads and must be thread-safe.
+    Every file is verified on the destination; returns their digests.
+    """
+    items = []
+    ranged = []
+    dest_dirs = {dest_root}
+    for source_file, size in files:
+        rel_path = posixpath.relpath(source_file, source_root)
+        dest_file = posixpath.join(dest_root, rel_path)
+        dest_dirs.add(posixpath.dirname(dest_file))
+        if size >= RANGE_THRESHOLD:
+            ranged.append((dest_file, size))
+            items.extend(range_items(source_file, dest_file, size, pool_size))
+        else:
+            items.append((source_file, dest_file, size, 0, None))
+
+    make_dest_dirs(dest_ssh, dest_dirs)
+
+    if ranged:
+        dest_sftp = dest_ssh.open_sftp()
+        try:
+            for dest_file, size in ranged:
+                preallocate(dest_sftp, dest_file, size)
+        finally:
+            dest_sftp.close()
+
+    logger.info(f"Transferring {len(files)} files ({len(ranged)} split into ranges) "
+                f"over {min(pool_size, len(items))} SFTP sessions per host")
+    digests = verified_copy_pool(source_ssh, dest_ssh, items, pool_size, on_chunk)
+    logger.info("All files transferred successfully")
+    return digests
+
+
+def verify_tree_copy(source_ssh, dest_ssh, source_root, dest_root, job_id):
+    """
+    Manifest verification: compare every file of the two trees by sha256, copy the
+    ones that differ again, and record the manifest digest on the job.
+    """
+    manifest_digest, differing = verify_tree(source_ssh, dest_ssh, source_root, dest_root)
+    if differing:
+        logger.error(f"{len(differing)} files differ from the source; copying them again")
+        source_sftp = source_ssh.open_sftp()
+        try:
+            files = [
+                (posixpath.join(source_root, path), source_sftp.stat(posixpath.join(source_root, path)).st_size)
+                for path in differing
+            ]
+        finally:
+            source_sftp.close()
+        transfer_files(source_ssh, dest_ssh, files, source_root, dest_root)
+        manifest_digest, differing = verify_tree(source_ssh, dest_ssh, source_root, dest_root)
+        if differing:
+            logger.error(f"Files still differ after copying again: {differing[:10]}")
+            raise Exception(f"Manifest verification failed for {len(differing)} files: {differing[:10]}")
+    logger.info(f"Manifest verification passed: {manifest_digest}")
+    update_job_checksum(job_id, manifest_digest)
+
+
+def files_transfer(task, transfer_data, source_ssh, dest_ssh):
+    """Files mode: copy the tree file by file over pooled SFTP sessions, no tar involved"""
+    source = transfer_data['source_storage']
+    dest = transfer_data['dest_storage']
+
+    files, total_bytes = list_files(source_ssh, source)
+    logger.info(f"Found {len(files)} files to transfer ({total_bytes} bytes)")
+
+    progress = ProgressReporter(task, transfer_data, total_bytes)
+    on_chunk = job_limiter(transfer_data).wrap(progress.add)
+    digests = transfer_files(source_ssh, dest_ssh, files, source, dest, on_chunk=on_chunk)
+    progress.flush()
+    update_job_checksum(transfer_data['job_id'], combined_digest(digests))
+
+    if transfer_data.get('verify_manifest'):
+        verify_tree_copy(source_ssh, dest_ssh, source, dest, transfer_data['job_id'])
@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+from app.database.models.models import JobStatus
+from app.utils.job_control import StopCheck
+from app.utils.job_events import send_job_event, PROGRESS_EVENT
+
+# Publish at most every PROGRESS_INTERVAL_MS, or as soon as PROGRESS_MIN_BYTES more
+# bytes have moved, whichever comes first.
+PROGRESS_INTERVAL_MS = int(os.getenv('PROGRESS_INTERVAL_MS', 1000))
+PROGRESS_MIN_BYTES = int(os.getenv('PROGRESS_MIN_BYTES', 64 * 1024 * 1024))
+
+# Weight of the newest rate sample in the exponential moving average (0..1)
+RATE_SMOOTHING = 0.3
+
+
+class ProgressReporter:
+    """
+    Coalesces byte counts from a copy loop into rate-limited Celery state updates.
+
+    The copy loop calls `add(n)` (or `update(bytes_done)` when it only knows an absolute
+    position) as often as it likes; the reporter decides when an update is worth a
+    Redis write. Safe to feed from several threads. Both raise TransferStopped once
+    the job has been paused or cancelled, which stops the copy loop feeding them.
+    """
+
+    def __init__(self, task, transfer_data, total_bytes,
+                 interval_ms=PROGRESS_INTERVAL_MS, min_bytes=PROGRESS_MIN_BYTES, smoothing=RATE_SMOOTHING):
+        self.task = task
+        # task.request is thread-local and empty in the copy threads that call add()
+        self.task_id = task.request.id
+        self.job_id = transfer_data['job_id']
+        self.user_id = transfer_data['user_id']
+        self.total_bytes = total_bytes
+        self.interval = interval_ms / 1000
+        self.min_bytes = min_bytes
+        self.smoothing = smoothing
+
+        self.bytes_done = 0
+        self.rate = 0.0  # smoothed bytes per second
+        self.start_time = time.monotonic()
+        self._last_publish_time = self.start_time
+        self._last_publish_bytes = 0
+        self._lock = threading.Lock()
+        self.check_stop = StopCheck(self.job_id)
+
+    def add(self, nbytes):
+        """Record `nbytes` more bytes transferred"""
+        self.check_stop()
+        with self._lock:
+            self.bytes_done += nbytes
+            self._maybe_publish()
+
+    def update(self, bytes_done):
+        """Record an absolute position; never moves progress backwards"""
+        self.check_stop()
+        with self._lock:
+            if bytes_done > self.bytes_done:
+                self.bytes_done = bytes_done
+                self._maybe_publish()
+
+    def flush(self):
+        """Publish the current state regardless of the rate limit"""
+        with self._lock:
+            self._publish(time.monotonic())
+
+    @property
+    def percent(self):
+        if not self.total_bytes:
+            return 0
+        return min(int((self.bytes_done / self.total_bytes) * 100), 100)
+
+    @property
+    def eta(self):
+        """Estimated seconds remaining at the smoothed rate"""
+        if self.rate <= 0:
+            return None
+        remaining_bytes = max(self.total_bytes - self.bytes_done, 0)
+        return int(remaining_bytes / self.rate)
+
+    def meta(self):
+        return {
+            'job_id': self.job_id,
+            'task_id': self.task_id,
+            'user_id': self.user_id,
+            'current': self.bytes_done,
+            'total': self.total_bytes,
+            'status': JobStatus.IN_PROGRESS,
+            'percent': self.percent,
+            'rate': int(self.rate),
+            'eta': self.eta
+        }
+
+    def _maybe_publish(self):
+        now = time.monotonic()
+        if (now - self._last_publish_time < self.interval
+                and self.bytes_done - self._last_publish_bytes < self.min_bytes):
+            return
+        self._publish(now)
+
+    def _publish(self, now):
+        elapsed = now - self._last_publish_time
+        if elapsed > 0:
+            sample = (self.bytes_done - self._last_publish_bytes) / elapsed
+            if self.rate == 0:
+                self.rate = sample
+            else:
+                self.rate = self.smoothing * sample + (1 - self.smoothing) * self.rate
+        self._last_publish_time = now
+        self._last_publish_bytes = self.bytes_done
+        self._send()
+
+    def _send(self):
+        meta = self.meta()
+        self.task.update_state(task_id=self.task_id, state=JobStatus.IN_PROGRESS, meta=meta)
+        # The API processes' job monitors push it to the owner's sockets
+        send_job_event(PROGRESS_EVENT, uuid=self.task_id, **meta)
@@ -0,0 +1,59 @@
+import os
+from app.logging.logger import logger
+from app.utils.integrity import verified_copy_pool
+
+# Files at least this big are split into byte ranges copied in parallel
+RANGE_THRESHOLD = int(os.getenv('RANGE_THRESHOLD', 1024 * 1024 * 1024))
+# Parallel SFTP streams used for a single large file
+RANGE_STREAMS = int(os.getenv('RANGE_STREAMS', 4))
+# Don't bother splitting below this; per-range setup would outweigh the gain
+MIN_RANGE_SIZE = 64 * 1024 * 1024
+
+
+def split_ranges(size, parts):
+    """Split `size` bytes into at most `parts` contiguous (offset, length) ranges"""
+    if size <= 0:
+        return [(0, 0)]
+    parts = max(1, min(parts, size // MIN_RANGE_SIZE))
+    step = -(-size // parts)  # ceil division
+    return [(offset, min(step, size - offset)) for offset in range(0, size, step)]
+
+
+def preallocate(dest_sftp, dest_path, size):
+    """Create dest_path at its final size so ranges can be written into it in place"""
+    with dest_sftp.file(dest_path, 'wb') as dfh:
+        dfh.truncate(size)
+
+
+def range_items(source_path, dest_path, size, parts):
+    """Copy-pool work items for one file split into byte ranges"""
+    return [
+        (source_path, dest_path, size, offset, length)
+        for offset, length in split_ranges(size, parts)
+    ]
+
+
+def copy_file_ranges(source_ssh, dest_ssh, source_path, dest_path, size, streams=RANGE_STREAMS, on_chunk=None,
+                     items=None, checkpointers=None):
+    """
+    Copy one large file as parallel byte ranges over `streams` SFTP channels per host.
+
+    Every range reads its slice with offset reads and writes it at the same offset of
+    the preallocated destination file, so the file is reassembled in place with no
+    join step. `on_chunk(n)` receives the progress of every range.
+    Pass `items` (and their `checkpointers`) to continue ranges from a previous
+    attempt; the destination file is then reused rather than preallocated.
+    Every range is verified on the destination; returns their digests.
+    """
+    if items is None:
+        items = range_items(source_path, dest_path, size, streams)
+        dest_sftp = dest_ssh.open_sftp()
+        try:
+            preallocate(dest_sftp, dest_path, size)
+        finally:
+            dest_sftp.close()
+    logger.info(f"Copying {source_path} as {len(items)} parallel ranges")
+
+    digests = verified_copy_pool(source_ssh, dest_ssh, items, len(items), on_chunk, checkpointers)
+    logger.info(f"Ranged copy of {source_path} completed")
+    return digests
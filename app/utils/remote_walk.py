@@ -0,0 +1,83 @@
+from app.logging.logger import logger
+
+# How much of a listing to pull off the channel per read
+WALK_CHUNK_SIZE = 262144
+
+
+class RemoteWalk:
+    """
+    A single streamed `find -printf` over a remote tree.
+
+    Iterating yields (path, size), or (path, size, mtime) with `mtimes`, for every
+    regular file as find reports it, parsed from NUL-separated records as they come
+    off the channel, so neither the listing nor its text is ever held whole. The
+    running `file_count` and `total_bytes` are final once iteration ends, which lets
+    one walk feed both the plan (the entries) and the progress total.
+
+    `relative` yields paths relative to root; `sort` has the remote host sort the
+    listing by path (sort spills to disk on huge trees); with `missing_ok` a root
+    that does not exist is an empty tree instead of an error.
+    """
+
+    def __init__(self, ssh, root, relative=False, mtimes=False, sort=False, missing_ok=False):
+        self.ssh = ssh
+        self.root = root
+        self.mtimes = mtimes
+        self.sort = sort
+        self.file_count = 0
+        self.total_bytes = 0
+
+        path_format = '%P' if relative else '%p'
+        record_format = f"{path_format}\\t%s\\t%T@\\0" if mtimes else f"{path_format}\\t%s\\0"
+        self.command = f"find '{root}' -type f -printf '{record_format}'"
+        if sort:
+            self.command += " | LC_ALL=C sort -z"
+        if missing_ok:
+            self.command = f"[ ! -d '{root}' ] || {self.command}"
+
+    def __iter__(self):
+        logger.info(f"Walking remote tree with command: {self.command}")
+        channel = self.ssh.get_transport().open_session()
+        errors = []
+        try:
+            channel.exec_command(self.command)
+            buffer = b''
+            previous = None
+            while True:
+                data = channel.recv(WALK_CHUNK_SIZE)
+                if not data:
+                    break
+                # Keep stderr drained so a flood of permission errors cannot stall the walk
+                while channel.recv_stderr_ready():
+                    errors.append(channel.recv_stderr(WALK_CHUNK_SIZE))
+                records = (buffer + data).split(b'\0')
+                buffer = records.pop()
+                for record in records:
+                    entry = self._parse(record)
+                    # Merges over two sorted walks rely on both using the same order
+                    if self.sort:
+                        if previous is not None and entry[0] <= previous:
+                            raise Exception(f"Listing of {self.root} is not sorted at {entry[0]}")
+                        previous = entry[0]
+                    self.file_count += 1
+                    self.total_bytes += entry[1]
+                    yield entry
+
+            channel.recv_exit_status()
+            while channel.recv_stderr_ready():
+                errors.append(channel.recv_stderr(WALK_CHUNK_SIZE))
+            walk_error = b''.join(errors).decode(errors='replace').strip()
+            if walk_error:
+                logger.error(f"Remote walk error: {walk_error}")
+                raise Exception(f"Failed to list {self.root}: {walk_error}")
+            logger.info(f"Walked {self.root}: {self.file_count} files, {self.total_bytes} bytes")
+        finally:
+            channel.close()
+
+    def _parse(self, record):
+        # Split from the right: file names may contain tabs (and, NUL-separated, newlines)
+        if self.mtimes:
+            path, size, mtime = record.decode().rsplit('\t', 2)
+            return path, int(size), int(float(mtime))
+        path, size = record.decode().rsplit('\t', 1)
+        return path, int(size)
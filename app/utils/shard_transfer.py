@@ -0,0 +1,198 @@
+import heapq
+import json
+import math
+import os
+import posixpath
+from sqlalchemy.orm import Session
+from app.db_setup import engine
+from app.database.models.models import TransferShard
+from app.logging.logger import logger
+from app.utils.compression import resolve_codec, tar_flags
+from app.utils.integrity import run_parallel
+from app.utils.multi_file_transfer import transfer_files, verify_tree_copy, SFTP_POOL_SIZE
+from app.utils.progress_reporter import ProgressReporter
+from app.utils.stream_transfer import stream_tar_relay, TAR_CHECKPOINT_FLAGS
+from app.utils.bandwidth import job_limiter
+from app.utils.manifest_cache import manifest_files
+from app.utils.job_control import tracked
+
+# Files at least this big are sent on their own over SFTP; everything smaller goes into tar shards
+SHARD_LARGE_FILE = int(os.getenv('SHARD_LARGE_FILE', 64 * 1024 * 1024))
+# Rough size of one tar shard, and the most files one may hold
+SHARD_TARGET_BYTES = int(os.getenv('SHARD_TARGET_BYTES', 512 * 1024 * 1024))
+SHARD_MAX_FILES = int(os.getenv('SHARD_MAX_FILES', 50000))
+# What one file costs on top of its bytes when balancing shards (open, stat, tar
+# header, create on the destination), expressed in bytes
+SHARD_FILE_COST = int(os.getenv('SHARD_FILE_COST', 64 * 1024))
+# Shards in flight at once. A large-file shard uses SFTP_POOL_SIZE // SHARD_STREAMS
+# SFTP sessions per host, a tar shard one exec channel, so the total stays under MaxSessions.
+SHARD_STREAMS = int(os.getenv('SHARD_STREAMS', 4))
+
+
+def plan_shards(files, source_root):
+    """
+    Split [(path, size), ...] under source_root into shards.
+
+    Files of SHARD_LARGE_FILE bytes or more become one 'file' shard each. The rest
+    are bin-packed into 'tar' shards of roughly equal cost (bytes plus SHARD_FILE_COST
+    per file), largest file first onto the lightest shard, so a shard of big files
+    and one of many tiny files take about as long. Returns a list of shard dicts,
+    largest first.
+    """
+    shards = []
+    small = []
+    for path, size in files:
+        rel_path = posixpath.relpath(path, source_root)
+        if size >= SHARD_LARGE_FILE:
+            shards.append({'kind': 'file', 'paths': [rel_path], 'file_count': 1, 'total_bytes': size})
+        else:
+            small.append((size, rel_path))
+
+    if small:
+        total_cost = sum(size + SHARD_FILE_COST for size, _ in small)
+        shard_count = max(math.ceil(total_cost / SHARD_TARGET_BYTES), math.ceil(len(small) / SHARD_MAX_FILES), 1)
+        bins = [{'kind': 'tar', 'paths': [], 'file_count': 0, 'total_bytes': 0} for _ in range(shard_count)]
+        lightest = [(0, i) for i in range(shard_count)]
+        small.sort(reverse=True)
+        for size, rel_path in small:
+            cost, i = heapq.heappop(lightest)
+            bins[i]['paths'].append(rel_path)
+            bins[i]['file_count'] += 1
+            bins[i]['total_bytes'] += size
+            heapq.heappush(lightest, (cost + size + SHARD_FILE_COST, i))
+        for shard in bins:
+            # Path order keeps tar walking each directory once
+            shard['paths'].sort()
+        shards.extend(bins)
+
+    shards.sort(key=lambda shard: shard['total_bytes'], reverse=True)
+    for index, shard in enumerate(shards):
+        shard['shard_index'] = index
+        shard['completed'] = False
+    return shards
+
+
+def save_plan(job_id, shards):
+    with Session(engine) as db:
+        db.query(TransferShard).filter(TransferShard.job_id == job_id).delete()
+        for shard in shards:
+            db.add(TransferShard(
+                job_id=job_id,
+                shard_index=shard['shard_index'],
+                kind=shard['kind'],
+                file_count=shard['file_count'],
+                total_bytes=shard['total_bytes'],
+                paths=json.dumps(shard['paths']),
+                completed=False
+            ))
+        db.commit()
+
+
+def load_plan(job_id, with_paths=True):
+    """The job's stored plan as a list of shard dicts in shard order ([] if it has none)"""
+    with Session(engine) as db:
+        rows = db.query(TransferShard).filter(TransferShard.job_id == job_id).order_by(TransferShard.shard_index).all()
+        plan = []
+        for row in rows:
+            shard = {
+                'shard_index': row.shard_index,
+                'kind': row.kind,
+                'file_count': row.file_count,
+                'total_bytes': row.total_bytes,
+                'completed': row.completed
+            }
+            if with_paths:
+                shard['paths'] = json.loads(row.paths)
+            plan.append(shard)
+        return plan
+
+
+def mark_shard_completed(job_id, shard_index):
+    with Session(engine) as db:
+        db.query(TransferShard).filter(
+            TransferShard.job_id == job_id,
+            TransferShard.shard_index == shard_index
+        ).update({TransferShard.completed: True})
+        db.commit()
+
+
+def send_tar_shard(source_ssh, dest_ssh, source, dest, shard, flags, job_id, on_progress=None, on_chunk=None):
+    """Relay one tar shard: tar reads its file list from stdin on the source and extracts under dest"""
+    pack_command = tracked(f"tar -c {flags} {TAR_CHECKPOINT_FLAGS} -f - -C '{source}' --null -T -", job_id)
+    unpack_command = tracked(f"mkdir -p '{dest}' && tar -x {flags} -f - -C '{dest}'", job_id)
+    # ./ keeps names that start with a dash from being read as options
+    file_list = b''.join(f"./{path}\0".encode() for path in shard['paths'])
+    stream_tar_relay(source_ssh, dest_ssh, pack_command, unpack_command, on_progress, on_chunk,
+                     pack_input=file_list)
+
+
+def get_or_plan(job_id, source_ssh, source):
+    """The job's stored plan, or a new one planned from the source listing and stored"""
+    plan = load_plan(job_id)
+    if plan:
+        logger.info(f"Resuming stored plan of {len(plan)} shards")
+        return plan
+    # The planner consumes the listing as it streams in, from the cache or the walk
+    plan = plan_shards(manifest_files(source_ssh, source), source)
+    save_plan(job_id, plan)
+    tar_count = sum(1 for shard in plan if shard['kind'] == 'tar')
+    logger.info(f"Planned {len(plan)} shards: {tar_count} tar batches and {len(plan) - tar_count} large files")
+    return plan
+
+
+def send_shards(transfer_data, source_ssh, dest_ssh, shards, progress):
+    """
+    Send `shards` (from the plan), SHARD_STREAMS at a time, largest first, marking each
+    one completed on the job as it lands. Progress goes to `progress.add`.
+    """
+    source = transfer_data['source_storage']
+    dest = transfer_data['dest_storage']
+    job_id = transfer_data['job_id']
+    codec, level = resolve_codec(transfer_data, source_ssh, dest_ssh)
+    flags = tar_flags(codec, level)
+    limiter = job_limiter(transfer_data)
+    file_pool_size = max(1, SFTP_POOL_SIZE // SHARD_STREAMS)
+
+    def send(shard):
+        if shard['kind'] == 'file':
+            rel_path = shard['paths'][0]
+            transfer_files(source_ssh, dest_ssh, [(posixpath.join(source, rel_path), shard['total_bytes'])],
+                           source, dest, pool_size=file_pool_size, on_chunk=limiter.wrap(progress.add))
+        else:
+            # Checkpoints report how far this shard's tar has got; turn them into increments
+            reported = [0]
+
+            def on_progress(bytes_done):
+                bytes_done = min(bytes_done, shard['total_bytes'])
+                if bytes_done > reported[0]:
+                    progress.add(bytes_done - reported[0])
+                    reported[0] = bytes_done
+
+            send_tar_shard(source_ssh, dest_ssh, source, dest, shard, flags, job_id, on_progress, limiter.consume)
+            progress.add(shard['total_bytes'] - reported[0])
+        mark_shard_completed(job_id, shard['shard_index'])
+
+    run_parallel(send, sorted(shards, key=lambda shard: shard['total_bytes'], reverse=True), SHARD_STREAMS)
+
+
+def sharded_transfer(task, transfer_data, source_ssh, dest_ssh):
+    """
+    Sharded mode: plan the tree into balanced tar shards of small files plus one shard
+    per large file, and send SHARD_STREAMS shards at a time.
+
+    The plan is stored with the job (TransferShard) and every shard is marked once it
+    has landed, so a retried or resumed job only sends the shards still outstanding.
+    """
+    plan = get_or_plan(transfer_data['job_id'], source_ssh, transfer_data['source_storage'])
+    pending = [shard for shard in plan if not shard['completed']]
+    total_bytes = sum(shard['total_bytes'] for shard in pending)
+    logger.info(f"Sending {len(pending)} of {len(plan)} shards ({total_bytes} bytes)")
+
+    progress = ProgressReporter(task, transfer_data, total_bytes)
+    send_shards(transfer_data, source_ssh, dest_ssh, pending, progress)
+    progress.flush()
+    logger.info("All shards transferred")
+
+    if transfer_data.get('verify_manifest'):
+        verify_tree_copy(source_ssh, dest_ssh, transfer_data['source_storage'], transfer_data['dest_storage'],
+                         transfer_data['job_id'])
@@ -0,0 +1,155 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+import paramiko
+from app.logging.logger import logger
+
+# Idle connections older than this are closed instead of reused (seconds)
+SSH_POOL_IDLE_TIMEOUT = int(os.getenv('SSH_POOL_IDLE_TIMEOUT', 300))
+# Idle connections kept per host/user; any more are closed on release
+SSH_POOL_MAX_IDLE = int(os.getenv('SSH_POOL_MAX_IDLE', 4))
+# SSH keepalive interval for pooled transports, so idle NAT/firewall state survives (seconds)
+SSH_KEEPALIVE_INTERVAL = int(os.getenv('SSH_KEEPALIVE_INTERVAL', 30))
+
+
+class SSHConnectionPool:
+    """
+    Process-wide pool of authenticated SSH connections, keyed by (host, port, user).
+
+    `acquire` hands out an SSHClient for exclusive use: the caller opens channels
+    (exec_command / get_transport().open_session()) and SFTP sessions on it as usual,
+    and gives it back with `release` when the job is done. Released connections stay
+    open with keepalives and are reused by the next job for the same host, which
+    skips the TCP connect, key exchange and authentication. Connections that have
+    died or sat idle for SSH_POOL_IDLE_TIMEOUT are evicted. Private keys are parsed
+    once per file and reloaded only when the file changes.
+    """
+
+    def __init__(self, idle_timeout=SSH_POOL_IDLE_TIMEOUT, max_idle=SSH_POOL_MAX_IDLE,
+                 keepalive=SSH_KEEPALIVE_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.keepalive = keepalive
+        self._idle = {}  # (host, port, user) -> [(client, released_at), ...]
+        self._keys = {}  # identity file -> (mtime, key)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'key_loads': 0}
+
+    def load_key(self, identity_file):
+        identity_file = str(identity_file)
+        mtime = os.path.getmtime(identity_file)
+        with self._lock:
+            cached = self._keys.get(identity_file)
+            if cached and cached[0] == mtime:
+                return cached[1]
+        logger.info(f"Loading private key from: {identity_file}")
+        key = paramiko.RSAKey(filename=identity_file)
+        with self._lock:
+            self._keys[identity_file] = (mtime, key)
+            self._stats['key_loads'] += 1
+        return key
+
+    def acquire(self, host, user, identity_file, port=22):
+        """Return a connected SSHClient for host, reusing an idle one when possible"""
+        pool_key = (host, port, user)
+        with self._lock:
+            self._evict_expired()
+            idle = self._idle.get(pool_key, [])
+            while idle:
+                client, _ = idle.pop()
+                if self._is_alive(client):
+                    self._stats['hits'] += 1
+                    logger.info(f"Reusing pooled SSH connection to {user}@{host}")
+                    return client
+                self._stats['evictions'] += 1
+                client.close()
+            self._stats['misses'] += 1
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        logger.info(f"Opening SSH connection to {user}@{host}")
+        client.connect(host, port=port, username=user, pkey=self.load_key(identity_file))
+        client.get_transport().set_keepalive(self.keepalive)
+        client.pool_key = pool_key
+        return client
+
+    def release(self, client, discard=False):
+        """
+        Give a client back to the pool. Dead ones, any beyond SSH_POOL_MAX_IDLE, and
+        ones released with `discard` (e.g. after a failed job) are closed instead.
+        """
+        pool_key = getattr(client, 'pool_key', None)
+        with self._lock:
+            idle = self._idle.setdefault(pool_key, []) if pool_key else None
+            if discard or idle is None or not self._is_alive(client) or len(idle) >= self.max_idle:
+                self._stats['evictions'] += 1
+                client.close()
+                return
+            idle.append((client, time.monotonic()))
+
+    @contextmanager
+    def connection(self, host, user, identity_file, port=22):
+        client = self.acquire(host, user, identity_file, port)
+        try:
+            yield client
+        except Exception:
+            self.release(client, discard=True)
+            raise
+        self.release(client)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, idle=sum(len(idle) for idle in self._idle.values()))
+
+    def close_all(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for client, _ in idle:
+                    client.close()
+            self._idle.clear()
+
+    def _evict_expired(self):
+        # Caller holds the lock
+        cutoff = time.monotonic() - self.idle_timeout
+        for pool_key, idle in self._idle.items():
+            keep = []
+            for client, released_at in idle:
+                if released_at >= cutoff and self._is_alive(client):
+                    keep.append((client, released_at))
+                else:
+                    self._stats['evictions'] += 1
+                    client.close()
+            self._idle[pool_key] = keep
+
+    @staticmethod
+    def _is_alive(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active() and transport.is_authenticated()
+
+
+# One pool per worker process
+ssh_pool = SSHConnectionPool()
+
+
+def connect_servers(server_configs, identity_file):
+    """Get SSH connections to the source (pisms) and destination (pimaster) servers from the pool"""
+    source_server = server_configs['pisms']
+    dest_server = server_configs['pimaster']
+    source_ssh = ssh_pool.acquire(source_server['host'], source_server['user'], identity_file,
+                                  source_server.get('port', 22))
+    try:
+        dest_ssh = ssh_pool.acquire(dest_server['host'], dest_server['user'], identity_file,
+                                    dest_server.get('port', 22))
+    except Exception:
+        ssh_pool.release(source_ssh)
+        raise
+    logger.info("Connected to source and destination servers")
+    return source_ssh, dest_ssh
+
+
+def release_servers(*clients, discard=False):
+    """Hand connections from connect_servers back to the pool (or close them, with `discard`)"""
+    for client in clients:
+        ssh_pool.release(client, discard)
+    logger.info(f"SSH connections returned to the pool: {ssh_pool.stats()}")
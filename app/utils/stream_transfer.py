@@ -0,0 +1,193 @@
+import os
+import re
+import threading
+from app.logging.logger import logger
+
+# How much to pull off the source tar channel per read
+STREAM_CHUNK_SIZE = 131072
+
+# tar reports a checkpoint on stderr every TAR_CHECKPOINT records it writes, tagged
+# with the number of records written so far. Records are 10 KiB of *uncompressed*
+# tar data, so that number tells us how far into the source tree tar has got,
+# whatever the compression ratio.
+TAR_RECORD_SIZE = 10240
+TAR_CHECKPOINT = 100
+TAR_CHECKPOINT_FLAGS = f"--checkpoint={TAR_CHECKPOINT} --checkpoint-action=echo='#%u'"
+# GNU tar prefixes the echo with its program name, as in "tar: #100"
+CHECKPOINT_PATTERN = re.compile(r'(?:\S+: )?#(\d+)')
+
+# ssh options the source host uses to reach the destination in direct mode. BatchMode
+# makes it fail fast instead of prompting when it has no usable key.
+DIRECT_CONNECT_TIMEOUT = int(os.getenv('DIRECT_CONNECT_TIMEOUT', 10))
+DIRECT_SSH_OPTIONS = os.getenv(
+    'DIRECT_SSH_OPTIONS',
+    f"-o BatchMode=yes -o StrictHostKeyChecking=accept-new -o ConnectTimeout={DIRECT_CONNECT_TIMEOUT}"
+)
+
+
+def get_tree_size(ssh, path):
+    """Return the total size in bytes of a remote directory tree (du -sb)"""
+    size_command = f"du -sb '{path}'"
+    logger.info(f"Getting total size with command: {size_command}")
+    stdin, stdout, stderr = ssh.exec_command(size_command)
+    size_output = stdout.read().decode().strip()
+    size_error = stderr.read().decode()
+    if not size_output:
+        logger.error(f"Error getting tree size: {size_error}")
+        raise Exception(f"Failed to get tree size: {size_error or 'empty output'}")
+    return int(size_output.split()[0])
+
+
+def stream_tar_relay(source_ssh, dest_ssh, pack_command, unpack_command, on_progress=None, on_chunk=None,
+                     pack_input=None):
+    """
+    Relay a tar stream from the source host straight into tar on the destination host.
+
+    The source runs `pack_command` (tar -c ... to stdout, with TAR_CHECKPOINT_FLAGS)
+    and the destination runs `unpack_command` (tar -x ... from stdin). The worker only
+    moves the bytes in between, so packing, transfer and unpacking all run at the same
+    time and no archive is ever written to either storage.
+
+    `on_progress(bytes_done)` is called with the number of uncompressed tar bytes the
+    source has produced so far, as reported by the tar checkpoints, and `on_chunk(n)`
+    with the size of every chunk relayed. `pack_input` (bytes), if given, is fed to
+    the pack command's stdin, e.g. a file list for tar -T -.
+    Returns the number of (possibly compressed) bytes relayed.
+    """
+    source_channel = source_ssh.get_transport().open_session()
+    dest_channel = dest_ssh.get_transport().open_session()
+    source_errors = []
+    try:
+        logger.info(f"Starting unpack on destination with command: {unpack_command}")
+        dest_channel.exec_command(unpack_command)
+        logger.info(f"Starting pack on source with command: {pack_command}")
+        source_channel.exec_command(pack_command)
+        if pack_input is not None:
+            # Feed stdin from its own thread: tar starts writing before it has read the
+            # whole list, and its output has to be drained meanwhile
+            feeder = threading.Thread(target=_feed_stdin, args=(source_channel, pack_input),
+                                      name="tar-stdin", daemon=True)
+            feeder.start()
+
+        bytes_relayed = 0
+        while True:
+            data = source_channel.recv(STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            # sendall re-slices what is left after every window-sized send; slicing a
+            # memoryview is free where slicing bytes copies the remainder each time
+            dest_channel.sendall(memoryview(data))
+            bytes_relayed += len(data)
+            if on_chunk:
+                on_chunk(len(data))
+
+            # Drain checkpoints as we go so stderr never fills its window
+            if source_channel.recv_stderr_ready():
+                _parse_stderr(source_channel, source_errors, on_progress)
+
+        # Signal EOF so tar on the destination can finish
+        dest_channel.shutdown_write()
+
+        source_status = source_channel.recv_exit_status()
+        dest_status = dest_channel.recv_exit_status()
+        _parse_stderr(source_channel, source_errors, on_progress)
+        if source_status != 0:
+            error = '\n'.join(source_errors)
+            logger.error(f"Pack command error ({source_status}): {error}")
+            raise Exception(f"Failed to create tar stream: {error}")
+        if dest_status != 0:
+            error = _read_stderr(dest_channel)
+            logger.error(f"Unpack command error ({dest_status}): {error}")
+            raise Exception(f"Failed to extract tar stream: {error}")
+
+        logger.info(f"Tar stream relayed: {bytes_relayed} bytes")
+        return bytes_relayed
+    finally:
+        source_channel.close()
+        dest_channel.close()
+
+
+def _feed_stdin(channel, data):
+    try:
+        channel.sendall(memoryview(data))
+        channel.shutdown_write()
+    except Exception as e:
+        # The pack command failing early closes the channel; its exit status reports it
+        logger.error(f"Error feeding pack command input: {str(e)}")
+
+
+def _parse_stderr(channel, errors, on_progress):
+    """Split tar's stderr into checkpoint progress and real error lines"""
+    for line in _read_stderr(channel).splitlines():
+        match = CHECKPOINT_PATTERN.fullmatch(line.strip())
+        if match:
+            if on_progress:
+                on_progress(int(match.group(1)) * TAR_RECORD_SIZE)
+        elif line.strip():
+            errors.append(line)
+
+
+def _read_stderr(channel):
+    """Collect whatever the remote command has written to stderr so far"""
+    chunks = []
+    while channel.recv_stderr_ready():
+        chunks.append(channel.recv_stderr(STREAM_CHUNK_SIZE))
+    return b''.join(chunks).decode(errors='replace').strip()
+
+
+def direct_ssh_command(user, host, port=22):
+    """The ssh invocation the source host uses to reach the destination"""
+    return f"ssh {DIRECT_SSH_OPTIONS} -p {port} {user}@{host}"
+
+
+def can_reach(source_ssh, user, host, port=22):
+    """True if the source host can open its own SSH session to the destination"""
+    probe = f"{direct_ssh_command(user, host, port)} true"
+    logger.info(f"Checking direct reachability with command: {probe}")
+    stdin, stdout, stderr = source_ssh.exec_command(probe)
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        logger.info(f"Source cannot reach {user}@{host} directly ({status}): {stderr.read().decode().strip()}")
+    return status == 0
+
+
+def remote_push(source_ssh, push_command, on_progress=None):
+    """
+    Run a pipeline on the source host that delivers the data to the destination by
+    itself (tar -c ... | ssh dest tar -x ...), so none of it passes through the worker.
+
+    Only stderr comes back: tar checkpoints are turned into `on_progress(bytes_done)`
+    calls as in stream_tar_relay, anything else is collected as errors.
+    """
+    channel = source_ssh.get_transport().open_session()
+    errors = []
+    try:
+        logger.info(f"Starting direct push on source with command: {push_command}")
+        channel.exec_command(push_command)
+        channel.shutdown_write()
+
+        pending = ''
+        while True:
+            data = channel.recv_stderr(STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            lines = (pending + data.decode(errors='replace')).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                match = CHECKPOINT_PATTERN.fullmatch(line.strip())
+                if match:
+                    if on_progress:
+                        on_progress(int(match.group(1)) * TAR_RECORD_SIZE)
+                elif line.strip():
+                    errors.append(line)
+        if pending.strip():
+            errors.append(pending)
+
+        status = channel.recv_exit_status()
+        if status != 0:
+            error = '\n'.join(errors)
+            logger.error(f"Direct push error ({status}): {error}")
+            raise Exception(f"Direct push failed: {error}")
+        logger.info("Direct push completed")
+    finally:
+        channel.close()
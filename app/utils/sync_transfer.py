@@ -0,0 +1,240 @@
+import posixpath
+import queue
+import threading
+from fastapi import HTTPException
+from celery import shared_task
+from app.database.models.models import JobStatus
+from app.utils.update_job_status import update_job_status
+from app.logging.logger import logger
+from app.utils.copy_engine import open_sftp_pool
+from app.utils.integrity import remote_hashes
+from app.utils.multi_file_transfer import transfer_files, SFTP_POOL_SIZE
+from app.utils.progress_reporter import ProgressReporter
+from app.utils.linux_paramiko_transfer import TRANSFER_MAX_RETRIES, TRANSFER_RETRY_DELAY
+from app.utils.ssh_pool import connect_servers, release_servers, ssh_pool
+from app.utils.bandwidth import job_limiter, pair_name
+from app.utils.job_slots import limit_concurrency
+from app.utils.remote_walk import RemoteWalk
+from app.utils.manifest_cache import invalidate_manifests
+from app.utils.job_control import TransferStopped, StopCheck, clean_up_stopped, record_stopped
+
+
+def iter_manifest(ssh, root, missing_ok=False):
+    """
+    Yield (rel_path, size, mtime) for every regular file under root, sorted by path.
+
+    One find on the remote host, sorted there and consumed as it streams in, so the
+    worker never holds a whole manifest in memory. With `missing_ok` a root that
+    does not exist yields an empty manifest instead of failing.
+    """
+    return iter(RemoteWalk(ssh, root, relative=True, mtimes=True, sort=True, missing_ok=missing_ok))
+
+
+def diff_manifests(source_manifest, dest_manifest):
+    """
+    Merge two path-sorted manifests and yield (action, entry) for every path.
+
+    action is 'new' (only on the source), 'deleted' (only on the destination),
+    'changed' (size differs), 'touched' (same size, different mtime) or 'same'.
+    entry is the source entry, or the destination one for 'deleted'. Only the
+    current entry of each side is held, whatever the size of the trees.
+    """
+    source_entries = iter(source_manifest)
+    dest_entries = iter(dest_manifest)
+    source = next(source_entries, None)
+    dest = next(dest_entries, None)
+    while source is not None or dest is not None:
+        if dest is None or (source is not None and source[0] < dest[0]):
+            yield 'new', source
+            source = next(source_entries, None)
+        elif source is None or dest[0] < source[0]:
+            yield 'deleted', dest
+            dest = next(dest_entries, None)
+        else:
+            if source[1] != dest[1]:
+                yield 'changed', source
+            elif source[2] != dest[2]:
+                yield 'touched', source
+            else:
+                yield 'same', source
+            source = next(source_entries, None)
+            dest = next(dest_entries, None)
+
+
+def set_mtimes(dest_ssh, dest_root, entries, pool_size=SFTP_POOL_SIZE):
+    """Give synced files their source mtime so the next sync sees them as unchanged"""
+    if not entries:
+        return
+    work = queue.Queue()
+    for entry in entries:
+        work.put(entry)
+
+    errors = []
+    pool = open_sftp_pool(dest_ssh, max(1, min(pool_size, len(entries))))
+
+    def worker(sftp):
+        while not errors:
+            try:
+                rel_path, mtime = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                sftp.utime(posixpath.join(dest_root, rel_path), (mtime, mtime))
+            except Exception as e:
+                logger.error(f"Error setting mtime of {rel_path}: {str(e)}")
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(sftp,), name=f"sftp-utime-{i}") for i, sftp in enumerate(pool)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for sftp in pool:
+            sftp.close()
+
+    if errors:
+        raise errors[0]
+
+
+def remove_dest_files(dest_ssh, dest_root, paths):
+    """Delete `paths` (relative to dest_root) on the destination with a single exec round trip"""
+    if not paths:
+        return
+    channel = dest_ssh.get_transport().open_session()
+    try:
+        channel.exec_command(f"cd '{dest_root}' && xargs -0 rm -f --")
+        channel.sendall(memoryview('\0'.join(paths).encode()))
+        channel.shutdown_write()
+        if channel.recv_exit_status() != 0:
+            rm_error = channel.makefile_stderr('rb').read().decode()
+            logger.error(f"Error pruning destination files: {rm_error}")
+            raise Exception(f"Failed to prune destination files: {rm_error}")
+    finally:
+        channel.close()
+    logger.info(f"Pruned {len(paths)} files from the destination")
+
+
+def sync_trees(task, transfer_data, source_ssh, dest_ssh):
+    """
+    Make dest_storage match source_storage, sending only new and changed files.
+
+    Files are compared by size and mtime. With `checksum` set in transfer_data, files
+    whose size matches but whose mtime differs are hashed on both hosts and only sent
+    if the contents differ. With `prune` set, files missing from the source are
+    deleted from the destination (directories are left in place). Both trees are
+    walked, never taken from the manifest cache: the cache does not notice a file
+    rewritten in place, which is exactly what a sync has to find.
+    Returns the number of files per diff action.
+    """
+    source = transfer_data['source_storage']
+    dest = transfer_data['dest_storage']
+    checksum = transfer_data.get('checksum', False)
+    prune = transfer_data.get('prune', False)
+
+    counts = {'new': 0, 'changed': 0, 'touched': 0, 'same': 0, 'deleted': 0}
+    to_send = []
+    touched = []
+    deleted = []
+    for action, (path, size, mtime) in diff_manifests(iter_manifest(source_ssh, source),
+                                                      iter_manifest(dest_ssh, dest, missing_ok=True)):
+        counts[action] += 1
+        if action in ('new', 'changed') or (action == 'touched' and not checksum):
+            to_send.append((path, size, mtime))
+        elif action == 'touched':
+            touched.append((path, size, mtime))
+        elif action == 'deleted':
+            deleted.append(path)
+    logger.info(f"Sync plan for {source} -> {dest}: {counts}")
+
+    # Same size, different mtime: only send the ones whose contents really differ,
+    # but fix the mtime of all of them so they are skipped next time
+    retimed = []
+    if touched:
+        paths = [path for path, _, _ in touched]
+        source_hashes = remote_hashes(source_ssh, source, paths)
+        dest_hashes = remote_hashes(dest_ssh, dest, paths)
+        for path, size, mtime in touched:
+            if path in source_hashes and source_hashes[path] == dest_hashes.get(path):
+                retimed.append((path, mtime))
+            else:
+                to_send.append((path, size, mtime))
+        logger.info(f"{len(retimed)} of {len(touched)} files with a new mtime are unchanged by checksum")
+
+    total_bytes = sum(size for _, size, _ in to_send)
+    logger.info(f"Sending {len(to_send)} files ({total_bytes} bytes)")
+    progress = ProgressReporter(task, transfer_data, total_bytes)
+    if to_send:
+        files = [(posixpath.join(source, path), size) for path, size, _ in to_send]
+        transfer_files(source_ssh, dest_ssh, files, source, dest,
+                       on_chunk=job_limiter(transfer_data).wrap(progress.add))
+    progress.flush()
+
+    set_mtimes(dest_ssh, dest, [(path, mtime) for path, _, mtime in to_send] + retimed)
+    if prune:
+        remove_dest_files(dest_ssh, dest, deleted)
+    return counts
+
+
+# A sync only moves what is still missing, so a redelivered or retried run simply
+# picks up where the last one stopped.
+@shared_task(name="transfer.sync", bind=True, acks_late=True, reject_on_worker_lost=True,
+             max_retries=TRANSFER_MAX_RETRIES)
+@limit_concurrency
+def linux_sync_transfer(self, transfer_data, server_configs, identity_file):
+    """
+    Incremental transfer: diff the source and destination manifests and send only
+    new and changed files, optionally pruning files removed from the source.
+    A resumed sync diffs the trees again, so it only sends what the paused run had not.
+    """
+    try:
+        # Paused or cancelled while still queued
+        StopCheck(transfer_data['job_id'])()
+        update_job_status(transfer_data['job_id'], JobStatus.IN_PROGRESS)
+        logger.info(f"Starting sync with data: {transfer_data}")
+
+        # Validate transfer data
+        if not transfer_data.get('source_storage'):
+            raise HTTPException(status_code=400, detail="Source storage is required")
+        if not transfer_data.get('dest_storage'):
+            raise HTTPException(status_code=400, detail="Destination storage is required")
+
+        transfer_data['bandwidth_pair'] = pair_name(server_configs['pisms']['host'], server_configs['pimaster']['host'])
+        source_ssh, dest_ssh = connect_servers(server_configs, identity_file)
+        try:
+            counts = sync_trees(self, transfer_data, source_ssh, dest_ssh)
+        except Exception as e:
+            if isinstance(e, TransferStopped):
+                clean_up_stopped(e, source_ssh, dest_ssh, transfer_data)
+            invalidate_manifests(dest_ssh, transfer_data['dest_storage'])
+            release_servers(source_ssh, dest_ssh, discard=True)
+            raise
+        invalidate_manifests(dest_ssh, transfer_data['dest_storage'])
+        release_servers(source_ssh, dest_ssh)
+
+        update_job_status(transfer_data['job_id'], JobStatus.COMPLETED)
+        logger.info("Sync completed successfully.")
+
+        return {
+            "status": "completed",
+            "message": "Sync successful",
+            "source": transfer_data['source_storage'],
+            "destination": transfer_data['dest_storage'],
+            "files": counts,
+            "ssh_pool": ssh_pool.stats()
+        }
+
+    except TransferStopped as stop:
+        return record_stopped(self, stop, self.name, [transfer_data, server_configs, identity_file])
+    except HTTPException:
+        update_job_status(transfer_data['job_id'], JobStatus.FAILED)
+        raise
+    except Exception as e:
+        logger.error(f"Sync failed with error: {e}")
+        if self.request.retries < self.max_retries:
+            logger.info(f"Retrying sync in {TRANSFER_RETRY_DELAY}s (attempt {self.request.retries + 1})")
+            update_job_status(transfer_data['job_id'], JobStatus.PENDING)
+            raise self.retry(exc=e, countdown=TRANSFER_RETRY_DELAY)
+        update_job_status(transfer_data['job_id'], JobStatus.FAILED)
+        raise HTTPException(status_code=500, detail=str(e))
@@ -2,6 +2,7 @@ from app.db_setup import engine
 from sqlalchemy.orm import Session
 from app.database.models.models import Job
 from app.logging.logger import logger
+from app.utils.job_events import send_job_event, JOB_STATUS_EVENT
 
 
 
@@ -11,5 +12,31 @@ def update_job_status(job_id: int, status: str):
         if job:
             job.status = status
             db.commit()
+            send_job_event(JOB_STATUS_EVENT, job_id=job_id, user_id=job.user_id, status=status)
         else:
-            logger.error(f"Job with id {job_id} not found")
\ No newline at end of file
+            logger.error(f"Job with id {job_id} not found")
+
+def update_job_codec(job_id: int, codec: str):
+    with Session(engine) as db:
+        job = db.query(Job).filter(Job.id == job_id).first()
+        if job:
+            job.codec = codec
+            db.commit()
+        else:
+            logger.error(f"Job with id {job_id} not found")
+
+
+def update_job_checksum(job_id: int, checksum: str):
+    with Session(engine) as db:
+        job = db.query(Job).filter(Job.id == job_id).first()
+        if job:
+            job.checksum = checksum
+            db.commit()
+        else:
+            logger.error(f"Job with id {job_id} not found")
+
+
+def get_job_codec(job_id: int):
+    with Session(engine) as db:
+        job = db.query(Job).filter(Job.id == job_id).first()
+        return job.codec if job else None
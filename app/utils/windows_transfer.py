@@ -1,339 +1,331 @@
 import subprocess
 import asyncio
+import shlex
 from pathlib import Path
-import paramiko
 from app.logging.logger import logger
-import time
-from app.websocket.connection_manager import manager
+from app.websocket.event_bus import publish_to_user
 from celery import shared_task
 from app.utils.update_job_status import update_job_status
 from app.db_setup import engine
 from app.database.models.models import JobStatus
-# Why read in chunks?
-# - Windows is not as efficient with large file transfers
-# - Reading in chunks allows us to update the progress bar more frequently
-# - Reading in chunks allows us to handle errors more gracefully
-CHUNK_SIZE = {
-    'small': 32768,
-    'medium': 65536,
-    'large': 131072
-}
+from app.utils.multi_file_transfer import files_transfer, list_files, transfer_files, verify_tree_copy
+from app.utils.integrity import verified_copy_pool, combined_digest
+from app.utils.update_job_status import update_job_checksum
+from app.utils.progress_reporter import ProgressReporter
+from app.utils.range_transfer import RANGE_THRESHOLD, RANGE_STREAMS, copy_file_ranges, range_items, preallocate
+from app.utils.checkpoint import load_checkpoints, clear_checkpoints, resume_items
+from app.utils.stream_transfer import (
+    stream_tar_relay, TAR_CHECKPOINT_FLAGS, can_reach, remote_push, direct_ssh_command
+)
+from app.utils.compression import resolve_codec, tar_flags, archive_extension
+from app.utils.ssh_pool import connect_servers, release_servers
+from app.utils.bandwidth import job_limiter, pair_name
+from app.utils.shard_transfer import sharded_transfer
+from app.utils.job_slots import limit_concurrency
+from app.utils.manifest_cache import cached_tree_size, invalidate_manifests
+from app.utils.job_control import (
+    TransferStopped, StopCheck, tracked, wait_remote, clean_up_stopped, record_stopped
+)
 @shared_task(name="transfer.windows", bind=True)
+@limit_concurrency
 def windows_tar_transfer(self, transfer_data, server_configs, identity_file):
     """Windows-specific implementation using paramiko"""
     try:
+        # Paused or cancelled while still queued
+        StopCheck(transfer_data['job_id'])()
         update_job_status(transfer_data['job_id'], JobStatus.IN_PROGRESS)
         logger.info(f"Starting windows transfer process with data: {transfer_data}")
-        source = transfer_data['source_storage']
         dest = transfer_data['dest_storage']
-        user_id = transfer_data['user_id']
+        transfer_data['bandwidth_pair'] = pair_name(server_configs['pisms']['host'], server_configs['pimaster']['host'])
         
-        # Initialize SSH connections for both servers
-        logger.info("Initializing SSH clients...")
-        source_ssh = paramiko.SSHClient()
-        dest_ssh = paramiko.SSHClient()
-        source_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        dest_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        source_ssh, dest_ssh = connect_servers(server_configs, identity_file)
+        try:
+            if transfer_data.get('mode') == 'stream':
+                windows_stream_transfer(self, transfer_data, source_ssh, dest_ssh)
+            elif transfer_data.get('mode') == 'direct':
+                windows_direct_transfer(self, transfer_data, source_ssh, dest_ssh, server_configs['pimaster'])
+            elif transfer_data.get('mode') == 'files':
+                files_transfer(self, transfer_data, source_ssh, dest_ssh)
+            elif transfer_data.get('mode') == 'sharded':
+                sharded_transfer(self, transfer_data, source_ssh, dest_ssh)
+            else:
+                windows_archive_transfer(self, transfer_data, source_ssh, dest_ssh)
+        except Exception as e:
+            if isinstance(e, TransferStopped):
+                clean_up_stopped(e, source_ssh, dest_ssh, transfer_data)
+            invalidate_manifests(dest_ssh, str(Path(dest).parent))
+            release_servers(source_ssh, dest_ssh, discard=True)
+            raise
+        # Archive and stream modes unpack next to dest, so drop cached listings from its parent down
+        invalidate_manifests(dest_ssh, str(Path(dest).parent))
+
+        logger.info("All files transferred successfully")
         
-        # Load private key
-        logger.info(f"Loading private key from: {identity_file}")
-        private_key = paramiko.RSAKey(filename=str(identity_file))
+        # Return connections to the pool for the next job
+        release_servers(source_ssh, dest_ssh)
         
-        # Connect to source server (pisms)
-        source_server = server_configs['pisms']
-        logger.info(f"Connecting to source server: {source_server['host']}")
-        source_ssh.connect(
-            source_server['host'],
-            username=source_server['user'],
-            pkey=private_key
-        )
-        logger.info("Successfully connected to source server")
+        # TODO: set the task_id to null
+        update_job_status(transfer_data['job_id'], JobStatus.COMPLETED)
+ 
         
-        # Connect to destination server (pimaster)
-        dest_server = server_configs['pimaster']
-        logger.info(f"Connecting to destination server: {dest_server['host']}")
-        dest_ssh.connect(
-            dest_server['host'],
-            username=dest_server['user'],
-            pkey=private_key
+    except TransferStopped as stop:
+        return record_stopped(self, stop, self.name, [transfer_data, server_configs, identity_file])
+    except Exception as e:
+        # TODO: set the task_id to null
+        update_job_status(transfer_data['job_id'], JobStatus.FAILED)
+        logger.error(f"Windows transfer failed with error: {str(e)}")
+        raise Exception(f"Windows transfer failed: {str(e)}")
+
+
+def windows_archive_transfer(task, transfer_data, source_ssh, dest_ssh):
+    """
+    Archive mode: build a compressed tar of the source, copy it over SFTP, extract it
+    and clean up. A resumed job carries on from the checkpoints of the archive it
+    stopped with.
+    """
+    source = transfer_data['source_storage']
+    dest = transfer_data['dest_storage']
+    user_id = transfer_data['user_id']
+    job_id = transfer_data['job_id']
+    codec, level = resolve_codec(transfer_data, source_ssh, dest_ssh)
+
+    # Setup SFTP connections
+    source_sftp = source_ssh.open_sftp()
+    dest_sftp = dest_ssh.open_sftp()
+    logger.info("SFTP connections established")
+    
+    # Use tar instead of zip
+    source_archive = f"{source}{archive_extension(codec)}"
+    dest_archive = f"{dest}{archive_extension(codec)}"
+    # Where a cancel finds the archives to remove
+    transfer_data['archives'] = {'source': source_archive, 'dest': dest_archive}
+    
+    source_parent = str(Path(source).parent).replace('\\', '/')  # Ensure forward slashes
+    source_name = Path(source).name
+    check_stop = StopCheck(job_id)
+
+    # A resumed or retried job picks up the archive its previous run left behind, as
+    # long as it is still the one the checkpoints were taken against
+    resumable = False
+    checkpoints = load_checkpoints(job_id)
+    if checkpoints:
+        stdin, stdout, stderr = source_ssh.exec_command(f"stat -c%s '{source_archive}'")
+        existing_size = stdout.read().decode().strip()
+        resumable = existing_size.isdigit() and all(
+            checkpoint['file_size'] == int(existing_size) for checkpoint in checkpoints.values()
         )
-        logger.info("Successfully connected to destination server")
-        
-        # Setup SFTP connections
-        source_sftp = source_ssh.open_sftp()
-        dest_sftp = dest_ssh.open_sftp()
-        logger.info("SFTP connections established")
-        
-        # Use tar instead of zip
-        source_archive = f"{source}.tar.gz"
-        dest_archive = f"{dest}.tar.gz"
-        
+        if not resumable:
+            logger.info("Checkpoints do not match the source archive; starting over")
+            clear_checkpoints(job_id)
+
+    if resumable:
+        logger.info(f"Reusing archive from previous run: {source_archive}")
+    else:
         # Create tar archive
         logger.info(f"Creating tar archive: {source_archive}")
-        source_parent = str(Path(source).parent).replace('\\', '/')  # Ensure forward slashes
-        source_name = Path(source).name
-        tar_command = f"cd '{source_parent}' && tar -czf '{source_archive}' '{source_name}'"
-        
+        tar_command = f"cd '{source_parent}' && tar -c {tar_flags(codec, level)} -f '{source_archive}' '{source_name}'"
+
         logger.info(f"Executing command: {tar_command}")  # Add this for debugging
-        stdin, stdout, stderr = source_ssh.exec_command(tar_command)
-        
-        tar_error = stderr.read().decode()
-        tar_output = stdout.read().decode()
+        tar_status, tar_output, tar_error = wait_remote(source_ssh, tracked(tar_command, job_id), check_stop)
         logger.info(f"Tar command output: {tar_output}")
         if tar_error:
             logger.error(f"Tar command error: {tar_error}")
             raise Exception(f"Failed to create tar archive: {tar_error}")
+    
+    # Get file size (using Linux-compatible stat command)
+    size_command = f"stat -c%s '{source_archive}'"
+    stdin, stdout, stderr = source_ssh.exec_command(size_command)
+    size_output = stdout.read().decode().strip()
+    size_error = stderr.read().decode()
+    
+    if size_error:
+        logger.error(f"Error getting file size: {size_error}")
+        raise Exception(f"Failed to get archive size: {size_error}")
+    
+    if not size_output:
+        logger.error("File size command returned empty output")
+        raise Exception("Failed to get archive size: empty output")
         
-        # Get file size (using Linux-compatible stat command)
-        size_command = f"stat -c%s '{source_archive}'"
-        stdin, stdout, stderr = source_ssh.exec_command(size_command)
-        size_output = stdout.read().decode().strip()
-        size_error = stderr.read().decode()
-        
-        if size_error:
-            logger.error(f"Error getting file size: {size_error}")
-            raise Exception(f"Failed to get archive size: {size_error}")
-        
-        if not size_output:
-            logger.error("File size command returned empty output")
-            raise Exception("Failed to get archive size: empty output")
-            
-        total_bytes = int(size_output)
-        logger.info(f"Archive file size: {total_bytes} bytes")
-
-        # Initialize transfer tracking
-        start_time = time.time()
-        bytes_transferred = 0
-
-        # Create destination directory
-        # mkdir_command = f"mkdir -p {Path(dest).parent}"
-        # dest_ssh.exec_command(mkdir_command)
-
-        # Create progress callback for single file transfer
-        # callback = create_progress_callback(
-        #     user_id=user_id,
-        #     total_bytes=total_bytes,
-        #     current_file=source_archive,
-        #     start_time=start_time,
-        #     bytes_transferred=bytes_transferred
-        # )
-
-        # Transfer the zip file
-        logger.info(f"Transferring zip file to destination")
-        try:
-            with source_sftp.file(source_archive, 'rb') as source_fh:
-                with dest_sftp.file(dest_archive, 'wb') as dest_fh:
-                    while True:
-                        data = source_fh.read(CHUNK_SIZE['small'])
-                        if not data:
-                            break
-                        dest_fh.write(data)
-                        bytes_transferred += len(data)
-                        
-                        # Report progress to Celery
-                        self.update_state(
-                            state=JobStatus.IN_PROGRESS,
-                            meta={
-                                'job_id': transfer_data['job_id'],
-                                'task_id': self.request.id,
-                                'user_id': user_id,
-                                'current': bytes_transferred,
-                                'total': total_bytes,
-                                'status': JobStatus.IN_PROGRESS,
-                                'percent': int((bytes_transferred / total_bytes) * 100)
-                            }
-                        )
-                        
-                        time.sleep(0.3)
-
-            self.update_state(
-                state=JobStatus.COMPLETED,
-                meta={
-                    'job_id': transfer_data['job_id'],
-                    'task_id': self.request.id,
-                    'user_id': user_id,
-                }
-            )
-        except Exception as e:
-            # TODO: set the task_id to null
-            update_job_status(transfer_data['job_id'], JobStatus.FAILED)
+    total_bytes = int(size_output)
+    logger.info(f"Archive file size: {total_bytes} bytes")
 
-            logger.error(f"Error transferring zip file: {str(e)}")
-            raise
+    # Initialize transfer tracking
+    progress = ProgressReporter(task, transfer_data, total_bytes)
 
-        # Untar directly to the destination location
-        logger.info("Untarring file on destination server")
-        dest_parent = str(Path(dest).parent).replace('\\', '/')
-        untar_command = f"cd '{dest_parent}' && tar -xzf '{dest_archive}'"
-        
-        logger.info(f"Executing untar command: {untar_command}")
-        stdin, stdout, stderr = dest_ssh.exec_command(untar_command)
-        
-        # Get command output and error
-        untar_error = stderr.read().decode()
-        untar_output = stdout.read().decode()
-        
-        logger.info(f"Untar command output: {untar_output}")
-        if untar_error:
-            logger.error(f"Untar command error: {untar_error}")
-            raise Exception(f"Failed to untar file: {untar_error}")
-            
-        # Remove the archive after successful extraction
-        logger.info("Removing archive file")
-        rm_command = f"rm '{dest_archive}'"
-        dest_ssh.exec_command(rm_command)
-
-        # Clean up zip file on source server
-        logger.info("Cleaning up source zip file")
-        cleanup_command = f"rm {source_archive}"
-        source_ssh.exec_command(cleanup_command)
+    # Work out what is left to copy; ranges confirmed by an earlier run are skipped
+    if total_bytes >= RANGE_THRESHOLD:
+        items = range_items(source_archive, dest_archive, total_bytes, RANGE_STREAMS)
+    else:
+        items = [(source_archive, dest_archive, total_bytes, 0, None)]
+    items, checkpointers, bytes_done = resume_items(job_id, dest_sftp, items)
+    progress.add(bytes_done)
 
-        logger.info("All files transferred successfully")
-        
-        # Close connections
-        source_sftp.close()
-        dest_sftp.close()
-        source_ssh.close()
-        dest_ssh.close()
-        logger.info("All connections closed")
-        
-        # TODO: set the task_id to null
-        update_job_status(transfer_data['job_id'], JobStatus.COMPLETED)
- 
-        
+    # Transfer the zip file
+    logger.info(f"Transferring zip file to destination")
+    on_chunk = job_limiter(transfer_data).wrap(progress.add)
+    try:
+        if total_bytes >= RANGE_THRESHOLD:
+            if not bytes_done:
+                preallocate(dest_sftp, dest_archive, total_bytes)
+            digests = copy_file_ranges(source_ssh, dest_ssh, source_archive, dest_archive, total_bytes,
+                                       on_chunk=on_chunk, items=items, checkpointers=checkpointers)
+        else:
+            digests = verified_copy_pool(source_ssh, dest_ssh, items, 1, on_chunk, checkpointers)
+        progress.flush()
+        update_job_checksum(job_id, combined_digest(digests))
+
+        task.update_state(
+            state=JobStatus.COMPLETED,
+            meta={
+                'job_id': transfer_data['job_id'],
+                'task_id': task.request.id,
+                'user_id': user_id,
+            }
+        )
+    except TransferStopped:
+        raise
     except Exception as e:
         # TODO: set the task_id to null
         update_job_status(transfer_data['job_id'], JobStatus.FAILED)
-        logger.error(f"Windows transfer failed with error: {str(e)}")
-        # manager.sync_broadcast_to_user(
-        #     user_id,
-        #     {
-        #         "type": "transfer_progress",
-        #         "progress": -1,
-        #         "error": str(e)
-        #     }
-        # )
-        raise Exception(f"Windows transfer failed: {str(e)}")
+
+        logger.error(f"Error transferring zip file: {str(e)}")
+        raise
+
+    # Untar directly to the destination location
+    logger.info("Untarring file on destination server")
+    dest_parent = str(Path(dest).parent).replace('\\', '/')
+    untar_command = f"cd '{dest_parent}' && tar -x {tar_flags(codec, level)} -f '{dest_archive}'"
+    
+    logger.info(f"Executing untar command: {untar_command}")
+    untar_status, untar_output, untar_error = wait_remote(dest_ssh, tracked(untar_command, job_id), check_stop)
     
+    logger.info(f"Untar command output: {untar_output}")
+    if untar_error:
+        logger.error(f"Untar command error: {untar_error}")
+        raise Exception(f"Failed to untar file: {untar_error}")
+
+    # Nothing left to resume once the archive is extracted
+    clear_checkpoints(job_id)
+
+    # Remove the archive after successful extraction
+    logger.info("Removing archive file")
+    rm_command = f"rm '{dest_archive}'"
+    dest_ssh.exec_command(rm_command)
+
+    # Clean up zip file on source server
+    logger.info("Cleaning up source zip file")
+    cleanup_command = f"rm {source_archive}"
+    source_ssh.exec_command(cleanup_command)
+
+    if transfer_data.get('verify_manifest'):
+        verify_tree_copy(source_ssh, dest_ssh, source, f"{dest_parent}/{source_name}", transfer_data['job_id'])
+
+    source_sftp.close()
+    dest_sftp.close()
+
+
+def windows_stream_transfer(task, transfer_data, source_ssh, dest_ssh):
+    """Stream mode: relay `tar -c` on the source into `tar -x` on the destination, no archive on disk"""
+    source = transfer_data['source_storage']
+    dest = transfer_data['dest_storage']
+    codec, level = resolve_codec(transfer_data, source_ssh, dest_ssh)
+
+    total_bytes = cached_tree_size(source_ssh, source)
+    logger.info(f"Source tree size: {total_bytes} bytes")
+
+    progress = ProgressReporter(task, transfer_data, total_bytes)
+
+    # Same layout as archive mode: the source directory lands under dest's parent
+    source_parent = str(Path(source).parent).replace('\\', '/')
+    source_name = Path(source).name
+    dest_parent = str(Path(dest).parent).replace('\\', '/')
+    pack_command = f"cd '{source_parent}' && tar -c {tar_flags(codec, level)} {TAR_CHECKPOINT_FLAGS} -f - '{source_name}'"
+    unpack_command = f"mkdir -p '{dest_parent}' && cd '{dest_parent}' && tar -x {tar_flags(codec, level)} -f -"
+    stream_tar_relay(source_ssh, dest_ssh, tracked(pack_command, transfer_data['job_id']),
+                     tracked(unpack_command, transfer_data['job_id']), progress.update,
+                     job_limiter(transfer_data).consume)
+    progress.update(total_bytes)
+    progress.flush()
+    logger.info("Tar stream transfer completed")
+
+    if transfer_data.get('verify_manifest'):
+        verify_tree_copy(source_ssh, dest_ssh, source, f"{dest_parent}/{source_name}", transfer_data['job_id'])
+
+
+def windows_direct_transfer(task, transfer_data, source_ssh, dest_ssh, dest_server):
+    """Direct mode: the source pipes tar straight into ssh to the destination; stream mode if it can't reach it"""
+    source = transfer_data['source_storage']
+    dest = transfer_data['dest_storage']
+    dest_host = dest_server.get('direct_host', dest_server['host'])
+    dest_port = dest_server.get('port', 22)
+
+    if not can_reach(source_ssh, dest_server['user'], dest_host, dest_port):
+        logger.info("Direct transfer not possible; relaying the stream through the worker instead")
+        windows_stream_transfer(task, transfer_data, source_ssh, dest_ssh)
+        return
+
+    codec, level = resolve_codec(transfer_data, source_ssh, dest_ssh)
+    total_bytes = cached_tree_size(source_ssh, source)
+    logger.info(f"Source tree size: {total_bytes} bytes")
+
+    progress = ProgressReporter(task, transfer_data, total_bytes)
+
+    # Same layout as archive mode: the source directory lands under dest's parent
+    source_parent = str(Path(source).parent).replace('\\', '/')
+    source_name = Path(source).name
+    dest_parent = str(Path(dest).parent).replace('\\', '/')
+    pack_command = (f"cd {shlex.quote(source_parent)} && "
+                    f"tar -c {tar_flags(codec, level)} {TAR_CHECKPOINT_FLAGS} -f - {shlex.quote(source_name)}")
+    unpack_command = f"mkdir -p {shlex.quote(dest_parent)} && cd {shlex.quote(dest_parent)} && tar -x {tar_flags(codec, level)} -f -"
+    # Quoted once more for the source's shell, so only the destination's shell interprets it
+    push_command = f"{pack_command} | {direct_ssh_command(dest_server['user'], dest_host, dest_port)} {shlex.quote(unpack_command)}"
+    remote_push(source_ssh, tracked(push_command, transfer_data['job_id']), progress.update)
+    progress.update(total_bytes)
+    progress.flush()
+    logger.info("Direct transfer completed")
+
+    if transfer_data.get('verify_manifest'):
+        verify_tree_copy(source_ssh, dest_ssh, source, f"{dest_parent}/{source_name}", transfer_data['job_id'])
 
 
 
-async def windows_files_transfer(transfer_data, server_configs, identity_file):
+
+async def windows_files_transfer(task, transfer_data, server_configs, identity_file):
     """Windows-specific implementation using paramiko"""
     try:
         logger.info(f"Starting windows transfer process with data: {transfer_data}")
         source = transfer_data['source_storage']
         dest = transfer_data['dest_storage']
         user_id = transfer_data['user_id']
+        transfer_data['bandwidth_pair'] = pair_name(server_configs['pisms']['host'], server_configs['pimaster']['host'])
         
-        # Initialize SSH connections for both servers
-        logger.info("Initializing SSH clients...")
-        source_ssh = paramiko.SSHClient()
-        dest_ssh = paramiko.SSHClient()
-        source_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        dest_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        
-        # Load private key
-        logger.info(f"Loading private key from: {identity_file}")
-        private_key = paramiko.RSAKey(filename=str(identity_file))
-        
-        # Connect to source server (pisms)
-        source_server = server_configs['pisms']
-        logger.info(f"Connecting to source server: {source_server['host']}")
-        source_ssh.connect(
-            source_server['host'],
-            username=source_server['user'],
-            pkey=private_key
-        )
-        logger.info("Successfully connected to source server")
-        
-        # Connect to destination server (pimaster)
-        dest_server = server_configs['pimaster']
-        logger.info(f"Connecting to destination server: {dest_server['host']}")
-        dest_ssh.connect(
-            dest_server['host'],
-            username=dest_server['user'],
-            pkey=private_key
-        )
-        logger.info("Successfully connected to destination server")
-        
-        # Setup SFTP connections
-        source_sftp = source_ssh.open_sftp()
-        dest_sftp = dest_ssh.open_sftp()
-        logger.info("SFTP connections established")
+        source_ssh, dest_ssh = connect_servers(server_configs, identity_file)
         
-        # Get total size
-        size_command = f"du -sb {source}"
-        logger.info(f"Getting total size with command: {size_command}")
-        stdin, stdout, stderr = source_ssh.exec_command(size_command)
-        total_bytes = int(stdout.read().decode().split()[0])
-        logger.info(f"Total bytes to transfer: {total_bytes}")
+        # Get list of files and their sizes in one listing
+        files_to_transfer, total_bytes = list_files(source_ssh, source)
+        logger.info(f"Found {len(files_to_transfer)} files to transfer ({total_bytes} bytes)")
         
-        # Get list of files
-        find_command = f"find {source} -type f"
-        logger.info(f"Getting file list with command: {find_command}")
-        stdin, stdout, stderr = source_ssh.exec_command(find_command)
-        files_to_transfer = stdout.read().decode().split('\n')
-        files_to_transfer = [f for f in files_to_transfer if f]
-        logger.info(f"Found {len(files_to_transfer)} files to transfer")
+        # ProgressReporter is thread-safe, so the pool's worker threads feed it directly.
+        # Build it here: task.request is thread-local and empty in the worker threads
+        progress = ProgressReporter(task, transfer_data, total_bytes)
+        on_chunk = job_limiter(transfer_data).wrap(progress.add)
         
-        # Initialize transfer tracking
-        start_time = time.time()
-        bytes_transferred = 0
-        
-        for source_file in files_to_transfer:
-            # Calculate paths
-            rel_path = Path(source_file).relative_to(source)
-            dest_file = str(Path(dest) / rel_path).replace('\\', '/')
-            current_file = source_file
-            
-            logger.info(f"Processing file: {source_file} -> {dest_file}")
-            
-            # Create destination directory on dest server
-            dest_dir = str(Path(dest_file).parent).replace('\\', '/')
-            mkdir_command = f"mkdir -p {dest_dir}"
-            logger.info(f"Creating directory on destination: {mkdir_command}")
-            stdin, stdout, stderr = dest_ssh.exec_command(mkdir_command)
-            
-            # Get file size
-            file_attr = source_sftp.stat(source_file)
-            file_size = file_attr.st_size
-            logger.info(f"File size: {file_size} bytes")
-            
-            # Create progress callback
-            callback = create_progress_callback(
-                user_id=user_id,
-                total_bytes=total_bytes,
-                current_file=current_file,
-                start_time=start_time,
-                bytes_transferred=bytes_transferred
+        # Copy over pooled SFTP sessions off the event loop
+        try:
+            await asyncio.to_thread(
+                transfer_files, source_ssh, dest_ssh, files_to_transfer, source, dest, on_chunk=on_chunk
             )
-            
-            # Transfer file from source to destination
-            logger.info(f"Starting transfer of: {source_file}")
-            try:
-                # Create a temporary file for transfer
-                with source_sftp.file(source_file, 'rb') as source_fh:
-                    with dest_sftp.file(dest_file, 'wb') as dest_fh:
-                        while True:
-                            data = source_fh.read(CHUNK_SIZE['small'])  # Read in 32KB chunks
-                            if not data:
-                                break
-                            dest_fh.write(data)
-                            callback(len(data), file_size)
-                logger.info(f"Successfully transferred: {source_file}")
-            except Exception as e:
-                logger.error(f"Error transferring {source_file}: {str(e)}")
-                raise
+        except Exception:
+            invalidate_manifests(dest_ssh, dest)
+            release_servers(source_ssh, dest_ssh, discard=True)
+            raise
+        invalidate_manifests(dest_ssh, dest)
+        progress.flush()
         
         logger.info("All files transferred successfully")
         
-        # Close connections
-        source_sftp.close()
-        dest_sftp.close()
-        source_ssh.close()
-        dest_ssh.close()
-        logger.info("All connections closed")
+        # Return connections to the pool for the next job
+        release_servers(source_ssh, dest_ssh)
         
         return {
             "status": "completed",
@@ -344,7 +336,7 @@ async def windows_files_transfer(transfer_data, server_configs, identity_file):
         
     except Exception as e:
         logger.error(f"Windows transfer failed with error: {str(e)}")
-        await manager.broadcast_to_user(
+        publish_to_user(
             user_id,
             {
                 "type": "transfer_progress",
@@ -353,56 +345,3 @@ async def windows_files_transfer(transfer_data, server_configs, identity_file):
             }
         )
         raise Exception(f"Windows transfer failed: {str(e)}")
-    
-
-
-def create_progress_callback(user_id, total_bytes, current_file, start_time, bytes_transferred):
-    """Creates a progress callback function for file transfers"""
-    def progress_callback(bytes_so_far, total_bytes_for_file):
-        nonlocal bytes_transferred
-        bytes_transferred += bytes_so_far
-        
-        # Calculate progress percentage
-        progress = int((bytes_transferred / total_bytes) * 100)
-        
-        # Calculate estimated time remaining
-        elapsed_time = time.time() - start_time
-        if bytes_transferred > 0:
-            transfer_rate = bytes_transferred / elapsed_time
-            remaining_bytes = total_bytes - bytes_transferred
-            estimated_seconds = remaining_bytes / transfer_rate if transfer_rate > 0 else 0
-        else:
-            estimated_seconds = 0
-        
-        logger.info(f"Transfer progress: {progress}% ({bytes_transferred}/{total_bytes} bytes)")
-        logger.info(f"Current file progress: {bytes_so_far}/{total_bytes_for_file} bytes")
-        logger.info(f"Estimated time remaining: {int(estimated_seconds)} seconds")
-        
-        # Send progress update
-        asyncio.create_task(
-            manager.broadcast_to_user(
-                user_id,
-                {
-                    "type": "transfer_progress",
-                    "progress": progress,
-                    "job_id": 2,
-                    "bytes_transferred": bytes_transferred,
-                    "total_bytes": total_bytes,
-                    "estimated_time_remaining": int(estimated_seconds),
-                    "error": None
-                }
-            )
-        )
-    
-    return progress_callback
-
-
-# def update_job_status(job_id: int,  status: str):
-#     with Session(engine) as db:
-#         db.query(Job).filter(Job.id == job_id).update({"status": status})
-#         db.commit()
-        
-
-# async def update_job_status(job_id: int, status: str, db: Session):
-#     db.query(Job).filter(Job.id == job_id).update({"status": status})
-#     db.commit()
\ No newline at end of file
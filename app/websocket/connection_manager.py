@@ -1,28 +1,254 @@
-from typing import Dict, List
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Dict, List, Set
 from fastapi import WebSocket
+from app.logging.logger import logger
+
+# Frames one connection may have waiting; past that the oldest progress frame goes
+WS_QUEUE_SIZE = int(os.getenv('WS_QUEUE_SIZE', 64))
+# A send that takes longer than this means the client is gone or hopelessly behind
+WS_SEND_TIMEOUT = float(os.getenv('WS_SEND_TIMEOUT', 10))
+# job_updates frames one connection gets per second at most (0: no limit); updates in
+# between are merged, the newest state of each job winning
+WS_UPDATES_PER_SECOND = float(os.getenv('WS_UPDATES_PER_SECOND', 2))
+WS_UPDATE_INTERVAL = 1 / WS_UPDATES_PER_SECOND if WS_UPDATES_PER_SECOND > 0 else 0
+# Jobs one connection may subscribe to
+WS_MAX_SUBSCRIPTIONS = int(os.getenv('WS_MAX_SUBSCRIPTIONS', 500))
+
+# Job statuses a progress frame may carry; any other status is an event the client must see
+PROGRESS_STATUSES = ('in_progress',)
+
+
+def is_progress_frame(message):
+    """
+    True for frames a newer one makes redundant: percent/byte updates of running
+    jobs. Status changes, errors and completions are never dropped.
+    """
+    if message.get('type') == 'job_updates':
+        return all(update.get('status') in PROGRESS_STATUSES for update in message.get('updates', []))
+    if message.get('type') == 'transfer_progress':
+        return not message.get('error') and 0 <= (message.get('progress') or 0) < 100
+    return False
+
+
+class ClientConnection:
+    """
+    One socket with its own bounded outgoing queue and writer task, so a slow or
+    stalled client only ever delays itself. When the queue is full the oldest
+    progress frame makes room; a send that fails or times out closes the connection.
+    Job states are not queued one by one: they are merged per job and go out together
+    in one job_updates frame, at most WS_UPDATES_PER_SECOND times a second.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: int, on_close):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.on_close = on_close
+        self.queue = deque()  # (enqueued at, message)
+        self.updates = {}     # job id -> newest state not sent yet
+        self.updates_since = None
+        self.last_flush = 0.0
+        # Jobs subscribed to; None until the first subscribe: every job of the user
+        self.jobs: Set[int] = None
+        self.ready = asyncio.Event()
+        self.connected_at = time.time()
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.closed = False
+        self.writer = asyncio.create_task(self._write(), name=f"ws-writer:{user_id}")
+
+    def put(self, message):
+        if self.closed:
+            return
+        if len(self.queue) >= WS_QUEUE_SIZE:
+            for index, (_, queued) in enumerate(self.queue):
+                if is_progress_frame(queued):
+                    del self.queue[index]
+                    self.dropped += 1
+                    break
+            else:
+                # Full of events that must arrive: the newcomer goes if it is only progress
+                if is_progress_frame(message):
+                    self.dropped += 1
+                    return
+        self.queue.append((time.monotonic(), message))
+        self.ready.set()
+
+    def push_update(self, state):
+        """Queue a job's state for the next job_updates frame, replacing an unsent one"""
+        if self.closed:
+            return
+        if state['job_id'] in self.updates:
+            self.coalesced += 1
+        elif not self.updates:
+            self.updates_since = time.monotonic()
+        self.updates[state['job_id']] = state
+        self.ready.set()
+
+    async def _write(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.queue:
+                    enqueued_at, message = self.queue.popleft()
+                    await self._send(message, enqueued_at)
+                if not self.updates:
+                    continue
+                wait = self.last_flush + WS_UPDATE_INTERVAL - time.monotonic()
+                if wait > 0:
+                    # Not due yet; other frames still go out meanwhile
+                    try:
+                        await asyncio.wait_for(self.ready.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    self.ready.set()
+                    continue
+                updates, since = list(self.updates.values()), self.updates_since
+                self.updates = {}
+                self.last_flush = time.monotonic()
+                await self._send({"type": "job_updates", "updates": updates}, since)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"Dropping websocket of user {self.user_id}: {type(e).__name__} {str(e)}")
+            self.on_close(self)
+            try:
+                await self.websocket.close()
+            except Exception:
+                pass
+
+    async def _send(self, message, enqueued_at):
+        await asyncio.wait_for(self.websocket.send_json(message), WS_SEND_TIMEOUT)
+        self.sent += 1
+        self.last_lag = time.monotonic() - enqueued_at
+        self.max_lag = max(self.max_lag, self.last_lag)
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self.updates.clear()
+        self.writer.cancel()
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'user_id': self.user_id,
+            'connected_at': int(self.connected_at),
+            'subscriptions': 'all' if self.jobs is None else len(self.jobs),
+            'queued': len(self.queue),
+            'oldest_queued_seconds': round(now - self.queue[0][0], 3) if self.queue else 0,
+            'pending_updates': len(self.updates),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'last_lag_seconds': round(self.last_lag, 3),
+            'max_lag_seconds': round(self.max_lag, 3)
+        }
+
+
+class JobStream:
+    """
+    The one stream of a job's states in this process, however many sockets (tabs,
+    users) watch the job. Lives as long as it has subscribers.
+    """
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+        self.state = None  # newest state published
+        self.subscribers: Set[ClientConnection] = set()
+
+    def publish(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        for connection in self.subscribers:
+            connection.push_update(state)
+
 
 class ConnectionManager:
     def __init__(self):
         self.workspace_connections: Dict[int, List[WebSocket]] = {}
-        self.user_connections: Dict[int, List[WebSocket]] = {}
+        self.user_connections: Dict[int, List[ClientConnection]] = {}
+        self.job_streams: Dict[int, JobStream] = {}
 
     async def connect_to_user(self, websocket: WebSocket, user_id: int):
         await websocket.accept()
         if user_id not in self.user_connections:
             self.user_connections[user_id] = []
-        self.user_connections[user_id].append(websocket)
+        connection = ClientConnection(websocket, user_id, self._evict)
+        self.user_connections[user_id].append(connection)
+        return connection
 
 
     def disconnect_from_user(self, websocket: WebSocket, user_id: int):
-        if user_id in self.user_connections:
-            self.user_connections[user_id].remove(websocket)
-            if not self.user_connections[user_id]:
-                del self.user_connections[user_id]
+        for connection in list(self.user_connections.get(user_id, [])):
+            if connection.websocket is websocket:
+                self._evict(connection)
+
+    def _evict(self, connection: ClientConnection):
+        connection.closed = True
+        connections = self.user_connections.get(connection.user_id, [])
+        if connection in connections:
+            connections.remove(connection)
+            if not connections:
+                del self.user_connections[connection.user_id]
+        self.unsubscribe(connection, list(connection.jobs or []))
+        if not connection.writer.done() and connection.writer is not asyncio.current_task():
+            connection.close()
+
+    def subscribe(self, connection: ClientConnection, job_id: int, state=None):
+        """Add the connection to the job's stream (created for its first subscriber) and send it the current state"""
+        if connection.jobs is None:
+            connection.jobs = set()
+        connection.jobs.add(job_id)
+        stream = self.job_streams.get(job_id)
+        if stream is None:
+            stream = self.job_streams[job_id] = JobStream(job_id)
+        stream.subscribers.add(connection)
+        if stream.state is None:
+            stream.state = state
+        if stream.state is not None:
+            connection.push_update(stream.state)
+
+    def unsubscribe(self, connection: ClientConnection, job_ids):
+        """Leave the jobs' streams; a stream goes with its last subscriber"""
+        for job_id in job_ids:
+            if connection.jobs is not None:
+                connection.jobs.discard(job_id)
+            stream = self.job_streams.get(job_id)
+            if stream is None:
+                continue
+            stream.subscribers.discard(connection)
+            if not stream.subscribers:
+                del self.job_streams[job_id]
+
+    def publish_job_update(self, state):
+        """A job's state changed: to its stream's subscribers and to the owner's sockets that subscribed to nothing in particular"""
+        stream = self.job_streams.get(state['job_id'])
+        if stream:
+            stream.publish(state)
+        for connection in self.user_connections.get(state['user_id'], []):
+            if connection.jobs is None:
+                connection.push_update(state)
 
     async def broadcast_to_user(self, user_id: int, message: dict):
-        if user_id in self.user_connections:
-            for connection in self.user_connections[user_id]:
-                await connection.send_json(message)
+        # Only queues: every connection's writer sends on its own, concurrently
+        for connection in self.user_connections.get(user_id, []):
+            connection.put(message)
+
+    def stats(self, user_id: int = None):
+        """Queue depth, drops and send lag of every connection in this process (of one user, if given)"""
+        return [
+            connection.stats()
+            for uid, connections in self.user_connections.items() if user_id is None or uid == user_id
+            for connection in connections
+        ]
 
 # Create a single instance to be used throughout the application
-manager = ConnectionManager()
\ No newline at end of file
+manager = ConnectionManager()
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import os
+import redis.asyncio as aioredis
+from app.logging.logger import logger
+from app.redis_client import get_redis, redis_backend_url
+from app.websocket.connection_manager import manager
+
+# Workers publish on these; every API process listens to all of them and delivers to
+# the sockets it holds itself. Messages are JSON: {"user_id", "message"}.
+# Job progress and status travel as Celery events instead (see app.utils.job_monitor).
+EVENT_CHANNEL_PREFIX = 'events:'
+USER_CHANNEL = EVENT_CHANNEL_PREFIX + 'user:{}'
+
+# Longest wait before the subscriber reconnects after losing Redis
+EVENT_RECONNECT_MAX_SECONDS = float(os.getenv('EVENT_RECONNECT_MAX_SECONDS', 30))
+
+
+def publish_to_user(user_id, message):
+    """Send `message` to every socket of the user, on whichever API process holds it"""
+    channel = USER_CHANNEL.format(user_id)
+    try:
+        get_redis().publish(channel, json.dumps({'user_id': user_id, 'message': message}))
+    except Exception as e:
+        # Progress is best effort; never fail a transfer over it
+        logger.error(f"Could not publish event on {channel}: {str(e)}")
+
+
+class EventSubscriber:
+    """
+    The one Redis subscription of an API process. Receives the events every worker
+    publishes and hands them to the local ConnectionManager; events for users with no
+    socket on this process are dropped. Reconnects with backoff if Redis goes away.
+    """
+
+    def __init__(self, connection_manager):
+        self.manager = connection_manager
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(), name="event-subscriber")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def connect(self):
+        return aioredis.Redis.from_url(redis_backend_url)
+
+    async def run(self):
+        delay = 1
+        while True:
+            client = pubsub = None
+            try:
+                client = self.connect()
+                pubsub = client.pubsub()
+                await pubsub.psubscribe(f"{EVENT_CHANNEL_PREFIX}*")
+                logger.info("Subscribed to job events")
+                delay = 1
+                async for event in pubsub.listen():
+                    if event['type'] == 'pmessage':
+                        await self.deliver(event['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job event subscription lost, retrying in {delay}s: {str(e)}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, EVENT_RECONNECT_MAX_SECONDS)
+            finally:
+                if pubsub is not None:
+                    await pubsub.aclose()
+                if client is not None:
+                    await client.aclose()
+
+    async def deliver(self, data):
+        try:
+            event = json.loads(data)
+            await self.manager.broadcast_to_user(event['user_id'], event['message'])
+        except Exception as e:
+            logger.error(f"Could not deliver job event: {str(e)}")
+
+
+# One per API process, started from the app's lifespan
+event_subscriber = EventSubscriber(manager)
@@ -0,0 +1,211 @@
+"""
+CPU cost per GB of the byte-moving loops, without network or encryption.
+
+run_benchmarks times whole transfers, where paramiko's encryption and packet
+handling dominate the CPU profile. This runs only the loops that move the data,
+in-process, against stand-ins for the paramiko objects on either end. The
+stand-ins copy data where paramiko does and nowhere else:
+
+    SFTP reads      are served in 32 KB blocks, as prefetched SFTP responses are,
+                    through paramiko's own BufferedFile.read
+    SFTP writes     go through BufferedFile.write, and every request copies its slice
+                    of the data, as paramiko does when it builds the packet
+    channel recv    returns a new bytes object per call, as paramiko's BufferedPipe does
+    channel sendall is paramiko's Channel.sendall, over a send that copies up to
+                    one 32 KB packet per call
+
+Cases:
+
+    copy    CopyEngine.copy of one file
+    relay   stream_tar_relay of the same number of bytes
+
+Run from the repository root:
+
+    python -m benchmarks.relay_microbench --size-mb 1024 --repeat 5 --save relay.json
+    python -m benchmarks.relay_microbench --baseline relay.json
+
+With --baseline the exit status is 1 if any case uses more than --tolerance more CPU per GB.
+"""
+import argparse
+import json
+import logging
+import statistics
+import sys
+import time
+import paramiko
+from paramiko.file import BufferedFile
+
+CASES = ['copy', 'relay']
+
+# Largest SFTP read/write request and SSH channel packet paramiko sends
+BLOCK_SIZE = 32768
+
+
+class BlockSource(BufferedFile):
+    """A remote file of `size` bytes whose reads arrive in BLOCK_SIZE responses"""
+
+    def __init__(self, size):
+        super().__init__()
+        self._set_mode('rb')
+        self.remaining = size
+        self.block = bytes(BLOCK_SIZE)
+
+    def _read(self, size):
+        size = min(size, BLOCK_SIZE, self.remaining)
+        self.remaining -= size
+        # A new object per response, like the one paramiko parses out of each packet
+        return bytes(self.block[:size]) if size else None
+
+    def prefetch(self, file_size=None, max_concurrent_requests=None):
+        pass
+
+    def seek(self, offset, whence=0):
+        pass
+
+
+class BlockSink(BufferedFile):
+    """A remote file that takes writes as BLOCK_SIZE requests"""
+
+    def __init__(self):
+        super().__init__()
+        self._set_mode('wb')
+
+    def _write(self, data):
+        chunk = min(len(data), BLOCK_SIZE)
+        bytes(data[:chunk])
+        return chunk
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+    def seek(self, offset, whence=0):
+        pass
+
+
+class StandInSFTP:
+    def __init__(self, size=0):
+        self.size = size
+
+    def stat(self, path):
+        attributes = paramiko.SFTPAttributes()
+        attributes.st_size = self.size
+        return attributes
+
+    def file(self, path, mode='r'):
+        return BlockSink() if 'w' in mode or '+' in mode else BlockSource(self.size)
+
+
+class StandInChannel:
+    """The parts of a paramiko Channel that stream_tar_relay uses"""
+
+    sendall = paramiko.Channel.sendall
+
+    def __init__(self, size=0):
+        self.remaining = size
+        self.block = bytes(BLOCK_SIZE * 4)
+
+    def exec_command(self, command):
+        pass
+
+    def recv(self, nbytes):
+        size = min(nbytes, len(self.block), self.remaining)
+        self.remaining -= size
+        return bytes(self.block[:size])
+
+    def send(self, data):
+        size = min(len(data), BLOCK_SIZE)
+        bytes(data[:size])
+        return size
+
+    def recv_stderr_ready(self):
+        return False
+
+    def shutdown_write(self):
+        pass
+
+    def recv_exit_status(self):
+        return 0
+
+    def close(self):
+        pass
+
+
+class StandInSSH:
+    def __init__(self, channel):
+        self.channel = channel
+
+    def get_transport(self):
+        return self
+
+    def open_session(self):
+        return self.channel
+
+
+def run_case(case, size):
+    from app.utils.copy_engine import CopyEngine
+    from app.utils.stream_transfer import stream_tar_relay
+
+    if case == 'copy':
+        CopyEngine().copy(StandInSFTP(size), StandInSFTP(), 'source', 'dest', size)
+    else:
+        stream_tar_relay(StandInSSH(StandInChannel(size)), StandInSSH(StandInChannel()), 'pack', 'unpack')
+
+
+def measure(case, size):
+    """Seconds and CPU seconds of one run of a case"""
+    start = time.monotonic()
+    cpu_start = time.process_time()
+    run_case(case, size)
+    return time.monotonic() - start, time.process_time() - cpu_start
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for case, result in results.items():
+        before = baseline.get(case)
+        if before and result['cpu_s_per_gb'] > before['cpu_s_per_gb'] * (1 + tolerance):
+            regressions.append(f"{case}: {result['cpu_s_per_gb']} CPU s/GB, was {before['cpu_s_per_gb']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU per GB of the copy and relay loops")
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES)
+    parser.add_argument('--size-mb', type=int, default=1024, help="bytes moved per run")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per case; the median is reported")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="JSON file from --save to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    size = args.size_mb * 1024 * 1024
+    results = {}
+    for case in args.cases:
+        runs = [measure(case, size) for _ in range(args.repeat)]
+        seconds = statistics.median(run[0] for run in runs)
+        cpu_seconds = statistics.median(run[1] for run in runs)
+        results[case] = {
+            'mb_per_s': round(size / seconds / 1e6, 1),
+            'cpu_s_per_gb': round(cpu_seconds / (size / 1e9), 3)
+        }
+        print(f"{case:<8}{results[case]['mb_per_s']:>10} MB/s{results[case]['cpu_s_per_gb']:>10} CPU s/GB", flush=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
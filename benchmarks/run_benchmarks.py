@@ -0,0 +1,304 @@
+"""
+Throughput benchmarks for the transfer tasks, run against localhost stand-in hosts.
+
+Every target (a Celery transfer task in one of its modes) is run against every
+synthetic tree: one big file, many small files, and a mixed tree. Both hosts are
+stand-ins (benchmarks/standin.py) in a separate process behind a ShapedProxy, so
+--latency-ms and --bandwidth-mbit model the link to each host. Each run happens in
+a fresh process, and CPU and peak RSS are that of the worker side only.
+
+Run from the repository root:
+
+    python -m benchmarks.run_benchmarks --save baseline.json
+    python -m benchmarks.run_benchmarks --latency-ms 2 --bandwidth-mbit 1000
+    python -m benchmarks.run_benchmarks --baseline baseline.json --tolerance 0.1
+
+With --baseline the exit status is 1 if any run lost more than --tolerance of its
+MB/s or grew its peak RSS by more than that.
+"""
+import argparse
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import paramiko
+from benchmarks.standin import StandInHost, ShapedProxy
+
+# name -> (module, task, mode)
+TARGETS = {
+    'linux-archive': ('app.utils.linux_paramiko_transfer', 'linux_paramiko_transfer', 'archive'),
+    'linux-stream': ('app.utils.linux_paramiko_transfer', 'linux_paramiko_transfer', 'stream'),
+    'linux-sharded': ('app.utils.linux_paramiko_transfer', 'linux_paramiko_transfer', 'sharded'),
+    'files': ('app.utils.linux_paramiko_transfer', 'linux_paramiko_transfer', 'files'),
+    'windows-archive': ('app.utils.windows_transfer', 'windows_tar_transfer', 'archive'),
+}
+TREES = ['big', 'small', 'mixed']
+
+WRITE_CHUNK = 4 * 1024 * 1024
+
+
+def write_file(path, size, rng):
+    with open(path, 'wb') as f:
+        while size > 0:
+            chunk = min(size, WRITE_CHUNK)
+            f.write(rng.randbytes(chunk))
+            size -= chunk
+
+
+def make_tree(root, kind, args):
+    """Create a deterministic synthetic tree; returns (file count, total bytes)"""
+    rng = random.Random(f"{kind}-{args.seed}")
+    files = []
+    if kind in ('big', 'mixed'):
+        count = 1 if kind == 'big' else 2
+        files += [(f"data/big{i}.h5", args.big_mb * 1024 * 1024 // count) for i in range(count)]
+    if kind in ('small', 'mixed'):
+        count = args.small_files if kind == 'small' else args.small_files // 2
+        files += [(f"meta/d{i % 64}/e{i % 7}/f{i}.json", rng.randint(0, 2 * args.small_kb * 1024)) for i in range(count)]
+    if kind == 'mixed':
+        files += [(f"medium/m{i}.bin", rng.randint(1, 8) * 1024 * 1024) for i in range(16)]
+
+    for rel_path, size in files:
+        path = os.path.join(root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path, size, rng)
+    return len(files), sum(size for _, size in files)
+
+
+def count_tree(root):
+    count = total = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            count += 1
+            total += os.path.getsize(os.path.join(directory, name))
+    return count, total
+
+
+def serve_hosts(roots, latency_ms, bandwidth_bps, conn):
+    """Child process: one stand-in per host root, each behind a shaped proxy"""
+    ports = []
+    for root in roots:
+        host = StandInHost(root)
+        ports.append(ShapedProxy(host.port, latency_ms, bandwidth_bps).port if latency_ms or bandwidth_bps
+                     else host.port)
+    conn.send(ports)
+    while True:
+        time.sleep(3600)
+
+
+def run_scenario(spec, results):
+    """Child process: run one transfer task in-process and report its numbers"""
+    os.environ['DB_URL'] = f"sqlite:///{spec['work']}/{spec['name']}.db"
+    if not spec['verbose']:
+        logging.disable(logging.WARNING)
+
+    module = importlib.import_module(spec['module'])
+    task = getattr(module, spec['task'])
+    from app.celery_app import celery_app
+    from app.db_setup import engine
+    from app.database.models.base_model import Base
+    from app.database.models.models import User, Job, TransferCheckpoint, TransferShard
+    from sqlalchemy.orm import Session
+
+    celery_app.conf.result_backend = 'cache+memory://'
+    engine.echo = False
+    # Only what the transfers touch; the auth tables do not all work on SQLite
+    Base.metadata.create_all(engine, tables=[model.__table__ for model in (User, Job, TransferCheckpoint, TransferShard)])
+    with Session(engine) as db:
+        user = User(org='bench', name='bench', email='bench@localhost')
+        db.add(user)
+        db.commit()
+        job = Job(user_id=user.id, source_storage=spec['source'], dest_storage=spec['dest'])
+        db.add(job)
+        db.commit()
+        job_id, user_id = job.id, user.id
+
+    transfer_data = {
+        'job_id': job_id,
+        'user_id': user_id,
+        'source_storage': spec['source'],
+        'dest_storage': spec['dest'],
+        'status': 'pending',
+        'mode': spec['mode'],
+        'codec': spec['codec'],
+    }
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.monotonic()
+    # Start at the last retry so a failure is reported instead of retried
+    result = task.apply(args=[transfer_data, spec['server_configs'], spec['identity_file']],
+                        retries=task.max_retries or 0)
+    seconds = time.monotonic() - start
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    results.put({
+        'seconds': seconds,
+        'cpu_seconds': (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime),
+        'peak_rss_mb': usage_after.ru_maxrss / 1024,
+        'error': str(result.result) if result.failed() else None
+    })
+
+
+def run_once(ctx, name, target, tree, tree_stats, args, work, server_configs, identity_file):
+    module, task, mode = TARGETS[target]
+    out = os.path.join(work, 'pimaster', 'out', name)
+    shutil.rmtree(out, ignore_errors=True)
+    os.makedirs(out)
+    spec = {
+        'name': name,
+        'work': work,
+        'module': module,
+        'task': task,
+        'mode': mode,
+        'codec': args.codec,
+        'source': os.path.join(work, 'pisms', 'trees', tree),
+        'dest': os.path.join(out, 'dest'),
+        'server_configs': server_configs,
+        'identity_file': identity_file,
+        'verbose': args.verbose
+    }
+    results = ctx.Queue()
+    process = ctx.Process(target=run_scenario, args=(spec, results))
+    process.start()
+    process.join()
+    if results.empty():
+        return {'error': f"benchmark process exited with {process.exitcode}"}
+    run = results.get()
+
+    # Archive and stream modes put the tree under dest's parent, the others into dest
+    if not run['error'] and count_tree(out) != tree_stats:
+        run['error'] = f"destination has {count_tree(out)} (files, bytes), expected {tree_stats}"
+    shutil.rmtree(out, ignore_errors=True)
+    return run
+
+
+def summarize(runs, tree_stats):
+    """Median of the repeats, as MB/s, files/s, CPU % of one core and peak RSS"""
+    errors = [run['error'] for run in runs if run.get('error')]
+    if errors:
+        return {'error': errors[0]}
+    seconds = statistics.median(run['seconds'] for run in runs)
+    cpu_seconds = statistics.median(run['cpu_seconds'] for run in runs)
+    files, total_bytes = tree_stats
+    return {
+        'seconds': round(seconds, 3),
+        'mb_per_s': round(total_bytes / seconds / 1e6, 2),
+        'files_per_s': round(files / seconds, 1),
+        'cpu_percent': round(cpu_seconds / seconds * 100, 1),
+        'peak_rss_mb': round(max(run['peak_rss_mb'] for run in runs), 1)
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Regressions against a saved run: lower MB/s or higher peak RSS beyond tolerance"""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before or 'error' in before:
+            continue
+        if 'error' in result:
+            regressions.append(f"{name}: failed ({result['error']})")
+            continue
+        if result['mb_per_s'] < before['mb_per_s'] * (1 - tolerance):
+            regressions.append(f"{name}: {result['mb_per_s']} MB/s, was {before['mb_per_s']}")
+        if result['peak_rss_mb'] > before['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{name}: peak RSS {result['peak_rss_mb']} MB, was {before['peak_rss_mb']}")
+    return regressions
+
+
+def print_table(results):
+    print(f"{'scenario':<28}{'MB/s':>10}{'files/s':>12}{'CPU %':>9}{'peak RSS MB':>13}{'seconds':>10}")
+    for name, result in results.items():
+        if 'error' in result:
+            print(f"{name:<28}  FAILED: {result['error']}")
+        else:
+            print(f"{name:<28}{result['mb_per_s']:>10}{result['files_per_s']:>12}{result['cpu_percent']:>9}"
+                  f"{result['peak_rss_mb']:>13}{result['seconds']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the transfer tasks against localhost stand-in hosts")
+    parser.add_argument('--targets', nargs='+', choices=list(TARGETS), default=list(TARGETS))
+    parser.add_argument('--trees', nargs='+', choices=TREES, default=TREES)
+    parser.add_argument('--latency-ms', type=float, default=0, help="one-way latency added to each host link")
+    parser.add_argument('--bandwidth-mbit', type=float, default=0, help="bandwidth cap per host link, 0 for none")
+    parser.add_argument('--codec', default='none', help="tar codec for archive/stream/sharded modes")
+    parser.add_argument('--big-mb', type=int, default=256, help="size of the big tree")
+    parser.add_argument('--small-files', type=int, default=5000, help="files in the small tree")
+    parser.add_argument('--small-kb', type=int, default=8, help="average size of a small file")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per scenario; the median is reported")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--work-dir', help="where trees and host roots go (default: a temporary directory)")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="JSON file from --save to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--verbose', action='store_true', help="show the transfer logs")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    work = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix='transfer-bench-'))
+    roots = [os.path.join(work, 'pisms'), os.path.join(work, 'pimaster')]
+
+    identity_file = os.path.join(work, 'id_rsa')
+    paramiko.RSAKey.generate(2048).write_private_key_file(identity_file)
+
+    tree_stats = {}
+    for tree in args.trees:
+        tree_root = os.path.join(roots[0], 'trees', tree)
+        shutil.rmtree(tree_root, ignore_errors=True)
+        tree_stats[tree] = make_tree(tree_root, tree, args)
+        print(f"Tree {tree}: {tree_stats[tree][0]} files, {tree_stats[tree][1] / 1e6:.1f} MB")
+
+    parent_conn, child_conn = ctx.Pipe()
+    hosts = ctx.Process(target=serve_hosts, args=(roots, args.latency_ms, args.bandwidth_mbit * 125000, child_conn),
+                        daemon=True)
+    hosts.start()
+    source_port, dest_port = parent_conn.recv()
+    server_configs = {
+        'pisms': {'host': '127.0.0.1', 'user': 'bench', 'port': source_port},
+        'pimaster': {'host': '127.0.0.1', 'user': 'bench', 'port': dest_port}
+    }
+
+    results = {}
+    try:
+        for target in args.targets:
+            for tree in args.trees:
+                name = f"{target}/{tree}"
+                runs = [run_once(ctx, f"{target}-{tree}-{i}", target, tree, tree_stats[tree], args, work,
+                                 server_configs, identity_file)
+                        for i in range(args.repeat)]
+                results[name] = summarize(runs, tree_stats[tree])
+                print(f"{name}: {results[name]}", flush=True)
+    finally:
+        hosts.terminate()
+        if not args.work_dir:
+            shutil.rmtree(work, ignore_errors=True)
+
+    print()
+    print_table(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
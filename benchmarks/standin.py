@@ -0,0 +1,311 @@
+"""
+Localhost stand-ins for the pisms/pimaster storage hosts.
+
+StandInHost is an SSH server built on paramiko's server interface: it accepts any
+public key, runs exec requests through bash in its root directory (tar, find,
+sha256sum, ... behave as on the real hosts) and serves SFTP from the local
+filesystem, with relative paths resolved against the same root. Absolute paths are
+used as they are, so a benchmark keeps each host's trees under that host's root.
+
+ShapedProxy sits in front of a stand-in and adds one-way latency and a bandwidth
+cap in both directions, to look like a real link between the worker and a host.
+
+    python -m benchmarks.standin --root /tmp/pisms --latency-ms 5 --bandwidth-mbit 1000
+"""
+import argparse
+import os
+import queue
+import socket
+import subprocess
+import threading
+import time
+import paramiko
+
+EXEC_CHUNK_SIZE = 65536
+PROXY_CHUNK_SIZE = 65536
+
+
+class StandInSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            if attr.st_size is not None:
+                self.writefile.truncate(attr.st_size)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class StandInSFTPServer(paramiko.SFTPServerInterface):
+    """SFTP server backed by the local filesystem; relative paths start at the host's root"""
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = server.root
+
+    def _path(self, path):
+        return os.path.join(self.root, path)
+
+    def canonicalize(self, path):
+        return os.path.normpath(self._path(path))
+
+    def list_folder(self, path):
+        try:
+            entries = []
+            for name in os.listdir(self._path(path)):
+                attr = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(self._path(path), name)))
+                attr.filename = name
+                entries.append(attr)
+            return entries
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._path(path), flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = StandInSFTPHandle(flags)
+        handle.filename = self._path(path)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        return self._call(os.remove, self._path(path))
+
+    def rename(self, oldpath, newpath):
+        return self._call(os.rename, self._path(oldpath), self._path(newpath))
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, self._path(path))
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, self._path(path))
+
+    def chattr(self, path, attr):
+        return self._call(paramiko.SFTPServer.set_file_attr, self._path(path), attr)
+
+    def utime(self, path, attr):
+        return self.chattr(path, attr)
+
+    @staticmethod
+    def _call(func, *args):
+        try:
+            func(*args)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class StandInServer(paramiko.ServerInterface):
+    """Accepts any public key and runs exec requests through bash in the host's root"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=run_exec, args=(channel, command.decode(), self.root),
+                         name="standin-exec", daemon=True).start()
+        return True
+
+
+def run_exec(channel, command, cwd):
+    """Run command with the channel as its stdin/stdout/stderr and report the exit status"""
+    proc = subprocess.Popen(['bash', '-c', command], cwd=cwd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def pump_stdin():
+        try:
+            while True:
+                data = channel.recv(EXEC_CHUNK_SIZE)
+                if not data:
+                    break
+                proc.stdin.write(data)
+        except (OSError, EOFError):
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    def pump_stderr():
+        for data in iter(lambda: proc.stderr.read1(EXEC_CHUNK_SIZE), b''):
+            channel.sendall_stderr(data)
+
+    pumps = [threading.Thread(target=pump_stdin, daemon=True), threading.Thread(target=pump_stderr, daemon=True)]
+    for pump in pumps:
+        pump.start()
+    try:
+        for data in iter(lambda: proc.stdout.read1(EXEC_CHUNK_SIZE), b''):
+            channel.sendall(data)
+        pumps[1].join()
+        channel.send_exit_status(proc.wait())
+        channel.shutdown_write()
+    except (OSError, EOFError):
+        proc.kill()
+    finally:
+        channel.close()
+
+
+class StandInHost:
+    """A localhost SSH/SFTP server on an ephemeral port, serving files from `root`"""
+
+    def __init__(self, root, bind='127.0.0.1', port=0):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((bind, port))
+        self.sock.listen(100)
+        self.port = self.sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve, name="standin-accept", daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            server = StandInServer(self.root)
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, StandInSFTPServer)
+            transport.start_server(server=server)
+
+    def close(self):
+        self.sock.close()
+
+
+class ShapedProxy:
+    """
+    TCP proxy to target_port that delays every chunk by `latency_ms` and paces each
+    direction to `bandwidth_bps` bytes/s (0 for no cap). Chunks are released in
+    order: a chunk leaves `latency` after it arrived, but never before the previous
+    one has finished serialising at the capped rate.
+    """
+
+    def __init__(self, target_port, latency_ms=0, bandwidth_bps=0, target_host='127.0.0.1', bind='127.0.0.1', port=0):
+        self.target = (target_host, target_port)
+        self.latency = latency_ms / 1000
+        self.bandwidth = bandwidth_bps
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((bind, port))
+        self.sock.listen(100)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._serve, name="proxy-accept", daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(self.target)
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Both sockets are closed once both directions have seen EOF
+            connection = {'open': 2, 'lock': threading.Lock(), 'sockets': (client, upstream)}
+            self._pipe(client, upstream, connection)
+            self._pipe(upstream, client, connection)
+
+    def _pipe(self, src, dst, connection):
+        chunks = queue.Queue()
+
+        def read():
+            try:
+                for data in iter(lambda: src.recv(PROXY_CHUNK_SIZE), b''):
+                    chunks.put((time.monotonic() + self.latency, data))
+            except OSError:
+                pass
+            chunks.put((time.monotonic() + self.latency, None))
+
+        def write():
+            line_free = 0.0
+            try:
+                while True:
+                    due, data = chunks.get()
+                    send_at = max(due, line_free)
+                    delay = send_at - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    if data is None:
+                        dst.shutdown(socket.SHUT_WR)
+                        break
+                    dst.sendall(data)
+                    line_free = send_at + (len(data) / self.bandwidth if self.bandwidth else 0)
+            except OSError:
+                pass
+            with connection['lock']:
+                connection['open'] -= 1
+                if connection['open'] == 0:
+                    for sock in connection['sockets']:
+                        sock.close()
+
+        threading.Thread(target=read, name="proxy-read", daemon=True).start()
+        threading.Thread(target=write, name="proxy-write", daemon=True).start()
+
+    def close(self):
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a stand-in storage host on localhost")
+    parser.add_argument('--root', required=True, help="directory exec commands and relative SFTP paths start in")
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--bandwidth-mbit', type=float, default=0, help="0 for no cap")
+    args = parser.parse_args()
+
+    shaped = args.latency_ms or args.bandwidth_mbit
+    host = StandInHost(args.root, port=0 if shaped else args.port)
+    port = host.port
+    if shaped:
+        port = ShapedProxy(host.port, args.latency_ms, args.bandwidth_mbit * 125000, port=args.port).port
+    print(f"Stand-in host serving {host.root} on 127.0.0.1:{port}", flush=True)
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ from app.logging.logger import logger
 from typing import List, Dict
 from app.websocket.connection_manager import manager
 from app.utils.job_monitor import job_monitor
+from app.websocket.event_bus import event_subscriber
 import asyncio
 
 # Funktion som körs när vi startar FastAPI -
@@ -18,13 +19,16 @@ import asyncio
 async def lifespan(app: FastAPI):
     # Startup: initialize database and start job monitor
     init_db()
-    # monitor_task = asyncio.create_task(job_monitor.start_monitoring())
+    # Follow the transfer tasks' Celery events and push job changes to the sockets here
+    job_monitor.start()
+    # Deliver the events workers publish to the sockets this process holds
+    event_subscriber.start()
 
     yield  # Server is running
     
     # Shutdown: stop job monitor
-    # job_monitor.stop_monitoring()
-    # await monitor_task  # Wait for the monitoring task to complete
+    await event_subscriber.stop()
+    await job_monitor.stop()
 
 
 
@@ -58,16 +62,29 @@ app.include_router(v1_router, prefix="/v1")
 
 
 # New user notifications WebSocket endpoint
+# Without a subscription a socket gets every job of its user. Messages from the client:
+#   {"type": "subscribe", "job_ids": [...]}    only these jobs from now on (plus earlier subscriptions)
+#   {"type": "unsubscribe", "job_ids": [...]}
+# Job states arrive merged into {"type": "job_updates", "updates": [...]} frames,
+# at most WS_UPDATES_PER_SECOND per socket.
 @app.websocket("/v1/ws/user/{user_id}")
 async def user_websocket_endpoint(websocket: WebSocket, user_id: int):
     try:
-        await manager.connect_to_user(websocket, user_id)
+        connection = await manager.connect_to_user(websocket, user_id)
         while True:
-            # Receive job IDs to monitor
             data = await websocket.receive_json()
-            # if data["type"] == "monitor_jobs":
-            #     job_ids = data["job_ids"]
-            #     # Start monitoring these jobs
-            #     asyncio.create_task(monitor_jobs(user_id, job_ids))
+            if not isinstance(data, dict):
+                continue
+            job_ids = data.get("job_ids") or []
+            if not isinstance(job_ids, list):
+                job_ids = [job_ids]
+            # monitor_jobs is what older clients send
+            if data.get("type") in ("subscribe", "monitor_jobs"):
+                await job_monitor.subscribe(connection, job_ids)
+            elif data.get("type") == "unsubscribe":
+                job_monitor.unsubscribe(connection, job_ids)
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Also after a malformed message; leaves the job streams of the socket
         manager.disconnect_from_user(websocket, user_id)
@@ -1,3 +1,5 @@
 #! /bin/bash
 
-celery -A app.celery_app worker --pool=solo --loglevel=info
\ No newline at end of file
+# Transfers mostly wait on the network, so one process runs several of them on a
+# thread pool; app.utils.job_slots reads the same variable and also caps jobs per host
+celery -A app.celery_app worker --pool=threads --concurrency=${TRANSFER_JOBS_PER_PROCESS:-4} --loglevel=info
\ No newline at end of file
@@ -0,0 +1,8 @@
+import os
+from onelogin.saml2.idp_metadata_parser import OneLogin_Saml2_IdPMetadataParser
+
+# Importing anything under app runs app/__init__, which loads every router: the
+# engine needs a DB_URL and the login router fetches the IdP metadata on import.
+# The tests bring their own fakes, so neither has to exist.
+os.environ.setdefault('DB_URL', 'sqlite://')
+OneLogin_Saml2_IdPMetadataParser.parse_remote = staticmethod(lambda url, **kwargs: {})
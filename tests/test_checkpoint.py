@@ -0,0 +1,146 @@
+import os
+import pytest
+import app.utils.checkpoint as checkpoint
+from app.utils.checkpoint import Checkpointer, resume_items, TAIL_WINDOW
+
+MIB = 1024 * 1024
+CHUNK = 256 * 1024
+
+
+class FakeFile:
+    """Destination file handle: writes into a shared bytearray"""
+
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.position = 0
+
+    def seek(self, position):
+        self.position = position
+
+    def read(self, length):
+        data = bytes(self.store[self.path][self.position:self.position + length])
+        self.position += len(data)
+        return data
+
+    def write(self, data):
+        buffer = self.store.setdefault(self.path, bytearray())
+        end = self.position + len(data)
+        if len(buffer) < end:
+            buffer.extend(b'\0' * (end - len(buffer)))
+        buffer[self.position:end] = data
+        self.position = end
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def flush(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeSFTP:
+    def __init__(self):
+        self.store = {}
+
+    def file(self, path, mode):
+        if mode == 'rb' and path not in self.store:
+            raise IOError(f"No such file: {path}")
+        return FakeFile(self.store, path)
+
+
+@pytest.fixture
+def saved(monkeypatch):
+    """Checkpoints kept in memory instead of the database"""
+    rows = {}
+
+    def save_checkpoint(job_id, source_path, dest_path, file_size, range_start, range_end, offset, digest, tail_digest):
+        rows[(dest_path, range_start)] = {
+            'source_path': source_path,
+            'file_size': file_size,
+            'range_end': range_end,
+            'offset': offset,
+            'digest': digest,
+            'tail_digest': tail_digest
+        }
+
+    monkeypatch.setattr(checkpoint, 'save_checkpoint', save_checkpoint)
+    monkeypatch.setattr(checkpoint, 'load_checkpoints', lambda job_id: dict(rows))
+    return rows
+
+
+def copy(checkpointer, sftp, data, start, end):
+    """Write data[start:end] through the checkpointer, then save as a pause would"""
+    dfh = sftp.file(checkpointer.dest_path, 'r+b')
+    dfh.seek(start)
+    for position in range(start, end, CHUNK):
+        checkpointer.write(dfh, data[position:min(position + CHUNK, end)])
+    checkpointer.save()
+
+
+def resume(sftp, data):
+    items, checkpointers, bytes_done = resume_items(1, sftp, [('/src/big', '/dst/big', len(data), 0, None)])
+    (_, dest_path, _, start, _), = items
+    return checkpointers[(dest_path, start)], start, bytes_done
+
+
+def test_resumes_twice_with_less_than_a_tail_window_in_between(saved):
+    data = os.urandom(4 * MIB)
+    sftp = FakeSFTP()
+
+    first = Checkpointer(1, '/src/big', '/dst/big', len(data), 0, len(data), interval_bytes=MIB)
+    copy(first, sftp, data, 0, 2 * MIB + CHUNK)
+
+    second, start, bytes_done = resume(sftp, data)
+    assert start == bytes_done == 2 * MIB + CHUNK
+    # Stopped again after fewer than TAIL_WINDOW bytes
+    assert CHUNK < TAIL_WINDOW
+    copy(second, sftp, data, start, start + CHUNK)
+
+    third, start, bytes_done = resume(sftp, data)
+    assert start == bytes_done == 2 * MIB + 2 * CHUNK
+    copy(third, sftp, data, start, len(data))
+
+    assert bytes(sftp.store['/dst/big']) == data
+    assert saved[('/dst/big', 0)]['offset'] == len(data)
+
+
+def test_restarts_when_the_destination_tail_changed(saved):
+    data = os.urandom(2 * MIB)
+    sftp = FakeSFTP()
+
+    first = Checkpointer(1, '/src/big', '/dst/big', len(data), 0, len(data), interval_bytes=MIB)
+    copy(first, sftp, data, 0, MIB + CHUNK)
+    sftp.store['/dst/big'][MIB] ^= 0xff
+
+    _, start, bytes_done = resume(sftp, data)
+    assert start == bytes_done == 0
+
+
+def test_restart_rewinds_to_the_resumed_offset(saved):
+    data = os.urandom(3 * MIB)
+    sftp = FakeSFTP()
+
+    first = Checkpointer(1, '/src/big', '/dst/big', len(data), 0, len(data), interval_bytes=MIB)
+    copy(first, sftp, data, 0, MIB + CHUNK)
+
+    second, start, _ = resume(sftp, data)
+    copy(second, sftp, data, start, len(data))
+    assert saved[('/dst/big', 0)]['offset'] == len(data)
+    digest = saved[('/dst/big', 0)]['digest']
+
+    # The copy failed verification: the retry starts over from the resumed offset
+    second.restart()
+    assert saved[('/dst/big', 0)]['offset'] == start
+    _, restarted, bytes_done = resume(sftp, data)
+    assert restarted == bytes_done == start
+
+    copy(second, sftp, data, start, len(data))
+    assert saved[('/dst/big', 0)]['offset'] == len(data)
+    assert saved[('/dst/big', 0)]['digest'] == digest
+
@@ -0,0 +1,87 @@
+import pytest
+from app.utils.compression import (
+    CODECS, validate_codec, pick_codec, codec_label, parse_codec_label, tar_flags, compressor_command
+)
+
+MB = 1000 * 1000
+LINK = 100 * MB
+SAMPLE = 32 * MB
+
+
+@pytest.mark.parametrize('codec', list(CODECS) + ['auto'])
+def test_every_codec_is_valid_without_a_level(codec):
+    assert validate_codec(codec) is None
+
+
+def test_unknown_codec_is_rejected():
+    assert 'must be one of' in validate_codec('brotli')
+
+
+@pytest.mark.parametrize('codec', ['none', 'auto'])
+def test_codecs_without_levels_reject_one(codec):
+    assert 'does not take a level' in validate_codec(codec, 1)
+
+
+@pytest.mark.parametrize('codec, level', [('zstd', 1), ('zstd', 19), ('gzip', 9), ('lz4', 12)])
+def test_levels_within_bounds(codec, level):
+    assert validate_codec(codec, level) is None
+
+
+@pytest.mark.parametrize('codec, level', [('zstd', 0), ('zstd', 20), ('gzip', 10), ('lz4', -1)])
+def test_levels_out_of_bounds(codec, level):
+    assert 'must be between 1 and' in validate_codec(codec, level)
+
+
+@pytest.mark.parametrize('codec, level, label', [('none', None, 'none'), ('zstd', None, 'zstd:3'), ('gzip', 9, 'gzip:9')])
+def test_codec_labels_round_trip(codec, level, label):
+    assert codec_label(codec, level) == label
+    parsed_codec, parsed_level = parse_codec_label(label)
+    assert parsed_codec == codec
+    assert parsed_level == (level if level is not None else CODECS[codec]['default_level'])
+
+
+def test_tar_flags():
+    assert tar_flags('none') == ""
+    assert tar_flags('zstd', 5) == "-I 'zstd -T0 -5'"
+    assert compressor_command('gzip') == 'gzip -6'
+
+
+def seconds_at(rate):
+    return SAMPLE / rate
+
+
+def test_no_candidates_means_no_compression():
+    assert pick_codec(SAMPLE, {}, LINK) == ('none', None)
+
+
+def test_incompressible_data_stays_uncompressed():
+    results = {('lz4', 1): (SAMPLE - 1000, seconds_at(2000 * MB)), ('zstd', 1): (SAMPLE - 2000, seconds_at(800 * MB))}
+    assert pick_codec(SAMPLE, results, LINK) == ('none', None)
+
+
+def test_picks_the_best_end_to_end_rate():
+    results = {
+        # Ratio 2, fast: 200 MB/s over the link
+        ('lz4', 1): (SAMPLE // 2, seconds_at(1000 * MB)),
+        # Ratio 4 but compresses at 300 MB/s: 300 MB/s end to end
+        ('zstd', 3): (SAMPLE // 4, seconds_at(300 * MB)),
+        # Ratio 5 but compresses at 50 MB/s: slower than sending it raw
+        ('gzip', 6): (SAMPLE // 5, seconds_at(50 * MB)),
+    }
+    assert pick_codec(SAMPLE, results, LINK) == ('zstd', 3)
+
+
+def test_slow_compressor_loses_to_the_raw_link():
+    results = {('gzip', 6): (SAMPLE // 10, seconds_at(60 * MB))}
+    assert pick_codec(SAMPLE, results, LINK) == ('none', None)
+
+
+@pytest.mark.parametrize('rate, expected', [(104 * MB, ('none', None)), (106 * MB, ('lz4', 1))])
+def test_a_candidate_must_beat_the_best_by_the_minimum_gain(rate, expected):
+    results = {('lz4', 1): (SAMPLE // 10, seconds_at(rate))}
+    assert pick_codec(SAMPLE, results, LINK) == expected
+
+
+def test_instant_compression_is_limited_by_the_link():
+    results = {('lz4', 1): (SAMPLE // 2, 0), ('zstd', 1): (SAMPLE // 3, 0)}
+    assert pick_codec(SAMPLE, results, LINK) == ('zstd', 1)
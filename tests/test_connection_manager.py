@@ -0,0 +1,167 @@
+import asyncio
+import pytest
+import app.websocket.connection_manager as connection_manager
+from app.websocket.connection_manager import ClientConnection, is_progress_frame
+
+
+class FakeWebSocket:
+    """Records sent frames; a stalled one never finishes a send"""
+
+    def __init__(self, stalled=False, fail=False):
+        self.stalled = stalled
+        self.fail = fail
+        self.sent = []
+        self.closed = False
+
+    async def send_json(self, message):
+        if self.fail:
+            raise ConnectionError("client went away")
+        if self.stalled:
+            await asyncio.Event().wait()
+        self.sent.append(message)
+
+    async def close(self):
+        self.closed = True
+
+
+def progress(job_id, percent):
+    return {'type': 'transfer_progress', 'job_id': job_id, 'progress': percent, 'error': None}
+
+
+def event(job_id, status):
+    return {'type': 'job_updates', 'updates': [{'job_id': job_id, 'status': status}]}
+
+
+def run(test):
+    """Run test(connection_factory) in a fresh event loop, closing its connections after"""
+    async def main():
+        connections = []
+
+        def connect(websocket=None, on_close=lambda connection: None):
+            connection = ClientConnection(websocket or FakeWebSocket(stalled=True), 1, on_close)
+            connections.append(connection)
+            return connection
+
+        try:
+            await test(connect)
+        finally:
+            for connection in connections:
+                connection.close()
+    asyncio.run(main())
+
+
+@pytest.fixture
+def small_queue(monkeypatch):
+    monkeypatch.setattr(connection_manager, 'WS_QUEUE_SIZE', 3)
+
+
+@pytest.mark.parametrize('message, expected', [
+    (progress(1, 0), True),
+    (progress(1, 99), True),
+    (progress(1, 100), False),
+    (progress(1, -1), False),
+    ({**progress(1, 50), 'error': 'boom'}, False),
+    (event(1, 'in_progress'), True),
+    (event(1, 'completed'), False),
+    ({'type': 'job_updates', 'updates': [{'status': 'in_progress'}, {'status': 'failed'}]}, False),
+    ({'type': 'notification'}, False),
+])
+def test_is_progress_frame(message, expected):
+    assert is_progress_frame(message) is expected
+
+
+def queued(connection):
+    return [message for _, message in connection.queue]
+
+
+def test_full_queue_drops_the_oldest_progress_frame(small_queue):
+    async def test(connect):
+        connection = connect()
+        connection.put(event(1, 'pending'))
+        connection.put(progress(1, 10))
+        connection.put(progress(1, 20))
+        connection.put(progress(1, 30))
+        assert queued(connection) == [event(1, 'pending'), progress(1, 20), progress(1, 30)]
+        assert connection.dropped == 1
+    run(test)
+
+
+def test_full_queue_of_events_drops_a_new_progress_frame(small_queue):
+    async def test(connect):
+        connection = connect()
+        events = [event(1, 'pending'), event(1, 'paused'), event(1, 'failed')]
+        for message in events:
+            connection.put(message)
+        connection.put(progress(2, 50))
+        assert queued(connection) == events
+        assert connection.dropped == 1
+    run(test)
+
+
+def test_full_queue_of_events_still_takes_an_event(small_queue):
+    async def test(connect):
+        connection = connect()
+        for status in ('pending', 'failed', 'completed'):
+            connection.put(event(1, status))
+        connection.put(event(2, 'completed'))
+        assert len(connection.queue) == 4
+        assert connection.dropped == 0
+    run(test)
+
+
+def test_closed_connection_takes_nothing():
+    async def test(connect):
+        connection = connect()
+        connection.close()
+        connection.put(event(1, 'completed'))
+        connection.push_update({'job_id': 1, 'status': 'completed'})
+        assert not connection.queue and not connection.updates
+    run(test)
+
+
+def test_updates_are_coalesced_per_job():
+    async def test(connect):
+        connection = connect()
+        connection.push_update({'job_id': 1, 'percent': 10})
+        connection.push_update({'job_id': 2, 'percent': 5})
+        connection.push_update({'job_id': 1, 'percent': 20})
+        assert connection.updates == {1: {'job_id': 1, 'percent': 20}, 2: {'job_id': 2, 'percent': 5}}
+        assert connection.coalesced == 1
+    run(test)
+
+
+def test_updates_go_out_together_at_the_rate_limit(monkeypatch):
+    monkeypatch.setattr(connection_manager, 'WS_UPDATE_INTERVAL', 0.2)
+
+    async def test(connect):
+        websocket = FakeWebSocket()
+        connection = connect(websocket)
+        connection.push_update({'job_id': 1, 'percent': 10})
+        await asyncio.sleep(0.05)
+        assert websocket.sent == [{'type': 'job_updates', 'updates': [{'job_id': 1, 'percent': 10}]}]
+
+        # Within the interval: merged and held back, other frames still go out
+        connection.push_update({'job_id': 1, 'percent': 20})
+        connection.push_update({'job_id': 2, 'percent': 5})
+        connection.push_update({'job_id': 1, 'percent': 30})
+        connection.put(event(3, 'completed'))
+        await asyncio.sleep(0.05)
+        assert websocket.sent[1:] == [event(3, 'completed')]
+
+        await asyncio.sleep(0.25)
+        assert websocket.sent[2:] == [
+            {'type': 'job_updates', 'updates': [{'job_id': 1, 'percent': 30}, {'job_id': 2, 'percent': 5}]}
+        ]
+    run(test)
+
+
+def test_failed_send_closes_the_connection():
+    async def test(connect):
+        closed = []
+        websocket = FakeWebSocket(fail=True)
+        connection = connect(websocket, on_close=closed.append)
+        connection.put(event(1, 'completed'))
+        await asyncio.sleep(0.05)
+        assert closed == [connection]
+        assert websocket.closed
+    run(test)
@@ -0,0 +1,49 @@
+import hashlib
+import shutil
+import subprocess
+import pytest
+from app.utils.integrity import parse_sha256sum_line, combined_digest
+
+DIGEST = hashlib.sha256(b'data').hexdigest()
+
+
+def test_plain_line():
+    assert parse_sha256sum_line(f"{DIGEST}  ./a/b.txt") == ('./a/b.txt', DIGEST)
+
+
+def test_path_with_double_spaces():
+    assert parse_sha256sum_line(f"{DIGEST}  ./a  b") == ('./a  b', DIGEST)
+
+
+@pytest.mark.parametrize('escaped, path', [
+    ('./line\\nbreak', './line\nbreak'),
+    ('./carriage\\rreturn', './carriage\rreturn'),
+    ('./back\\\\slash', './back\\slash'),
+    ('./both\\\\n', './both\\n'),
+])
+def test_escaped_names(escaped, path):
+    assert parse_sha256sum_line(f"\\{DIGEST}  {escaped}") == (path, DIGEST)
+
+
+def test_backslash_without_escaping_is_kept():
+    # Only a line starting with a backslash uses escapes
+    assert parse_sha256sum_line(f"{DIGEST}  ./a\\nb") == ('./a\\nb', DIGEST)
+
+
+@pytest.mark.skipif(not shutil.which('sha256sum'), reason="needs coreutils sha256sum")
+@pytest.mark.parametrize('name', ['plain', 'two  spaces', 'new\nline', 'back\\slash', 'mixed\\\nname'])
+def test_matches_real_sha256sum_output(tmp_path, name):
+    (tmp_path / name).write_bytes(b'data')
+    output = subprocess.run(['sha256sum', '--', name], cwd=tmp_path, capture_output=True, check=True).stdout
+    assert parse_sha256sum_line(output.decode().rstrip('\n')) == (name, DIGEST)
+
+
+def test_combined_digest_does_not_depend_on_order():
+    digests = {('/dst/a', 0): (4, DIGEST, False), ('/dst/b', 0): (10, DIGEST, True), ('/dst/b', 10): (10, DIGEST, True)}
+    reordered = dict(reversed(list(digests.items())))
+    assert combined_digest(digests) == combined_digest(reordered)
+    assert combined_digest(digests).startswith('sha256:')
+
+
+def test_combined_digest_covers_offsets():
+    assert combined_digest({('/dst/b', 0): (10, DIGEST, True)}) != combined_digest({('/dst/b', 10): (10, DIGEST, True)})
@@ -0,0 +1,141 @@
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+import app.utils.job_monitor as job_monitor
+from app.database.models.base_model import Base
+from app.database.models.models import User, Job, JobStatus
+from app.utils.job_monitor import job_status_from_task, reconcile_jobs
+
+
+@pytest.mark.parametrize('meta, expected', [
+    ({'status': 'SUCCESS', 'result': {'status': 'completed'}}, JobStatus.COMPLETED),
+    ({'status': 'SUCCESS', 'result': {'status': 'paused'}}, JobStatus.PAUSED),
+    ({'status': 'SUCCESS', 'result': {'status': 'cancelled'}}, JobStatus.CANCELLED),
+    ({'status': 'SUCCESS', 'result': None}, JobStatus.COMPLETED),
+    # A fanned-out parent's subtasks report the outcome
+    ({'status': 'SUCCESS', 'result': {'status': 'fanned_out'}}, None),
+    ({'status': 'STARTED', 'result': None}, JobStatus.IN_PROGRESS),
+    ({'status': 'RETRY', 'result': None}, JobStatus.PENDING),
+    ({'status': 'FAILURE', 'result': {'exc_type': 'Exception'}}, JobStatus.FAILED),
+    ({'status': 'REVOKED', 'result': None}, JobStatus.CANCELLED),
+    # Set by the task itself with update_state
+    ({'status': 'in_progress', 'result': {'percent': 10}}, JobStatus.IN_PROGRESS),
+    ({'status': 'PENDING', 'result': None}, None),
+    ({}, None),
+])
+def test_job_status_from_task(meta, expected):
+    assert job_status_from_task(meta) == expected
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """In-memory database for the monitor, counting the UPDATEs it runs"""
+    engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+    Base.metadata.create_all(engine, tables=[User.__table__, Job.__table__])
+    engine.updates = []
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_updates(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('UPDATE'):
+            engine.updates.append(statement)
+
+    monkeypatch.setattr(job_monitor, 'engine', engine)
+    with Session(engine) as session:
+        session.add(User(org='org', name='name', email='user@example.com'))
+        session.commit()
+    return engine
+
+
+@pytest.fixture
+def results(monkeypatch):
+    """Result-backend entries by task id"""
+    entries = {}
+    monkeypatch.setattr(job_monitor, 'fetch_task_results',
+                        lambda task_ids: {task_id: entries[task_id] for task_id in task_ids if task_id in entries})
+    return entries
+
+
+def add_job(engine, status, task_id=None):
+    with Session(engine) as session:
+        job = Job(user_id=1, source_storage='/src', dest_storage='/dst', status=status, task_id=task_id)
+        session.add(job)
+        session.commit()
+        return job.id
+
+
+def statuses(engine):
+    with Session(engine) as session:
+        return {job.id: job.status for job in session.query(Job)}
+
+
+def by_job(states):
+    return {state['job_id']: state for state in states}
+
+
+def test_nothing_to_reconcile(db, results):
+    assert reconcile_jobs([]) == []
+    assert db.updates == []
+
+
+def test_finished_tasks_fix_their_jobs_in_one_update(db, results):
+    completed = add_job(db, JobStatus.IN_PROGRESS, 'task-1')
+    failed = add_job(db, JobStatus.PENDING, 'task-2')
+    paused = add_job(db, JobStatus.IN_PROGRESS, 'task-3')
+    results.update({
+        'task-1': {'status': 'SUCCESS', 'result': {'status': 'completed'}},
+        'task-2': {'status': 'FAILURE', 'result': None},
+        'task-3': {'status': 'SUCCESS', 'result': {'status': 'paused'}},
+    })
+
+    states = by_job(reconcile_jobs([]))
+    assert {job_id: state['status'] for job_id, state in states.items()} == {
+        completed: JobStatus.COMPLETED, failed: JobStatus.FAILED, paused: JobStatus.PAUSED
+    }
+    assert statuses(db) == {completed: JobStatus.COMPLETED, failed: JobStatus.FAILED, paused: JobStatus.PAUSED}
+    assert len(db.updates) == 1
+
+
+def test_running_task_carries_its_progress(db, results):
+    job_id = add_job(db, JobStatus.PENDING, 'task-1')
+    results['task-1'] = {'status': 'in_progress', 'result': {'current': 50, 'total': 100, 'percent': 50,
+                                                             'rate': 10, 'eta': 5, 'task_id': 'task-1'}}
+
+    state = by_job(reconcile_jobs([]))[job_id]
+    assert state['status'] == JobStatus.IN_PROGRESS
+    assert {field: state[field] for field in ('current', 'total', 'percent', 'rate', 'eta')} == {
+        'current': 50, 'total': 100, 'percent': 50, 'rate': 10, 'eta': 5
+    }
+    assert statuses(db)[job_id] == JobStatus.IN_PROGRESS
+
+
+def test_jobs_are_never_moved_backwards(db, results):
+    running = add_job(db, JobStatus.IN_PROGRESS, 'task-1')
+    finished = add_job(db, JobStatus.COMPLETED, 'task-2')
+    results.update({
+        'task-1': {'status': 'RETRY', 'result': None},
+        'task-2': {'status': 'STARTED', 'result': None},
+    })
+
+    states = by_job(reconcile_jobs([finished]))
+    assert states[running]['status'] == JobStatus.IN_PROGRESS
+    assert states[finished]['status'] == JobStatus.COMPLETED
+    assert db.updates == []
+
+
+def test_only_active_and_known_jobs_are_read(db, results):
+    active = add_job(db, JobStatus.PENDING)
+    known = add_job(db, JobStatus.CANCELLED)
+    add_job(db, JobStatus.COMPLETED)
+
+    assert sorted(by_job(reconcile_jobs([known]))) == [active, known]
+
+
+def test_jobs_without_a_task_result_keep_their_status(db, results):
+    no_task = add_job(db, JobStatus.PENDING)
+    expired = add_job(db, JobStatus.IN_PROGRESS, 'task-gone')
+
+    states = by_job(reconcile_jobs([]))
+    assert states[no_task]['status'] == JobStatus.PENDING
+    assert states[expired]['status'] == JobStatus.IN_PROGRESS
+    assert db.updates == []
@@ -0,0 +1,132 @@
+import threading
+import time
+import pytest
+from app.utils.job_slots import JobSlots
+
+TIMEOUT = 5
+
+
+class Job:
+    """A transfer holding its slot in a thread until released"""
+
+    def __init__(self, slots, hosts):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        waiting = len(slots._waiting)
+        self.thread = threading.Thread(target=self._run, args=(slots, hosts), daemon=True)
+        self.thread.start()
+        # Queued (or already running) before the next job arrives
+        wait_until(lambda: self.started.is_set() or len(slots._waiting) > waiting)
+
+    def _run(self, slots, hosts):
+        with slots.slot(hosts):
+            self.started.set()
+            self.release.wait(TIMEOUT)
+
+    def finish(self):
+        self.release.set()
+        self.thread.join(TIMEOUT)
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def running(*jobs):
+    return [job.started.is_set() for job in jobs]
+
+
+@pytest.fixture
+def jobs():
+    started = []
+    yield started
+    # Release everything first: a waiting job only gets to finish once the others do
+    for job in started:
+        job.release.set()
+    for job in started:
+        job.finish()
+
+
+def start(jobs, slots, *hosts):
+    job = Job(slots, hosts)
+    jobs.append(job)
+    return job
+
+
+def test_per_process_limit(jobs):
+    slots = JobSlots(per_process=2, per_host=10)
+    first, second, third = (start(jobs, slots, f'src{i}', f'dst{i}') for i in range(3))
+    assert running(first, second, third) == [True, True, False]
+
+    first.finish()
+    wait_until(lambda: third.started.is_set())
+
+
+def test_per_host_limit(jobs):
+    slots = JobSlots(per_process=10, per_host=1)
+    first = start(jobs, slots, 'a', 'b')
+    same_source = start(jobs, slots, 'a', 'c')
+    same_dest = start(jobs, slots, 'd', 'b')
+    other = start(jobs, slots, 'd', 'e')
+    assert running(first, same_source, same_dest, other) == [True, False, False, True]
+    assert slots.running() == {'a': 1, 'b': 1, 'd': 1, 'e': 1}
+
+
+def test_same_host_on_both_sides_takes_one_host_slot(jobs):
+    slots = JobSlots(per_process=10, per_host=1)
+    job = start(jobs, slots, 'a', 'a')
+    assert job.started.is_set()
+    assert slots.running() == {'a': 1}
+
+
+def test_waiting_jobs_start_in_arrival_order(jobs):
+    slots = JobSlots(per_process=1, per_host=10)
+    current = start(jobs, slots, 'a', 'b')
+    waiting = [start(jobs, slots, f'src{i}', f'dst{i}') for i in range(3)]
+    assert running(*waiting) == [False, False, False]
+
+    for index, job in enumerate(waiting):
+        current.finish()
+        wait_until(lambda: job.started.is_set())
+        assert not any(running(*waiting[index + 1:]))
+        current = job
+
+
+def test_job_waiting_for_a_busy_host_does_not_block_others(jobs):
+    slots = JobSlots(per_process=10, per_host=1)
+    first = start(jobs, slots, 'a', 'b')
+    blocked = start(jobs, slots, 'a', 'c')
+    idle = start(jobs, slots, 'd', 'e')
+    assert running(first, blocked, idle) == [True, False, True]
+
+
+def test_freed_host_goes_to_the_longest_waiting_job(jobs):
+    slots = JobSlots(per_process=10, per_host=1)
+    first = start(jobs, slots, 'a', 'b')
+    older = start(jobs, slots, 'a', 'c')
+    newer = start(jobs, slots, 'a', 'd')
+
+    first.finish()
+    wait_until(lambda: older.started.is_set())
+    assert not newer.started.is_set()
+
+
+def test_waiting_jobs_hold_no_slots(jobs):
+    slots = JobSlots(per_process=10, per_host=1)
+    start(jobs, slots, 'a', 'b')
+    start(jobs, slots, 'a', 'c')
+    # The waiting job has not taken c, so a job bound for c runs
+    assert start(jobs, slots, 'c', 'd').started.is_set()
+
+
+def test_slot_is_released_when_the_job_fails():
+    slots = JobSlots(per_process=1, per_host=1)
+    with pytest.raises(RuntimeError):
+        with slots.slot(['a', 'b']):
+            raise RuntimeError("transfer failed")
+    assert slots.running() == {}
+    with slots.slot(['a', 'b']):
+        assert slots.running() == {'a': 1, 'b': 1}
@@ -0,0 +1,51 @@
+import pytest
+from app.utils.range_transfer import split_ranges, range_items, MIN_RANGE_SIZE
+
+
+def assert_contiguous(ranges, size):
+    position = 0
+    for offset, length in ranges:
+        assert offset == position
+        assert length > 0
+        position += length
+    assert position == size
+
+
+@pytest.mark.parametrize('size', [0, -1])
+def test_empty_file_is_one_empty_range(size):
+    assert split_ranges(size, 4) == [(0, 0)]
+
+
+def test_file_smaller_than_a_range_is_not_split():
+    assert split_ranges(MIN_RANGE_SIZE - 1, 4) == [(0, MIN_RANGE_SIZE - 1)]
+
+
+def test_file_exactly_one_range_is_not_split():
+    assert split_ranges(MIN_RANGE_SIZE, 4) == [(0, MIN_RANGE_SIZE)]
+
+
+def test_parts_are_capped_so_no_range_is_below_the_minimum():
+    size = 2 * MIN_RANGE_SIZE + 1
+    ranges = split_ranges(size, 8)
+    assert len(ranges) == 2
+    assert all(length >= MIN_RANGE_SIZE for _, length in ranges)
+    assert_contiguous(ranges, size)
+
+
+@pytest.mark.parametrize('size', [4 * MIN_RANGE_SIZE, 4 * MIN_RANGE_SIZE + 3, 10 * MIN_RANGE_SIZE - 1])
+def test_ranges_cover_the_file_without_gaps(size):
+    ranges = split_ranges(size, 4)
+    assert len(ranges) == 4
+    assert_contiguous(ranges, size)
+
+
+def test_at_least_one_part():
+    assert split_ranges(4 * MIN_RANGE_SIZE, 0) == [(0, 4 * MIN_RANGE_SIZE)]
+
+
+def test_range_items_are_copy_pool_items():
+    size = 2 * MIN_RANGE_SIZE
+    assert range_items('/src/big', '/dst/big', size, 2) == [
+        ('/src/big', '/dst/big', size, 0, MIN_RANGE_SIZE),
+        ('/src/big', '/dst/big', size, MIN_RANGE_SIZE, MIN_RANGE_SIZE),
+    ]
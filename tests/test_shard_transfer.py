@@ -0,0 +1,100 @@
+import pytest
+import app.utils.shard_transfer as shard_transfer
+from app.utils.shard_transfer import plan_shards
+from app.utils.fan_out_transfer import split_shards
+
+ROOT = '/data/tree'
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    """Small shard limits so a handful of files exercises the packing"""
+    monkeypatch.setattr(shard_transfer, 'SHARD_LARGE_FILE', 1000)
+    monkeypatch.setattr(shard_transfer, 'SHARD_TARGET_BYTES', 1000)
+    monkeypatch.setattr(shard_transfer, 'SHARD_MAX_FILES', 4)
+    monkeypatch.setattr(shard_transfer, 'SHARD_FILE_COST', 0)
+
+
+def paths(shards):
+    return sorted(path for shard in shards for path in shard['paths'])
+
+
+def test_empty_tree_has_no_shards():
+    assert plan_shards([], ROOT) == []
+
+
+def test_file_exactly_at_the_threshold_is_sent_on_its_own(limits):
+    shards = plan_shards([(f'{ROOT}/big', 1000), (f'{ROOT}/small', 999)], ROOT)
+    assert [(shard['kind'], shard['paths']) for shard in shards] == [('file', ['big']), ('tar', ['small'])]
+
+
+def test_paths_are_relative_to_the_source_root(limits):
+    shards = plan_shards([(f'{ROOT}/a/b/c', 10)], ROOT)
+    assert shards[0]['paths'] == ['a/b/c']
+
+
+def test_every_file_lands_in_exactly_one_shard(limits):
+    files = [(f'{ROOT}/f{i:02}', 10 * i) for i in range(30)] + [(f'{ROOT}/large', 5000)]
+    shards = plan_shards(files, ROOT)
+    assert paths(shards) == sorted(path[len(ROOT) + 1:] for path, _ in files)
+    assert sum(shard['file_count'] for shard in shards) == len(files)
+    assert sum(shard['total_bytes'] for shard in shards) == sum(size for _, size in files)
+
+
+def test_tar_shards_respect_the_file_limit(limits):
+    shards = plan_shards([(f'{ROOT}/f{i}', 1) for i in range(10)], ROOT)
+    assert len(shards) == 3
+    assert all(shard['file_count'] <= 4 for shard in shards)
+
+
+def test_tar_shards_are_balanced(limits):
+    sizes = [900, 800, 700, 600, 500, 400, 300, 200, 100]
+    shards = plan_shards([(f'{ROOT}/f{size}', size) for size in sizes], ROOT)
+    # 4500 bytes at a 1000 byte target: five shards, none far off the average
+    assert len(shards) == 5
+    assert max(shard['total_bytes'] for shard in shards) <= 1000
+
+
+def test_file_cost_counts_towards_the_shard_count(limits, monkeypatch):
+    monkeypatch.setattr(shard_transfer, 'SHARD_FILE_COST', 100)
+    monkeypatch.setattr(shard_transfer, 'SHARD_MAX_FILES', 100)
+    # 100 bytes of data, but with 100 per file ten files cost 1100: two shards
+    assert len(plan_shards([(f'{ROOT}/f{i}', 10) for i in range(9)], ROOT)) == 1
+    assert len(plan_shards([(f'{ROOT}/f{i}', 10) for i in range(10)], ROOT)) == 2
+
+
+def test_shards_are_indexed_largest_first(limits):
+    shards = plan_shards([(f'{ROOT}/big', 3000), (f'{ROOT}/bigger', 4000), (f'{ROOT}/small', 5)], ROOT)
+    assert [shard['shard_index'] for shard in shards] == [0, 1, 2]
+    assert [shard['total_bytes'] for shard in shards] == [4000, 3000, 5]
+    assert not any(shard['completed'] for shard in shards)
+
+
+def test_tar_shard_paths_are_sorted(limits):
+    shards = plan_shards([(f'{ROOT}/c', 1), (f'{ROOT}/a', 3), (f'{ROOT}/b', 2)], ROOT)
+    assert shards[0]['paths'] == ['a', 'b', 'c']
+
+
+def shard(index, total_bytes):
+    return {'shard_index': index, 'total_bytes': total_bytes}
+
+
+def test_split_without_shards():
+    assert split_shards([], 4) == []
+
+
+def test_split_into_fewer_batches_than_requested():
+    assert sorted(split_shards([shard(0, 10), shard(1, 5)], 8)) == [[0], [1]]
+
+
+def test_split_balances_bytes():
+    shards = [shard(0, 100), shard(1, 60), shard(2, 50), shard(3, 40), shard(4, 10)]
+    batches = split_shards(shards, 2)
+    sizes = {index: s['total_bytes'] for index, s in enumerate(shards)}
+    loads = sorted(sum(sizes[index] for index in batch) for batch in batches)
+    assert loads == [120, 140]
+    assert sorted(index for batch in batches for index in batch) == [0, 1, 2, 3, 4]
+
+
+def test_split_into_one_batch():
+    assert split_shards([shard(0, 1), shard(1, 2)], 1) == [[1, 0]]
@@ -0,0 +1,53 @@
+from app.utils.sync_transfer import diff_manifests
+
+
+def diff(source, dest):
+    return [(action, entry[0]) for action, entry in diff_manifests(source, dest)]
+
+
+def test_empty_trees():
+    assert diff([], []) == []
+
+
+def test_empty_destination_is_all_new():
+    source = [('a', 1, 10), ('b/c', 2, 10)]
+    assert diff(source, []) == [('new', 'a'), ('new', 'b/c')]
+
+
+def test_empty_source_is_all_deleted():
+    dest = [('a', 1, 10), ('b/c', 2, 10)]
+    assert diff([], dest) == [('deleted', 'a'), ('deleted', 'b/c')]
+
+
+def test_compares_size_then_mtime():
+    source = [('changed', 2, 10), ('same', 1, 10), ('touched', 1, 20)]
+    dest = [('changed', 1, 10), ('same', 1, 10), ('touched', 1, 10)]
+    assert diff(source, dest) == [('changed', 'changed'), ('same', 'same'), ('touched', 'touched')]
+
+
+def test_changed_size_wins_over_mtime():
+    assert diff([('a', 2, 20)], [('a', 1, 10)]) == [('changed', 'a')]
+
+
+def test_merges_interleaved_paths_in_order():
+    source = [('a', 1, 10), ('c', 1, 10), ('e', 1, 10)]
+    dest = [('b', 1, 10), ('c', 1, 10), ('d', 1, 10)]
+    assert diff(source, dest) == [('new', 'a'), ('deleted', 'b'), ('same', 'c'), ('deleted', 'd'), ('new', 'e')]
+
+
+def test_deleted_yields_the_destination_entry():
+    assert list(diff_manifests([], [('a', 5, 50)])) == [('deleted', ('a', 5, 50))]
+
+
+def test_consumes_manifests_lazily():
+    consumed = []
+
+    def manifest(entries):
+        for entry in entries:
+            consumed.append(entry[0])
+            yield entry
+
+    actions = diff_manifests(manifest([('a', 1, 10), ('b', 1, 10)]), manifest([('a', 1, 10), ('b', 1, 10)]))
+    assert next(actions) == ('same', ('a', 1, 10))
+    # Only the current entry of each side has been read
+    assert consumed == ['a', 'a']